@@ -0,0 +1,143 @@
+import os
+import gzip
+import json
+import hashlib
+import re
+
+# Uncompressed size at which a new bulk file is started, None writes a single file
+BULK_SIZE = None
+
+# Format and NetCDF source of the folder names written by catalog_folders()
+CATALOG_FOLDER = re.compile(r"-(stac-collection|stac|records|tds)(-nc(?:-single)?)?-v[^/]*$")
+
+
+def index_name(catalog):
+    """
+    Elasticsearch index for a catalog folder named by catalog_folders(), e.g.
+    eo4sas-catalog-stac-nc-v0-9 is stac-index-nc and eo4sas-catalog-stac-collection-v0-9 is
+    stac-collection-index
+    """
+    name = os.path.basename(catalog.rstrip("/"))
+    match = CATALOG_FOLDER.search(name)
+    if match is None:
+        raise ValueError("Catalog folder {} does not name a catalog variant".format(name))
+
+    return "{}-index{}".format(match.group(1), match.group(2) or "")
+
+
+def document_id(doc, path):
+    """
+    Deterministic document id, from the STAC/Records id or else a hash of the file path
+    """
+    if 'id' in doc:
+        return str(doc['id'])
+
+    return hashlib.sha1(path.encode("utf-8")).hexdigest()
+
+
+class BulkWriter:
+    """
+    Writes documents as gzipped NDJSON in the Elasticsearch _bulk action/document format
+
+    A new numbered file is started when the uncompressed size reaches max_bytes
+    """
+
+    def __init__(self, logger, basename, index, max_bytes=BULK_SIZE):
+        self.logger = logger
+        self.basename = basename
+        self.index = index
+        self.max_bytes = max_bytes
+        self.files = []
+        self.outfile = None
+        self.nbytes = 0
+        self.count = 0
+        self.ids = set()
+        self.duplicates = 0
+
+    def next_file(self):
+        if self.outfile is not None:
+            self.outfile.close()
+        if self.max_bytes is None:
+            name = "{}.ndjson.gz".format(self.basename)
+        else:
+            name = "{}-{:04d}.ndjson.gz".format(self.basename, len(self.files))
+        self.outfile = gzip.open(name, "wt", encoding="utf-8")
+        self.files.append(name)
+        self.nbytes = 0
+
+    def add(self, doc, doc_id):
+        """
+        Writes a document, refusing one whose id has already been written as it would replace that document
+
+        :return: True if the document was written
+        """
+        if doc_id in self.ids:
+            self.logger.warning("Skipping document {}, its id was already written".format(doc_id))
+            self.duplicates += 1
+            return False
+        self.ids.add(doc_id)
+        action = json.dumps({"index": {"_index": self.index, "_id": doc_id}}, separators=(",", ":"))
+        source = json.dumps(doc, separators=(",", ":"))
+        size = len(action) + len(source) + 2
+        if self.outfile is None or (self.max_bytes is not None and self.nbytes > 0 and
+                                    self.nbytes + size > self.max_bytes):
+            self.next_file()
+        self.outfile.write(action + "\n" + source + "\n")
+        self.nbytes += size
+        self.count += 1
+
+        return True
+
+    def close(self):
+        if self.outfile is not None:
+            self.outfile.close()
+        self.logger.info("Written {} documents to {}".format(self.count, ", ".join(self.files)))
+        if self.duplicates:
+            self.logger.warning("Skipped {} documents with duplicate ids".format(self.duplicates))
+
+        return self.files
+
+
+def catalog_documents(cat_folder):
+    """
+    Every item/record JSON of a catalog folder, except catalog.json, in a sorted order
+
+    The same documents are selected as by upload_esearch.load_s3
+
+    :return: generator of (document, document id)
+    """
+    for root, dirs, names in os.walk(cat_folder):
+        dirs.sort()
+        for name in sorted(names):
+            if not name.endswith(".json") or name == "catalog.json":
+                continue
+            path = os.path.join(root, name)
+            with open(path, "r") as f:
+                doc = json.load(f)
+                f.close()
+            yield doc, document_id(doc, os.path.relpath(path, cat_folder))
+
+
+def export_catalog(logger, cat_folder, max_bytes=BULK_SIZE):
+    """
+    Exports every item/record JSON of a catalog folder as bulk NDJSON
+
+    :return: list of bulk files written next to the catalog folder
+    """
+    writer = BulkWriter(logger, cat_folder.rstrip("/"), index_name(cat_folder), max_bytes=max_bytes)
+    for doc, doc_id in catalog_documents(cat_folder):
+        writer.add(doc, doc_id)
+
+    return writer.close()
+
+
+def read_bulk(infile):
+    """
+    Streams (action, document) pairs from an opened bulk NDJSON text stream
+    """
+    for line in infile:
+        if not line.strip():
+            continue
+        action = json.loads(line)
+        doc = json.loads(next(infile))
+        yield action, doc
@@ -0,0 +1,135 @@
+import os
+import gzip
+import json
+# pip install boto3
+import boto3
+
+# orjson is several times faster than json for the many small catalog files
+try:
+    import orjson
+
+    def dumps(doc):
+        return orjson.dumps(doc)
+
+    def loads(data):
+        return orjson.loads(data)
+
+except ImportError:
+    def dumps(doc):
+        return json.dumps(doc, separators=(",", ":")).encode("utf-8")
+
+    def loads(data):
+        return json.loads(data)
+
+# brotli is optional, without it only the gzip variants are written
+try:
+    # pip install brotli
+    import brotli
+except ImportError:
+    brotli = None
+
+ENCODINGS = {'gzip': ".gz", 'br': ".br"}
+
+
+def available_encodings():
+    return [encoding for encoding in ENCODINGS if encoding != "br" or brotli is not None]
+
+
+def compress(data, encoding):
+    if encoding == "br":
+        if brotli is None:
+            raise ImportError("The br encoding requires brotli, pip install brotli")
+        return brotli.compress(data, quality=11)
+
+    return gzip.compress(data, compresslevel=9, mtime=0)
+
+
+def decompress(data, encoding):
+    """
+    Reverses compress(), for reading back the objects uploaded by publish_catalog()
+    """
+    if encoding == "br":
+        if brotli is None:
+            raise ImportError("The br encoding requires brotli, pip install brotli")
+        return brotli.decompress(data)
+    elif encoding == "gzip":
+        return gzip.decompress(data)
+
+    return data
+
+
+def catalog_files(cat_folder):
+    for root, dirs, names in os.walk(cat_folder):
+        for name in sorted(names):
+            if name.endswith(".json"):
+                yield os.path.join(root, name)
+
+
+def compact_catalog(logger, cat_folder, encodings=None):
+    """
+    Rewrites every JSON file of a catalog minified and writes pre-compressed variants alongside
+
+    Files are replaced atomically, and file.json.gz / file.json.br are written for each encoding
+
+    :return: uncompressed and compressed byte totals
+    """
+    encodings = encodings or available_encodings()
+    before = after = 0
+    compressed = {encoding: 0 for encoding in encodings}
+    for path in catalog_files(cat_folder):
+        with open(path, "rb") as f:
+            data = f.read()
+            f.close()
+        before += len(data)
+        data = dumps(loads(data))
+        after += len(data)
+
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+            f.close()
+        os.replace(tmp_path, path)
+
+        for encoding in encodings:
+            packed = compress(data, encoding)
+            compressed[encoding] += len(packed)
+            with open(path + ENCODINGS[encoding], "wb") as f:
+                f.write(packed)
+                f.close()
+
+    logger.info("Compacted {} from {} to {} bytes, compressed {}".format(cat_folder, before, after, compressed))
+
+    return after, compressed
+
+
+def publish_catalog(logger, cat_folder, s3_url, encoding="gzip", profile="ogc"):
+    """
+    Uploads a catalog to S3 with each JSON stored compressed under its original key
+
+    Content-Encoding is set so browsers and HTTP clients decompress transparently, so the
+    catalog links do not change. Brotli is only decoded by clients over HTTPS
+    """
+    bucket, _, prefix = s3_url.replace("s3://", "").partition("/")
+    prefix = os.path.join(prefix, os.path.basename(cat_folder.rstrip("/")))
+    session = boto3.Session(profile_name=profile)
+    s3_client = session.client('s3')
+
+    count = 0
+    for path in catalog_files(cat_folder):
+        compressed_path = path + ENCODINGS[encoding]
+        if os.path.exists(compressed_path):
+            with open(compressed_path, "rb") as f:
+                body = f.read()
+                f.close()
+        else:
+            with open(path, "rb") as f:
+                body = compress(f.read(), encoding)
+                f.close()
+
+        key = os.path.join(prefix, os.path.relpath(path, cat_folder))
+        s3_client.put_object(Body=body, Bucket=bucket, Key=key, ContentType="application/json",
+                             ContentEncoding=encoding)
+        count += 1
+    logger.info("Uploaded {} files to s3://{}/{} with {} encoding".format(count, bucket, prefix, encoding))
+
+    return count
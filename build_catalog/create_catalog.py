@@ -9,12 +9,13 @@ import subprocess
 from argparse import ArgumentParser
 from urllib.request import urlretrieve
 from urllib.error import URLError
-from tempfile import TemporaryDirectory
+from tempfile import TemporaryDirectory, mkstemp
 import rasterio
-from rasterio.warp import transform_bounds
 from shapely.geometry import Polygon, mapping
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import ast
+import math
 import re
 
 # Pixalytics version of repository, from https://github.com/geopython/pygeometa
@@ -39,6 +40,22 @@ import logging
 import json
 from json import JSONEncoder
 
+# Allow the repository packages to be imported when run as a script
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from build_catalog.raster_stats import class_statistics, raster_uri
+from build_catalog.tdml_stream import write_tdml_stream
+from build_catalog.bulk_export import export_catalog
+from build_catalog.compact_output import available_encodings, compact_catalog, publish_catalog
+from build_catalog.metadata_cache import MetadataCache, CACHE_PATH, CACHE_SIZE
+from build_catalog.footprint import valid_footprint, FOOTPRINT_TOLERANCE, FOOTPRINT_MAX_VERTICES
+from utils.palette import CLASSES
+from utils.transforms import get_transformer
+from utils.checkpoint import Journal, partial_path, commit_output, write_json
+from utils.shards import parse_shard, shard_indices, shard_suffix
+from build_catalog.discovery import discover, parse_date, DATE_PATTERN, DATE_FORMAT, LIST_WORKERS
+from utils.tiling import parse_tile
+from build_catalog.nc_metadata import netcdf_metadata, datacube_fields, cube_dates, DATACUBE_SCHEMA
+
 class MyEncoder(JSONEncoder):
     def default(self, obj):
         tdict = remove_empty(obj.__dict__)
@@ -97,11 +114,23 @@ class TDML:
 
 
 # Need to transform to EPSG4326 as other projections not allowed by GeoJSON format
-def get_bbox_and_footprint(logger, raster_uri):
+def get_bbox_and_footprint(logger, raster_uri, exact=False, tolerance=FOOTPRINT_TOLERANCE,
+                           max_vertices=FOOTPRINT_MAX_VERTICES):
     dst_crs = 'EPSG:4326'
     with rasterio.open(raster_uri) as src:
         logger.debug("Source map projection: {}".format(src.crs))
-        if src.crs == dst_crs:
+        # Valid-data polygon from the nodata mask at a coarse overview level
+        footprint = None
+        if exact:
+            footprint = valid_footprint(src, dst_crs, tolerance=tolerance, max_vertices=max_vertices)
+            if footprint is None:
+                logger.warning("No valid data in {}, using the image bounds".format(raster_uri))
+
+        if footprint is not None:
+            bbox = list(footprint.bounds)
+            logger.debug("Footprint bounds: {}".format(bbox))
+
+        elif src.crs == dst_crs:
             bounds = src.bounds
 
             bbox = [bounds.left, bounds.bottom, bounds.right, bounds.top]
@@ -114,8 +143,8 @@ def get_bbox_and_footprint(logger, raster_uri):
             logger.debug("Bounds: {}".format(bounds))
 
         else:
-            # Transform to Lat & Lon
-            bounds = transform_bounds(src.crs, dst_crs, *src.bounds)
+            # Transform to Lat & Lon, reusing the transformer for this CRS across files
+            bounds = get_transformer(src.crs.to_wkt(), dst_crs).transform_bounds(*src.bounds, densify_pts=21)
             logger.debug("Transformed Bounds: {}".format(bounds))
 
             bbox = [bounds[0], bounds[1], bounds[2], bounds[3]]
@@ -129,9 +158,40 @@ def get_bbox_and_footprint(logger, raster_uri):
         return bbox, mapping(footprint), str(src.crs), dst_crs
 
 
+def raster_metadata(logger, raster_uri):
+    """
+    Header metadata for a raster: bounds, footprint, CRS, transform, GSD and data type
+    """
+    bbox, footprint, src_crs, dst_crs = get_bbox_and_footprint(logger, raster_uri)
+    with rasterio.open(raster_uri) as src:
+        metadata = {'bbox': bbox,
+                    'footprint': footprint,
+                    'crs': src_crs,
+                    'dst_crs': dst_crs,
+                    'transform': list(src.transform)[:6],
+                    'gsd': abs(src.transform.a),
+                    'dtype': src.dtypes[0],
+                    'width': src.width,
+                    'height': src.height}
+
+    return metadata
+
+
+def cached_metadata(cache, uri, section, extract):
+    """
+    Metadata section for an asset, only calling extract() when it is not in the cache
+    """
+    if cache is None:
+        return extract()
+
+    return cache.fetch(uri, section, extract)
+
+
 def pull_s3bucket(logger, tmp_dir, url, catalog_id, catalog_desc):
     endstr = os.path.splitext(url)[1]
-    img_path = os.path.join(tmp_dir.name, 'image' + endstr)
+    # A unique name, as the sources are prepared in parallel in the same temporary folder
+    fd, img_path = mkstemp(dir=tmp_dir.name, prefix='image-', suffix=endstr)
+    os.close(fd)
 
     try:
         urlretrieve(url, img_path)
@@ -148,11 +208,53 @@ def pull_s3bucket(logger, tmp_dir, url, catalog_id, catalog_desc):
     return img_path
 
 
-def add_item(logger, footprint, bbox, epsg, gsd, img_path, image_id):
+def add_statistics(item, asset, stats):
+    """
+    Adds class statistics to an item using the raster and classification extensions
+
+    The histogram and classes go on the asset, the class areas and valid-data fraction
+    are item properties so they can be searched once indexed
+    """
+    item.stac_extensions.append("https://stac-extensions.github.io/raster/v1.1.0/schema.json")
+    item.stac_extensions.append("https://stac-extensions.github.io/classification/v1.0.0/schema.json")
+
+    # Histogram has one bucket per class value, including the no data value
+    nbins = max([int(value) for value in stats['class_counts']] + [stats['nodata']]) + 1
+    buckets = [stats['class_counts'].get(str(value), 0) for value in range(nbins)]
+    buckets[stats['nodata']] = stats['total_pixels'] - stats['valid_pixels']
+    asset.extra_fields['raster:bands'] = [{
+        'nodata': stats['nodata'],
+        'data_type': stats['data_type'],
+        'spatial_resolution': stats['spatial_resolution'],
+        'statistics': {'valid_percent': 100.0 * stats['valid_fraction']},
+        'histogram': {'count': nbins, 'min': -0.5, 'max': nbins - 0.5, 'buckets': buckets}
+    }]
+
+    names = {str(value): name for value, name, colour in CLASSES}
+    asset.extra_fields['classification:classes'] = [
+        {'value': int(value), 'description': names.get(value, "class {}".format(value))}
+        for value in stats['class_counts']]
+
+    item.properties['eo4sas:class_counts'] = stats['class_counts']
+    item.properties['eo4sas:class_area_m2'] = stats['class_area_m2']
+    item.properties['eo4sas:valid_fraction'] = stats['valid_fraction']
+
+
+def epsg_code(crs):
+    """
+    Code of an EPSG:<code> CRS, or None for a CRS given as WKT
+    """
+    if crs.upper().startswith("EPSG:"):
+        return crs.split(":")[1]
+
+    return None
+
+
+def add_item(logger, footprint, bbox, epsg, gsd, img_path, image_id, previews=None, stats=None, dateval=None,
+             cube=None, wkt=None):
     try:
-        fdate = image_id.split("_")[0]
-        dateval = datetime(int(fdate[0:4]), int(fdate[4:6]), int(fdate[6:8]), int(fdate[9:11]), int(fdate[11:13]),
-                           int(fdate[13:15]))
+        if dateval is None:
+            dateval = parse_date(image_id)
     except:
         dateval = datetime.utcnow()
         logger.warning("Failed to extract date from {}, using today's date".format(image_id, dateval))
@@ -167,10 +269,26 @@ def add_item(logger, footprint, bbox, epsg, gsd, img_path, image_id):
     # Add common metadata
     item.common_metadata.gsd = float(gsd)
 
+    # Tiles cut by convert_gtiff.py --tile-size keep the scene they are part of
+    tile = parse_tile(image_id)
+    if tile is not None:
+        item.properties['eo4sas:scene'] = tile[0]
+        item.properties['eo4sas:tile'] = [tile[1], tile[2]]
+
+    # Dimensions and variables of a NetCDF, read from its header
+    if cube is not None:
+        item.stac_extensions.append(DATACUBE_SCHEMA)
+        item.properties.update(datacube_fields(cube))
+
     # Add projection metadata using projection extension
     ProjectionExtension.add_to(item)
     proj_ext = ProjectionExtension.ext(item)
-    proj_ext.epsg = int(epsg)
+    if epsg is not None:
+        proj_ext.epsg = int(epsg)
+    else:
+        # A CRS without an EPSG code is described by its WKT
+        proj_ext.epsg = None
+        proj_ext.wkt2 = wkt
 
     # Add image
     if os.path.splitext(image_id)[1] == ".nc":
@@ -185,12 +303,792 @@ def add_item(logger, footprint, bbox, epsg, gsd, img_path, image_id):
         )
     )
 
+    # Add thumbnail and overview created alongside the image by convert_gtiff.py
+    if previews is not None:
+        if previews.upper() == "WEBP":
+            preview_type = "image/webp"
+        else:
+            preview_type = pystac.MediaType.PNG
+        for key in ['thumbnail', 'overview']:
+            item.add_asset(
+                key=key,
+                asset=pystac.Asset(
+                    href="{}{}_{}.{}".format(img_path, image_id.split(".")[0], key, previews.lower()),
+                    media_type=preview_type,
+                    roles=[key]
+                )
+            )
+
+    # Add class statistics computed by raster_stats
+    if stats is not None:
+        add_statistics(item, item.assets['image'], stats)
+
     # Validate item
     item.validate()
 
     return item
 
 
+# Variants that can be built in one pass with --variants, output formats are built
+# for the GeoTIFFs and for each NetCDF source that is listed
+VARIANT_FORMATS = ["stac", "collection", "records"]
+VARIANT_SOURCES = ["nc", "nc-single"]
+VARIANTS = VARIANT_FORMATS + VARIANT_SOURCES + ["tds"]
+
+
+def catalog_folders(outdir, catalog_id, fmt, src, formats, version):
+    """
+    Output folder of a catalog variant, and the pytdml folder for TDS catalogs
+    """
+    # Include netcdf in sub_folder name
+    netcdf = "" if src in ["tif", "tds"] else "-{}".format(src)
+    pytdml_folder = None
+    if fmt == "collection" and "stac" in formats:
+        cat_folder = os.path.join(outdir, "{}-stac-collection{}-v{}".format(catalog_id, netcdf, version))
+    elif fmt in ["stac", "collection"]:
+        cat_folder = os.path.join(outdir, "{}-stac{}-v{}".format(catalog_id, netcdf, version))
+    elif fmt == "tds":
+        cat_folder = os.path.join(outdir, "{}-tds{}-v{}".format(catalog_id, netcdf, version))
+        pytdml_folder = os.path.join(outdir, "{}-pytdml-v{}".format(catalog_id, version))
+    else:
+        cat_folder = os.path.join(outdir, "{}-records{}-v{}".format(catalog_id, netcdf, version))
+
+    return cat_folder, pytdml_folder
+
+
+def write_manifest(cat_folder, fmt, src, shard, cfg, source):
+    """
+    Writes the manifest of a catalog shard next to its folder, listing each item or record
+    with its position in the full file list, link, bounds and dates
+
+    :return: path of the manifest
+    """
+    entries = []
+    for count, file in enumerate(cfg['files']):
+        if fmt == "records":
+            name = record_name(cfg, file, count)
+            href = "{}/{}.json".format(name, name)
+        else:
+            name = file.split(".")[0]
+            href = "./{}/{}.json".format(name, name)
+        begin = file_datetime(file, cfg)
+        end = source['end_dateval'] if src == "nc-single" else begin
+        entries.append({'file': file,
+                        'index': cfg['file_index'].get(file, count),
+                        'name': name,
+                        'href': href,
+                        'bbox': source['scene_footprints'].get(file, (source['bbox'], source['footprint']))[0],
+                        'start': begin.isoformat(),
+                        'end': end.isoformat()})
+
+    manifest = {'format': fmt,
+                'source': src,
+                'shard': shard,
+                'crs': source['dst_crs'],
+                'config': {key: cfg[key] for key in ['catalog_id', 'catalog_title', 'catalog_desc', 'yaml_file',
+                                                      'url', 'provider_name', 'provider_url']},
+                'entries': entries}
+    manifest_file = "{}.manifest.json".format(cat_folder.rstrip("/"))
+    write_json(manifest_file, manifest)
+
+    return manifest_file
+
+
+def load_configuration(logger, config_path):
+    """
+    Reads a catalog configuration YAML into a dictionary, exiting if it cannot be found
+    """
+    try:
+        with open(config_path, "r") as config_file:
+            config = yaml.safe_load(config_file)
+            cfg = {}
+            cfg['catalog_id'] = config["catalog_id"]
+            cfg['catalog_title'] = config["catalog_title"]
+            cfg['catalog_desc'] = config["catalog_desc"]
+            cfg['url'] = config["url"]
+            # Files are listed in the configuration, or else discovered at the url or input_dir
+            if config.get("files"):
+                cfg['files'] = config["files"].split(",")
+            else:
+                cfg['files'] = None
+            cfg['discover'] = config.get("discover")
+            cfg['date_pattern'] = config.get("date_pattern", DATE_PATTERN)
+            cfg['date_format'] = config.get("date_format", DATE_FORMAT)
+
+            # Additional files for a TDS dataset
+            if "tds" in config_path:
+                temp = config["label_files"]
+                cfg['label_files'] = temp.split(",")
+
+            cfg['input_dir'] = config.get("input_dir", "")
+            cfg['output_dir'] = config["output_dir"]
+            cfg['gsd'] = config["gsd"]
+            cfg['yaml_file'] = config["yaml_file"]
+            cfg['provider_name'] = config["provider_name"]
+            cfg['provider_url'] = config["provider_url"]
+
+            # Optional footprint simplification settings
+            cfg['footprint_tolerance'] = config.get("footprint_tolerance", FOOTPRINT_TOLERANCE)
+            cfg['footprint_max_vertices'] = config.get("footprint_max_vertices", FOOTPRINT_MAX_VERTICES)
+
+            logging.debug("Configuration was loaded from '{}'.".format(config_path))
+    except (FileNotFoundError, IOError):
+        logging.warning("Unable to load default configuration from '{}', relying on input variables.".format(
+            config_path))
+        sys.exit(1)
+
+    return cfg
+
+
+def file_datetime(file, cfg=None):
+    # Date pattern and format of the configuration, by default the date the filenames start with
+    if cfg is None:
+        return parse_date(file)
+    return parse_date(file, cfg['date_pattern'], cfg['date_format'])
+
+
+def date_range(files, single=False, cfg=None):
+    """
+    Start and end dates of a list of files, single NetCDFs have both dates in the filename
+    """
+    dateval = file_datetime(files[0], cfg)
+    if single:
+        end_dateval = file_datetime(files[0].split("_")[0].split("-")[1], cfg)
+    else:
+        end_dateval = file_datetime(files[-1], cfg)
+
+    return dateval, end_dateval
+
+
+def discover_files(logger, cfg, workers=LIST_WORKERS):
+    """
+    Files for a configuration with a discover section, sorted by date
+
+    The section can give the location to list (by default input_dir, or else the url), a glob
+    pattern, a regex and whether to list sub-folders, e.g.
+
+    discover:
+        pattern: "*_classification.tif"
+        regex: "^2020"
+        recursive: false
+
+    :return: list of file names relative to the url
+    """
+    options = cfg['discover'] if isinstance(cfg['discover'], dict) else {}
+    location = options.get("location") or cfg['input_dir'] or cfg['url']
+    found = discover(logger, location, pattern=options.get("pattern", "*"), regex=options.get("regex"),
+                     recursive=options.get("recursive", False), date_pattern=cfg['date_pattern'],
+                     date_format=cfg['date_format'], workers=workers, anon=options.get("anon", True))
+    files = [name for name, dateval in sorted(found, key=lambda entry: (entry[1], entry[0]))]
+    logger.info("Discovered {} files in {}".format(len(files), location))
+
+    return files
+
+
+def extract_source(logger, args, cache, cfg, imgfile, tmp_dir, per_file=True):
+    """
+    Extracts the metadata for every asset in a configuration once so it can be shared by all writers
+
+    :return: dictionary of the first image bounds and the per-file footprints and statistics
+    """
+    url = cfg['url']
+    files = cfg['files']
+
+    # NetCDF headers are read in place with range requests, so no file is downloaded and the
+    # dimensions, time steps and variables of every file are known
+    if os.path.splitext(imgfile)[1] == ".nc":
+        base = imgfile[:-len(files[0])]
+
+        def file_cube(file):
+            return cached_metadata(cache, base + file, "netcdf", lambda: netcdf_metadata(base + file))
+
+        with ThreadPoolExecutor(max_workers=args.workers) as executor:
+            cubes = dict(zip(files, executor.map(file_cube, files)))
+        metadata = cubes[files[0]]
+        if metadata['epsg'] is None and not metadata['crs']:
+            logger.info("No CRS found in the crs variable of {}".format(imgfile))
+            sys.exit(1)
+        source = {'bbox': metadata['bbox'],
+                  'footprint': metadata['footprint'],
+                  'src_crs': "EPSG:{}".format(metadata['epsg']) if metadata['epsg'] is not None else metadata['crs'],
+                  'dst_crs': metadata['dst_crs'],
+                  'scene_footprints': {file: (cube['bbox'], cube['footprint']) for file, cube in cubes.items()},
+                  'scene_stats': {},
+                  'cubes': cubes}
+        logger.debug("Footprint: {}".format(source['footprint']))
+
+        return source
+
+    # Get image and then extract information from first object
+    def first_metadata():
+        img_path = pull_s3bucket(logger, tmp_dir, imgfile, cfg['catalog_id'], cfg['catalog_desc'])
+        return raster_metadata(logger, img_path)
+
+    metadata = cached_metadata(cache, imgfile, "raster", first_metadata)
+    source = {'bbox': metadata['bbox'],
+              'footprint': metadata['footprint'],
+              'src_crs': metadata['crs'],
+              'dst_crs': metadata['dst_crs'],
+              'scene_footprints': {},
+              'scene_stats': {},
+              'cubes': {}}
+    logger.debug("Footprint: {}".format(source['footprint']))
+
+    # Per-file footprints, only the coarse overview mask of each file is read, or
+    # only the header for the bounds of each file, as needed for tiles
+    if (args.exact_footprint or args.file_bounds) and per_file:
+        tolerance, max_vertices = cfg['footprint_tolerance'], cfg['footprint_max_vertices']
+
+        def file_footprint(file):
+            if not args.exact_footprint:
+                return cached_metadata(cache, url + file, "bounds", lambda: get_bbox_and_footprint(
+                    logger, raster_uri(url + file)))
+            section = "footprint-{}-{}".format(tolerance, max_vertices)
+            return cached_metadata(cache, url + file, section, lambda: get_bbox_and_footprint(
+                logger, raster_uri(url + file), exact=True, tolerance=tolerance, max_vertices=max_vertices))
+
+        with ThreadPoolExecutor(max_workers=args.workers) as executor:
+            for file, result in zip(files, executor.map(file_footprint, files)):
+                source['scene_footprints'][file] = result[:2]
+
+    # Per-file class statistics, read block by block with range requests
+    if args.stats and per_file:
+        for file in files:
+            source['scene_stats'][file] = cached_metadata(cache, url + file, "statistics",
+                                                          lambda: class_statistics(logger, raster_uri(url + file)))
+
+    return source
+
+
+# Levels that items can be partitioned into sub-catalogs by, and the grid tile size in degrees
+PARTITION_LEVELS = ["year", "month", "grid"]
+GRID_SIZE = 1
+
+
+def grid_tile(bbox, grid_size=GRID_SIZE):
+    """
+    Name of the grid tile containing the centre of a bbox, e.g. S02E037 for the tile whose
+    lower left corner is at 2S 37E
+    """
+    lon = math.floor((bbox[0] + bbox[2]) / 2.0 / grid_size) * grid_size
+    lat = math.floor((bbox[1] + bbox[3]) / 2.0 / grid_size) * grid_size
+
+    return "{}{:02d}{}{:03d}".format("N" if lat >= 0 else "S", abs(lat), "E" if lon >= 0 else "W", abs(lon))
+
+
+def partition_keys(levels, dateval, bbox, grid_size=GRID_SIZE):
+    """
+    Sub-catalog path of an item for the partition levels, e.g. ['2020', '08'] for year,month
+    """
+    keys = []
+    for level in levels:
+        if level == "year":
+            keys.append(dateval.strftime("%Y"))
+        elif level == "month":
+            keys.append(dateval.strftime("%m") if "year" in levels else dateval.strftime("%Y-%m"))
+        else:
+            keys.append(grid_tile(bbox, grid_size))
+
+    return keys
+
+
+def sub_catalog(catalog, keys, cfg, collection=False):
+    """
+    Sub-catalog (or sub-collection) at the partition path below catalog, created as needed
+
+    :return: the sub-catalog and a list of the catalogs that were created
+    """
+    parent = catalog
+    created = []
+    for depth, key in enumerate(keys):
+        child = parent.get_child(key)
+        if child is None:
+            title = "{} {}".format(cfg['catalog_title'], "/".join(keys[:depth + 1]))
+            if collection:
+                # Extent is updated from the items once they have all been added
+                child = pystac.Collection(id=key, title=title, description=cfg['catalog_desc'],
+                                          extent=catalog.extent.clone())
+            else:
+                child = pystac.Catalog(id=key, title=title, description=cfg['catalog_desc'])
+            parent.add_child(child)
+            created.append(child)
+        parent = child
+
+    return parent, created
+
+
+def write_stac(logger, args, cfg, source, cat_folder, dateval, end_dateval, collection=False):
+    """
+    Writes a STAC Catalog or Collection with an item per file
+    """
+    logger.info("Creating STAC Catalog or Collection")
+    bbox, footprint, src_crs = source['bbox'], source['footprint'], source['src_crs']
+
+    # Create collection extent
+    spatial_extent = pystac.SpatialExtent([bbox])
+    temporal_extent = pystac.TemporalExtent([[dateval, end_dateval]])
+    collection_extent = pystac.Extent(spatial_extent, temporal_extent)
+
+    # Create catalog
+    if collection:
+        catalog = pystac.Collection(id=cfg['catalog_id'], title=cfg['catalog_title'], description=cfg['catalog_desc'],
+                                    extent=collection_extent)
+
+        # Setup provider information
+        catalog.providers = [
+            pystac.Provider(name=cfg['provider_name'], roles=[pystac.ProviderRole.PRODUCER], url=cfg['provider_url'])]
+
+    else:
+        catalog = pystac.Catalog(id=cfg['catalog_id'], title=cfg['catalog_title'], description=cfg['catalog_desc'])
+
+    for count, file in enumerate(cfg['files']):
+        item_bbox, item_footprint = source['scene_footprints'].get(file, (bbox, footprint))
+        item = add_item(logger, item_footprint, item_bbox, epsg_code(src_crs), cfg['gsd'], cfg['url'], file,
+                        previews=args.previews, stats=source['scene_stats'].get(file), dateval=file_datetime(file, cfg),
+                        cube=source['cubes'].get(file), wkt=src_crs)
+
+        # Items go in a sub-catalog per year, month or grid tile when partitioned
+        if args.partition:
+            keys = partition_keys(args.partition, item.datetime, item_bbox, args.grid_size)
+            sub_catalog(catalog, keys, cfg, collection=collection)[0].add_item(item)
+        else:
+            catalog.add_item(item)
+
+        if count == 0:
+            # JSON dump item
+            logger.debug(json.dumps(item.to_dict(), indent=4))
+
+    # Update extents in catalog from items, each sub-collection has the extent of its own items
+    if collection:
+        catalog.update_extent_from_items()
+        for parent, children, items in catalog.walk():
+            if parent is not catalog and isinstance(parent, pystac.Collection):
+                parent.update_extent_from_items()
+
+    # Set HREFs
+    catalog.normalize_hrefs(cat_folder)
+
+    # Validate, which needs: pip install pystac[validation]
+    catalog.validate_all()
+
+    # Save catalog
+    catalog.save(catalog_type=pystac.CatalogType.SELF_CONTAINED)
+
+    # Show catalog
+    with open(catalog.get_self_href()) as f:
+        print(f.read())
+
+
+def file_item(logger, cfg, file, local_path, previews=None, stats=False, exact=False):
+    """
+    STAC item for a single converted file, read from its local copy but referencing it at the configured url
+    """
+    bbox, footprint, src_crs, dst_crs = get_bbox_and_footprint(
+        logger, raster_uri(local_path), exact=exact, tolerance=cfg['footprint_tolerance'],
+        max_vertices=cfg['footprint_max_vertices'])
+    scene_stats = class_statistics(logger, raster_uri(local_path)) if stats else None
+
+    return add_item(logger, footprint, bbox, epsg_code(src_crs), cfg['gsd'], cfg['url'], file,
+                    previews=previews, stats=scene_stats, dateval=file_datetime(file, cfg), wkt=src_crs)
+
+
+def append_item(logger, cfg, cat_folder, item, catalog=None, levels=None, grid_size=GRID_SIZE):
+    """
+    Adds or replaces one item in a saved STAC catalog, creating the catalog if needed
+
+    Only the new item and the catalog.json it is linked from are written, the other items are left
+    untouched. When partitioned, only the affected sub-catalog is rewritten unless new sub-catalogs
+    have to be linked in. The returned catalog can be passed back in so it is only read from disk once
+
+    :param levels: partition levels of the sub-catalogs, from PARTITION_LEVELS
+    :return: catalog the item was added to
+    """
+    cat_file = os.path.join(cat_folder, "catalog.json")
+    if catalog is None and os.path.exists(cat_file):
+        catalog = pystac.Catalog.from_file(cat_file)
+    elif catalog is None:
+        if not os.path.exists(cat_folder):
+            os.makedirs(cat_folder)
+        catalog = pystac.Catalog(id=cfg['catalog_id'], title=cfg['catalog_title'], description=cfg['catalog_desc'])
+        catalog.set_self_href(cat_file)
+    catalog.catalog_type = pystac.CatalogType.SELF_CONTAINED
+
+    parent, created = catalog, []
+    if levels:
+        parent, created = sub_catalog(catalog, partition_keys(levels, item.datetime, item.bbox, grid_size), cfg)
+        for child in created:
+            child.set_self_href(os.path.join(os.path.dirname(child.get_parent().get_self_href()), child.id,
+                                             "catalog.json"))
+    folder = os.path.dirname(parent.get_self_href())
+
+    if parent.get_item(item.id) is not None:
+        parent.remove_item(item.id)
+    parent.add_item(item)
+    item.set_self_href(os.path.join(folder, item.id, "{}.json".format(item.id)))
+    item.validate()
+
+    # The item, its sub-catalog and any sub-catalogs that were created along with their parent
+    item.save_object(include_self_link=False)
+    updated = [parent] + created
+    if created:
+        updated.append(created[0].get_parent())
+    for updated_catalog in set(updated):
+        updated_catalog.save_object(include_self_link=False)
+    logger.info("Added {} to {}".format(item.id, folder))
+
+    return catalog
+
+
+def add_config_files(config_path, files):
+    """
+    Appends files to the files list of a catalog configuration, so that full rebuilds include them
+
+    The line is edited in place so that the comments in the YAML are kept
+    """
+    with open(config_path, "r") as f:
+        text = f.read()
+        f.close()
+
+    match = re.search(r'^files: "(.*)"$', text, re.M)
+    # Discovered files are found again by the next full build
+    if match is None:
+        return False
+    current = [file for file in match.group(1).split(",") if file]
+    new_files = [file for file in files if file not in current]
+    if not new_files:
+        return False
+    updated = 'files: "{}"'.format(",".join(sorted(current + new_files)))
+
+    tmp_path = config_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        f.write(text[:match.start()] + updated + text[match.end():])
+        f.close()
+    os.replace(tmp_path, config_path)
+
+    return True
+
+
+def write_tds(logger, args, cfg, source, cat_folder, pytdml_folder, pytdml_config, tmp_dir):
+    """
+    Writes a T18 TDS STAC catalog of images and labels, alongside the pytdml training dataset
+    """
+    catalog_id, url = cfg['catalog_id'], cfg['url']
+    bbox, footprint, src_crs = source['bbox'], source['footprint'], source['src_crs']
+    label_files = cfg['label_files']
+    catalog = pystac.Catalog(id=catalog_id, title=cfg['catalog_title'], description=cfg['catalog_desc'])
+
+    for count, file in enumerate(cfg['files']):
+        item = add_item(logger, footprint, bbox, epsg_code(src_crs), cfg['gsd'], url, file, wkt=src_crs)
+        catalog.add_item(item)
+        if count == 0:
+            # JSON dump item
+            logger.debug(json.dumps(item.to_dict(), indent=4))
+
+        logger.info("Adding label file")
+        item = add_item(logger, footprint, bbox, epsg_code(src_crs), cfg['gsd'], url, label_files[count],
+                        wkt=src_crs)
+    catalog.add_item(item)
+
+    # Set HREFs
+    catalog.normalize_hrefs(cat_folder)
+
+    # Validate, which needs: pip install pystac[validation]
+    catalog.validate_all()
+
+    # Save catalog
+    catalog.save(catalog_type=pystac.CatalogType.SELF_CONTAINED)
+
+    # Show catalog
+    with open(catalog.get_self_href()) as f:
+        print(f.read())
+
+    # Also create pytdml catalog
+    if not args.s3 and not os.path.exists(pytdml_folder):
+        os.mkdir(pytdml_folder)
+    pytdml_json = os.path.join(pytdml_folder, "{}.gson".format(catalog_id))
+
+    tdml = TDML()
+    if args.s3:
+        bucket = url.split(".s3")[0].split("//")[1]
+        s3_folder = os.path.join("s3://{}".format(bucket), pytdml_folder)
+        s3_json = os.path.join(s3_folder, "{}.gson".format(catalog_id))
+
+        # Write to S3 bucket
+        if args.stream_tdml:
+            write_tdml_stream(logger, pytdml_config, cfg['files'], label_files, s3_json, url, encoder=MyEncoder)
+        else:
+            tdml.write_pytdml(logger, pytdml_config, s3_json, url)
+
+        # Read back to temp file
+        tmp_json = os.path.join(tmp_dir.name, 'pytdml.json')
+        urlretrieve(os.path.join(url, pytdml_json), tmp_json)
+        logger.info("Retrieved {} to JSON file {}".format(os.path.join(url, pytdml_json), tmp_json))
+        training_dataset = pytdml.io.read_from_json(tmp_json)
+        #print("EO re-read:",training_dataset)
+
+    else:
+        if args.stream_tdml:
+            write_tdml_stream(logger, pytdml_config, cfg['files'], label_files, pytdml_json, encoder=MyEncoder)
+        else:
+            tdml.write_pytdml(logger, pytdml_config, pytdml_json)
+        training_dataset = pytdml.io.read_from_json(pytdml_json)
+
+
+    # Check if pytdml worked - read from TDML json file
+    print("Checking training dataset: {}".format(training_dataset.name))
+    print("Number of training samples: {}".format(str(training_dataset.amount_of_training_data)))
+    print("Number of classes: {}".format(str(training_dataset.number_of_classes)))
+
+
+def write_records(logger, cfg, source, cat_folder, dateval, end_dateval, tmp_dir, single=False, levels=None,
+                  grid_size=GRID_SIZE):
+    """
+    Writes an OGC API Records catalog with a record per file
+
+    :param levels: partition levels, from PARTITION_LEVELS, of sub-catalogs that the records are placed in
+    """
+    logger.info("Creating OGC Records Catalog")
+    url, yaml_file, files = cfg['url'], cfg['yaml_file'], cfg['files']
+    bbox, footprint, dst_crs = source['bbox'], source['footprint'], source['dst_crs']
+    scene_footprints, scene_stats = source['scene_footprints'], source['scene_stats']
+    # Modified YAMLs are written per catalog so that variants can be built concurrently
+    yaml_dir = os.path.join(tmp_dir.name, os.path.basename(cat_folder))
+    os.mkdir(yaml_dir)
+
+    # Loop for each file to create an OGC record for each
+    link_dict = {}
+    entries = []
+    for count, file in enumerate(files):
+
+        # For each file, update generic record yaml
+        out_yaml = os.path.join(yaml_dir, os.path.splitext(os.path.basename(yaml_file))[0] + "-updated.yml")
+
+        # Read YML contents
+        with open(os.path.join(os.path.dirname(__file__), yaml_file)) as f:
+            # use safe_load instead load
+            dataMap = yaml.safe_load(f)
+            f.close()
+
+        # Update bounding box
+        logger.info("dataMap: {} ".format(dataMap['identification']['extents']['spatial']))
+        yaml_dict = {}
+        item_bbox = scene_footprints.get(file, (bbox, footprint))[0]
+        float_bbox = '[{:.3f},{:.3f},{:.3f},{:.3f}]'.format(item_bbox[0], item_bbox[1], item_bbox[2], item_bbox[3])
+        yaml_dict.update({'bbox': ast.literal_eval(float_bbox)})
+        yaml_dict.update({'crs': ast.literal_eval(dst_crs.split(":")[1])})
+        # remove single quotes
+        res = {key.replace("'", ""): val for key, val in yaml_dict.items()}
+        dataMap['identification']['extents']['spatial'] = [res]
+        logger.info("Modified dataMap: {} ".format(dataMap['identification']['extents']['spatial']))
+
+        # Update dates
+        logger.debug("dataMap: {} ".format(dataMap['identification']['extents']['temporal']))
+        date_string = file_datetime(file, cfg).strftime("%Y-%m-%d")
+        if single:
+            end_date_string = end_dateval.strftime("%Y-%m-%d")
+        else:
+            end_date_string = date_string
+
+        yaml_dict = {}
+        yaml_dict.update({'begin': date_string})
+        yaml_dict.update({'end': end_date_string})
+        dataMap['identification']['extents']['temporal'] = [yaml_dict]
+        logger.debug("Modified dataMap: {} ".format(dataMap['identification']['extents']['temporal']))
+
+        # Update filename
+        logger.debug("dataMap: {} ".format(dataMap['metadata']['dataseturi']))
+        dataMap['metadata']['dataseturi'] = url + file
+        logger.debug("Modified dataMap: {} ".format(dataMap['metadata']['dataseturi']))
+
+        # Each record has its own identifier, which is also its Elasticsearch document id
+        dataset = record_name(cfg, file, count)
+        dataMap['metadata']['identifier'] = dataset
+
+        # Updated url and file type
+        dataMap['distribution']['s3']['url'] = url + file
+        if os.path.splitext(file) == "tif":
+            dataMap['distribution']['s3']['type'] = 'GeoTIFF'
+        else:
+            dataMap['distribution']['s3']['type'] = 'NetCDF'
+        logger.debug("Modified dataMap type: {} ".format(dataMap['distribution']['s3']['type']))
+        logger.debug("Modified dataMap url: {} ".format(dataMap['distribution']['s3']['url']))
+
+        # Remove single quotes
+        dataDict = {re.sub("'", "", key): val for key, val in dataMap.items()}
+
+        # Output modified version of YAML
+        with open(out_yaml, 'w') as f:
+            yaml.dump(dataDict, f)
+            f.close()
+
+        # Read modified YAML into dictionary
+        mcf_dict = read_mcf(out_yaml)
+
+        # create dataset folder
+        keys = partition_keys(levels, file_datetime(file, cfg), item_bbox, grid_size) if levels else []
+        dset_folder = os.path.join(cat_folder, *keys, dataset)
+        os.makedirs(dset_folder)
+        json_file = os.path.join(dset_folder, dataset + ".json")
+        link_dict.update({dataset: "{}/".format(dataset) + os.path.basename(json_file)})
+        entries.append({'name': dataset, 'keys': keys, 'bbox': item_bbox, 'begin': date_string,
+                        'end': end_date_string})
+
+        # Choose API Records output schema
+        records_os = OGCAPIRecordOutputSchema()
+
+        # Default schema
+        json_string = records_os.write(mcf_dict)
+
+        # Add class statistics to the record properties
+        if file in scene_stats:
+            record = json.loads(json_string)
+            record['properties']['statistics'] = scene_stats[file]
+            json_string = json.dumps(record, indent=4)
+
+        # Add the datacube dimensions and variables of a NetCDF to the record properties
+        if file in source['cubes']:
+            record = json.loads(json_string)
+            record['properties'].update(datacube_fields(source['cubes'][file]))
+            json_string = json.dumps(record, indent=4)
+
+        # Write to disk
+        with open(json_file, 'w') as ff:
+            ff.write(json_string)
+            ff.close()
+
+        # Last loop
+        if levels and files[-1] == files[count]:
+            write_records_tree(logger, cfg, cat_folder, yaml_dir, entries, res['crs'])
+
+        elif files[-1] == files[count]:
+
+            # The catalog extent covers every file footprint
+            if scene_footprints:
+                bboxes = [value[0] for value in scene_footprints.values()]
+                res = {'bbox': [round(min(b[0] for b in bboxes), 3), round(min(b[1] for b in bboxes), 3),
+                                round(max(b[2] for b in bboxes), 3), round(max(b[3] for b in bboxes), 3)],
+                       'crs': res['crs']}
+            write_records_catalog(logger, cfg, cat_folder, yaml_dir, link_dict, res, dateval.strftime("%Y-%m-%d"),
+                                  end_dateval.strftime("%Y-%m-%d"), date_string, end_date_string)
+
+
+def write_records_tree(logger, cfg, folder, yaml_dir, entries, crs, path=()):
+    """
+    Writes the catalog.json of a partition folder, linking to a sub-catalog for each partition key
+    below it or, at the last level, to its records, with the extent of the records it contains
+    """
+    bboxes = [entry['bbox'] for entry in entries]
+    res = {'bbox': [round(min(b[0] for b in bboxes), 3), round(min(b[1] for b in bboxes), 3),
+                    round(max(b[2] for b in bboxes), 3), round(max(b[3] for b in bboxes), 3)],
+           'crs': crs}
+    begin = min(entry['begin'] for entry in entries)
+    end = max(entry['end'] for entry in entries)
+
+    link_dict = {}
+    groups = {}
+    for entry in entries:
+        if entry['keys']:
+            groups.setdefault(entry['keys'][0], []).append(dict(entry, keys=entry['keys'][1:]))
+        else:
+            link_dict[entry['name']] = "{}/{}.json".format(entry['name'], entry['name'])
+    for key, group in sorted(groups.items()):
+        write_records_tree(logger, cfg, os.path.join(folder, key), yaml_dir, group, crs, path=path + (key,))
+        link_dict[key] = "{}/catalog.json".format(key)
+
+    # Sub-catalogs are identified by their partition path
+    if path:
+        cfg = dict(cfg, catalog_id="{}-{}".format(cfg['catalog_id'], "-".join(path)),
+                   catalog_title="{} {}".format(cfg['catalog_title'], "/".join(path)))
+    write_records_catalog(logger, cfg, folder, yaml_dir, link_dict, res, begin, end, begin, end)
+
+
+def record_name(cfg, file, count):
+    """
+    Folder and file name of the record for a file, numbered by its position in the full file list
+    so that records from different shards do not clash
+    """
+    position = cfg.get('file_index', {}).get(file, count)
+
+    return "{}{}".format(os.path.basename(cfg['yaml_file']).split(".")[0], position + 1)
+
+
+def write_records_catalog(logger, cfg, cat_folder, yaml_dir, link_dict, res, cat_begin, cat_end, begin, end):
+    """
+    Writes the catalog.json of an OGC API Records catalog linking to its records
+
+    :param cat_begin: start date of the catalog
+    :param begin: start date of the catalog extent
+    """
+    catalog_id, yaml_file = cfg['catalog_id'], cfg['yaml_file']
+
+    # Create catalog information
+    catalog_dict = {}
+    catalog_dict.update({'cat_id': catalog_id})
+    catalog_dict.update({'cat_description': cfg['catalog_desc']})
+    catalog_dict.update({'cat_begin': cat_begin})
+    catalog_dict.update({'cat_end': cat_end})
+
+    # For the catalog, update generic record yaml
+    cat_yaml = yaml_file.replace("record","catalog")
+    out_yaml = os.path.join(yaml_dir, os.path.splitext(os.path.basename(cat_yaml))[0] + "-updated.yml")
+
+    # Read original YML contents
+    print(out_yaml)
+    with open(os.path.join(os.path.dirname(__file__), cat_yaml)) as f:
+        # use safe_load instead of load
+        dataMap = yaml.safe_load(f)
+        f.close()
+
+    # Update details
+    dataMap['identification']['extents']['spatial'] = [res]
+    yaml_dict = {}
+    yaml_dict.update({'begin': begin})
+    yaml_dict.update({'end': end})
+    dataMap['identification']['extents']['temporal'] = [yaml_dict]
+
+    # Remove single quotes
+    dataDict = {re.sub("'", "", key): val for key, val in dataMap.items()}
+
+    # Output modified version of YAML
+    with open(out_yaml, 'w') as f:
+        yaml.dump(dataDict, f)
+        f.close()
+
+    # Read modified YAML into dictionary
+    mcf_dict = read_mcf(out_yaml)
+
+    # Add record links
+    catalog_dict.update({'cat_file': link_dict})
+    mcf_dict.update(catalog_dict)
+
+    # Catalog adjustments
+    mcf_dict['metadata']['identifier'] = catalog_id
+    mcf_dict['identification']['title'] = cfg['catalog_title']
+    mcf_dict['identification']['name'] = 'sam'
+    mcf_dict['identification']['abstract'] = cfg['catalog_desc']
+
+    now_dateval = datetime.utcnow().strftime("%Y-%m-%d")
+
+    mcf_dict['identification']['dates']['creation'] = now_dateval
+    mcf_dict['identification']['dates']['revision'] = now_dateval
+    mcf_dict['distribution']['s3']['url'] = link_dict
+    print("Links: ",mcf_dict)
+    # Choose API Dataset Record as catalog
+    # https://github.com/cholmes/ogc-collection/blob/main/ogc-dataset-record-spec.md - see examples
+    records_os = OGCAPIRecordOutputSchema()
+
+    # Default catalog schema
+    #print(mcf_dict)
+    json_string = records_os.write(mcf_dict)
+    logging.debug(json_string)
+
+    # Write catalog to disk
+    cat_file = os.path.join(cat_folder, "catalog.json")
+    with open(cat_file, 'w') as ff:
+        ff.write(json_string)
+        ff.close()
+
+
 def main():
     parser = ArgumentParser(
         description="Creates STAC Catalog (as Collection or Catalog) or OGC Records Catalog",
@@ -259,6 +1157,149 @@ def main():
         action="store_true",
         default=False,
     )
+    parser.add_argument(
+        "-p",
+        "--previews",
+        type=str.upper,
+        dest="previews",
+        choices=["PNG", "WEBP"],
+        help="Add thumbnail and overview assets created by convert_gtiff.py in this format",
+        default=None,
+    )
+    parser.add_argument(
+        "-st",
+        "--stats",
+        help="Add per-class pixel counts, areas and valid-data fraction for each file",
+        action="store_true",
+        default=False,
+    )
+    parser.add_argument(
+        "-e",
+        "--exact-footprint",
+        dest="exact_footprint",
+        help="Use the valid-data polygon of each file as its footprint rather than the image bounds",
+        action="store_true",
+        default=False,
+    )
+    parser.add_argument(
+        "--file-bounds",
+        dest="file_bounds",
+        help="Read the bounds of every file rather than using those of the first, e.g. for tiled scenes",
+        action="store_true",
+        default=False,
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        dest="workers",
+        help="Number of files processed in parallel for footprints",
+        default=8,
+    )
+    parser.add_argument(
+        "-C",
+        "--cache",
+        type=str,
+        dest="cache",
+        nargs="?",
+        const=CACHE_PATH,
+        help="Use an on-disk raster metadata cache, at {} if no path is given".format(CACHE_PATH),
+        default=None,
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        dest="cache_size",
+        help="Maximum size of the metadata cache in MB",
+        default=CACHE_SIZE // (1024 * 1024),
+    )
+    parser.add_argument(
+        "--stream-tdml",
+        dest="stream_tdml",
+        help="Write the pytdml training dataset incrementally, for large numbers of samples",
+        action="store_true",
+        default=False,
+    )
+    parser.add_argument(
+        "-b",
+        "--bulk",
+        help="Also write the items/records as gzipped NDJSON for the Elasticsearch bulk API",
+        action="store_true",
+        default=False,
+    )
+    parser.add_argument(
+        "--bulk-size",
+        type=int,
+        dest="bulk_size",
+        help="Start a new bulk file after this many MB (uncompressed)",
+        default=None,
+    )
+    parser.add_argument(
+        "--compact",
+        help="Write minified JSON with pre-compressed gzip and, if installed, brotli variants",
+        action="store_true",
+        default=False,
+    )
+    parser.add_argument(
+        "--publish",
+        type=str,
+        dest="publish",
+        help="Upload the catalog to this s3://bucket/prefix with Content-Encoding set",
+        default=None,
+    )
+    parser.add_argument(
+        "--encoding",
+        type=str,
+        dest="encoding",
+        choices=["gzip", "br"],
+        help="Content-Encoding used when publishing",
+        default="gzip",
+    )
+    parser.add_argument(
+        "-V",
+        "--variants",
+        type=str,
+        dest="variants",
+        help="Build several variants in one pass from: {}".format(",".join(VARIANTS)),
+        default=None,
+    )
+    parser.add_argument(
+        "-P",
+        "--partition",
+        type=str,
+        dest="partition",
+        help="Place items/records in sub-catalogs by these comma separated levels: {}".format(
+            ",".join(PARTITION_LEVELS)),
+        default=None,
+    )
+    parser.add_argument(
+        "--grid-size",
+        type=int,
+        dest="grid_size",
+        help="Size in degrees of the grid tiles used to partition by grid",
+        default=GRID_SIZE,
+    )
+    parser.add_argument(
+        "--shard",
+        type=str,
+        dest="shard",
+        help="Only build shard i of N of the files, given as i/N, to be combined with merge_catalog.py",
+        default=None,
+    )
+    parser.add_argument(
+        "--shard-by",
+        type=str,
+        dest="shard_by",
+        choices=["hash", "date"],
+        help="Split the files between shards by a hash of the filename or by date range",
+        default="hash",
+    )
+    parser.add_argument(
+        "--resume",
+        help="Keep the catalogs completed by an earlier run and only rebuild the others",
+        action="store_true",
+        default=False,
+    )
     parser.add_argument(
         "-v",
         "--verbose",
@@ -275,56 +1316,93 @@ def main():
     logger = logging.getLogger(program)
     logger.setLevel(logging.DEBUG if "verbose" in args and args.verbose else logging.INFO)
 
-    # Configuration to be loaded from main directory
-    if args.test:
-        CONFIGURATION_FILE_PATH = os.path.join(code_dir, "configuration-test.yaml")
+    # Sub-catalog levels
+    if args.partition:
+        args.partition = [level.strip() for level in args.partition.split(",")]
+        unknown = [level for level in args.partition if level not in PARTITION_LEVELS]
+        if unknown:
+            parser.error("Unknown partition levels {}, choose from {}".format(",".join(unknown),
+                                                                             ",".join(PARTITION_LEVELS)))
+        if args.shard:
+            parser.error("Partitioned catalogs cannot be built in shards")
+
+    if args.publish and args.encoding not in available_encodings():
+        parser.error("The {} encoding requires brotli, pip install brotli".format(args.encoding))
+
+    # Outputs to build as (format, source) pairs
+    if args.variants:
+        variants = [variant.strip() for variant in args.variants.split(",")]
+        unknown = [variant for variant in variants if variant not in VARIANTS]
+        if unknown:
+            parser.error("Unknown variants {}, choose from {}".format(",".join(unknown), ",".join(VARIANTS)))
+        sources = ["tif"] + [variant for variant in VARIANT_SOURCES if variant in variants]
+        formats = [variant for variant in VARIANT_FORMATS if variant in variants]
+        if not formats:
+            formats = ["records"]
+        jobs = [(fmt, src) for src in sources for fmt in formats]
+        if "tds" in variants:
+            jobs.append(("tds", "tds"))
     elif args.tds:
-        if args.s3:
-            CONFIGURATION_FILE_PATH = os.path.join(code_dir, "configuration-tds-s3.yaml")
-            CONFIGURATION_PYTDML = os.path.join(code_dir, "configuration-tds-pytdml-s3.yaml")
-        else:
-            CONFIGURATION_FILE_PATH = os.path.join(code_dir, "configuration-tds.yaml")
-            CONFIGURATION_PYTDML = os.path.join(code_dir, "configuration-tds-pytdml.yaml")
-    elif args.netcdf:
-        CONFIGURATION_FILE_PATH = os.path.join(code_dir, "configuration-nc.yaml")
-    elif args.netcdfsingle:
-        CONFIGURATION_FILE_PATH = os.path.join(code_dir, "configuration-nc-single.yaml")
+        jobs = [("tds", "tds")]
     else:
-        CONFIGURATION_FILE_PATH = os.path.join(code_dir, "configuration.yaml")
-
-    try:
-        with open(CONFIGURATION_FILE_PATH, "r") as config_file:
-            config = yaml.safe_load(config_file)
-            catalog_id = config["catalog_id"]
-            catalog_title = config["catalog_title"]
-            catalog_desc = config["catalog_desc"]
-            url = config["url"]
-            temp = config["files"]
-            files = temp.split(",")
-
-            # Additional files for a TDS dataset
-            if "tds" in CONFIGURATION_FILE_PATH:
-                temp = config["label_files"]
-                label_files = temp.split(",")
-
-            input_dir = config["input_dir"]
-            out_default = config["output_dir"]
-            gsd = config["gsd"]
-            yaml_file = config["yaml_file"]
-            provider_name = config["provider_name"]
-            provider_url = config["provider_url"]
-
-            logging.debug("Configuration was loaded from '{}'.".format(CONFIGURATION_FILE_PATH))
-    except (FileNotFoundError, IOError):
-        logging.warning("Unable to load default configuration from '{}', relying on input variables.".format(
-            CONFIGURATION_FILE_PATH))
-        sys.exit(1)
+        if args.netcdf:
+            src = "nc"
+        elif args.netcdfsingle:
+            src = "nc-single"
+        else:
+            src = "tif"
+        if args.collection:
+            fmt = "collection"
+        elif args.stac:
+            fmt = "stac"
+        else:
+            fmt = "records"
+        jobs = [(fmt, src)]
+    logger.info("Building {}".format(", ".join("{} ({})".format(fmt, src) for fmt, src in jobs)))
 
-    # Setup S3 bucket url
-    if args.url:
-        urlpath = args.url
+    # Configuration to be loaded from main directory
+    config_paths = {}
+    if args.test:
+        config_paths["tif"] = os.path.join(code_dir, "configuration-test.yaml")
     else:
-        urlpath = url
+        config_paths["tif"] = os.path.join(code_dir, "configuration.yaml")
+    config_paths["nc"] = os.path.join(code_dir, "configuration-nc.yaml")
+    config_paths["nc-single"] = os.path.join(code_dir, "configuration-nc-single.yaml")
+    if args.s3:
+        config_paths["tds"] = os.path.join(code_dir, "configuration-tds-s3.yaml")
+        CONFIGURATION_PYTDML = os.path.join(code_dir, "configuration-tds-pytdml-s3.yaml")
+    else:
+        config_paths["tds"] = os.path.join(code_dir, "configuration-tds.yaml")
+        CONFIGURATION_PYTDML = os.path.join(code_dir, "configuration-tds-pytdml.yaml")
+
+    # Each configuration is only read once, however many outputs use it
+    sources = []
+    for fmt, src in jobs:
+        if src not in sources:
+            sources.append(src)
+    configs = {src: load_configuration(logger, config_paths[src]) for src in sources}
+    for src in sources:
+        if configs[src]['files'] is None:
+            if not configs[src]['discover']:
+                parser.error("{} has neither a files list nor a discover section".format(config_paths[src]))
+            configs[src]['files'] = discover_files(logger, configs[src], workers=args.workers)
+
+    # Only the files of this shard are catalogued, keeping their position in the full list
+    if args.shard:
+        if "tds" in sources:
+            parser.error("Training dataset catalogs cannot be built in shards")
+        try:
+            parse_shard(args.shard)
+        except ValueError as err:
+            parser.error(str(err))
+        for src in sources:
+            cfg = configs[src]
+            indices = shard_indices(cfg['files'], args.shard, by=args.shard_by)
+            cfg['file_index'] = {cfg['files'][k]: k for k in indices}
+            cfg['files'] = [cfg['files'][k] for k in indices]
+            logger.info("Shard {} has {} {} files".format(args.shard, len(cfg['files']), src))
+        jobs = [(fmt, src) for fmt, src in jobs if configs[src]['files']]
+        sources = [src for src in sources if configs[src]['files']]
 
     # Temp directory
     tmp_dir = TemporaryDirectory()
@@ -333,7 +1411,7 @@ def main():
     if args.outdir:
         outdir = args.outdir
     else:
-        outdir = out_default
+        outdir = configs[sources[0]]['output_dir']
 
     if not os.path.exists(outdir):
         if not os.path.islink(outdir):
@@ -347,323 +1425,126 @@ def main():
     logger.info("Running {}".format(version_line.group()))
     version = version_line.group().split("'")[1]
 
-    # Date range
-    # Add item to catalog
-    if args.test or args.tds:
-        dateval = datetime.utcnow()
-        end_dateval = dateval
-    else:
-        fdate = files[0].split("_")[0]
-        dateval = datetime(int(fdate[0:4]), int(fdate[4:6]), int(fdate[6:8]), int(fdate[9:11]), int(fdate[11:13]),
-                           int(fdate[13:15]))
-
-        if args.netcdfsingle:
-            fdate = fdate.split("-")[1]
-        elif len(files) > 1:  # If more than one file
-            fdate = files[len(files) - 1].split("_")[0]
-        end_dateval = datetime(int(fdate[0:4]), int(fdate[4:6]), int(fdate[6:8]), int(fdate[9:11]), int(fdate[11:13]), int(fdate[13:15]))
-
-    print("Date range {} to {}".format(dateval, end_dateval))
-
-    # Include netcdf in sub_folder name
-    if args.netcdf:
-        netcdf = "-nc"
-    elif args.netcdfsingle:
-        netcdf = "-nc-single"
-    else:
-        netcdf = ""
-    # Create catalog sub_folder - delete if exists
-    if args.stac or args.collection:
-        cat_folder = os.path.join(outdir, "{}-stac{}-v{}".format(catalog_id, netcdf, version))
-    elif args.tds:
-        cat_folder = os.path.join(outdir, "{}-tds{}-v{}".format(catalog_id, netcdf, version))
-        pytdml_folder = os.path.join(outdir, "{}-pytdml-v{}".format(catalog_id, version))
-        logger.info("Generating catalog at {}".format(cat_folder))
-    else:
-        cat_folder = os.path.join(outdir, "{}-records{}-v{}".format(catalog_id, netcdf, version))
-
-    if not args.s3:
-        if os.path.exists(cat_folder):
-            shutil.rmtree(cat_folder)
-        os.mkdir(cat_folder)
-        imgfile = os.path.join(urlpath, files[0])
+    # Journal of completed catalogs, on resume only the incomplete ones are rebuilt
+    suffix = shard_suffix(args.shard)
+    journal = Journal(logger, os.path.join(outdir, ".catalog-journal{}.json".format(suffix)), resume=args.resume)
+    formats = [fmt for fmt, src in jobs]
+    folders = {}
+    for job in jobs:
+        cat_folder, pytdml_folder = catalog_folders(outdir, configs[job[1]]['catalog_id'], job[0], job[1], formats,
+                                                    version)
+        folders[job] = (cat_folder + suffix, pytdml_folder)
+    completed = [job for job in jobs if journal.done(folders[job][0])]
+    for job in completed:
+        logger.info("Skipping {}, already built".format(folders[job][0]))
+    jobs = [job for job in jobs if job not in completed]
+    sources = [src for src in sources if src in [job[1] for job in jobs]]
+
+    # Metadata cache, so repeat builds do not read unchanged rasters. On resume a cache in the
+    # output folder is used by default, so the files already read by the interrupted run are kept
+    if args.cache:
+        cache = MetadataCache(logger, path=args.cache, max_bytes=args.cache_size * 1024 * 1024)
+    elif args.resume:
+        cache = MetadataCache(logger, path=os.path.join(outdir, ".metadata-cache.sqlite"),
+                              max_bytes=args.cache_size * 1024 * 1024)
     else:
-        imgfile = os.path.join(urlpath, os.path.join(os.path.join(input_dir,"image"), files[0]))
-
-    # Get image and then extract information from first object
-    img_path = pull_s3bucket(logger, tmp_dir, imgfile, catalog_id, catalog_desc)
-    bbox, footprint, src_crs, dst_crs = get_bbox_and_footprint(logger, img_path)
-    logger.debug("Footprint: {}".format(footprint))
-
-    if args.stac or args.collection:
-        logger.info("Creating STAC Catalog or Collection")
-
-        # Create collection extent
-        spatial_extent = pystac.SpatialExtent([bbox])
-        temporal_extent = pystac.TemporalExtent([[dateval, end_dateval]])
-        collection_extent = pystac.Extent(spatial_extent, temporal_extent)
-
-        # Create catalog
-        if args.collection:
-            catalog = pystac.Collection(id=catalog_id, title=catalog_title, description=catalog_desc,
-                                        extent=collection_extent)
+        cache = None
 
-            # Setup provider information
-            catalog.providers = [
-                pystac.Provider(name=provider_name, roles=[pystac.ProviderRole.PRODUCER], url=provider_url)]
+    # Extract the metadata of each source once, to be shared by every output that uses it
+    def prepare(src):
+        cfg = configs[src]
+        files = cfg['files']
 
+        # Setup S3 bucket url
+        if args.url:
+            urlpath = args.url
         else:
-            catalog = pystac.Catalog(id=catalog_id, title=catalog_title, description=catalog_desc)
+            urlpath = cfg['url']
 
-        for count, file in enumerate(files):
-            item = add_item(logger, footprint, bbox, src_crs.split(":")[1], gsd, url, file)
-            catalog.add_item(item)
-
-            if count == 0:
-                # JSON dump item
-                logger.debug(json.dumps(item.to_dict(), indent=4))
-
-        # Update extents in catalog from items
-        if args.collection:
-            catalog.update_extent_from_items()
-
-        # Set HREFs
-        catalog.normalize_hrefs(cat_folder)
-
-        # Validate, which needs: pip install pystac[validation]
-        catalog.validate_all()
-
-        # Save catalog
-        catalog.save(catalog_type=pystac.CatalogType.SELF_CONTAINED)
-
-        # Show catalog
-        with open(catalog.get_self_href()) as f:
-            print(f.read())
-
-    elif args.tds: # Create T18 TDS catalog
-        catalog = pystac.Catalog(id=catalog_id, title=catalog_title, description=catalog_desc)
-
-        for count, file in enumerate(files):
-            item = add_item(logger, footprint, bbox, src_crs.split(":")[1], gsd, url, file)
-            catalog.add_item(item)
-            if count == 0:
-                # JSON dump item
-                logger.debug(json.dumps(item.to_dict(), indent=4))
-
-            logger.info("Adding label file")
-            item = add_item(logger, footprint, bbox, src_crs.split(":")[1], gsd, url, label_files[count])
-        catalog.add_item(item)
-
-        # Set HREFs
-        catalog.normalize_hrefs(cat_folder)
-
-        # Validate, which needs: pip install pystac[validation]
-        catalog.validate_all()
-
-        # Save catalog
-        catalog.save(catalog_type=pystac.CatalogType.SELF_CONTAINED)
-
-        # Show catalog
-        with open(catalog.get_self_href()) as f:
-            print(f.read())
-
-        # Also create pytdml catalog
-        if not args.s3 and not os.path.exists(pytdml_folder):
-            os.mkdir(pytdml_folder)
-        pytdml_json = os.path.join(pytdml_folder, "{}.gson".format(catalog_id))
-
-        tdml = TDML()
-        if args.s3:
-            bucket = url.split(".s3")[0].split("//")[1]
-            s3_folder = os.path.join("s3://{}".format(bucket), pytdml_folder)
-            s3_json = os.path.join(s3_folder, "{}.gson".format(catalog_id))
-
-            # Write to S3 bucket
-            tdml.write_pytdml(logger, CONFIGURATION_PYTDML, s3_json, url)
-
-            # Read back to temp file
-            tmp_json = os.path.join(tmp_dir.name, 'pytdml.json')
-            urlretrieve(os.path.join(url, pytdml_json), tmp_json)
-            logger.info("Retrieved {} to JSON file {}".format(os.path.join(url, pytdml_json), tmp_json))
-            training_dataset = pytdml.io.read_from_json(tmp_json)
-            #print("EO re-read:",training_dataset)
+        # Date range
+        if args.test or src == "tds":
+            dateval = datetime.utcnow()
+            end_dateval = dateval
+        else:
+            dateval, end_dateval = date_range(files, single=(src == "nc-single"), cfg=cfg)
+        print("Date range {} to {}".format(dateval, end_dateval))
 
+        if not args.s3:
+            imgfile = os.path.join(urlpath, files[0])
         else:
-            tdml.write_pytdml(logger, CONFIGURATION_PYTDML, pytdml_json)
-            training_dataset = pytdml.io.read_from_json(pytdml_json)
-
-
-        # Check if pytdml worked - read from TDML json file
-        print("Checking training dataset: {}".format(training_dataset.name))
-        print("Number of training samples: {}".format(str(training_dataset.amount_of_training_data)))
-        print("Number of classes: {}".format(str(training_dataset.number_of_classes)))
-
-    else:  # OGC Records
-        logger.info("Creating OGC Records Catalog")
-
-        # Create catalog information
-        catalog_dict = {}
-        catalog_dict.update({'cat_id': catalog_id})
-        catalog_dict.update({'cat_description': catalog_desc})
-        cat_begin = dateval.strftime("%Y-%m-%d")
-        cat_end = end_dateval.strftime("%Y-%m-%d")
-        catalog_dict.update({'cat_begin': cat_begin})
-        catalog_dict.update({'cat_end': cat_end})
-
-        # Loop for each file to create an OGC record for each
-        link_dict = {}
-        for count, file in enumerate(files):
-
-            # For each file, update generic record yaml
-            out_yaml = os.path.join(os.path.dirname(__file__),
-                                    os.path.splitext(os.path.basename(yaml_file))[0] + "-updated.yml")
-
-            # Read YML contents
-            with open(os.path.join(os.path.dirname(__file__), yaml_file)) as f:
-                # use safe_load instead load
-                dataMap = yaml.safe_load(f)
-                f.close()
-
-            # Update bounding box
-            logger.info("dataMap: {} ".format(dataMap['identification']['extents']['spatial']))
-            yaml_dict = {}
-            float_bbox = '[{:.3f},{:.3f},{:.3f},{:.3f}]'.format(bbox[0], bbox[1], bbox[2], bbox[3])
-            yaml_dict.update({'bbox': ast.literal_eval(float_bbox)})
-            yaml_dict.update({'crs': ast.literal_eval(dst_crs.split(":")[1])})
-            # remove single quotes
-            res = {key.replace("'", ""): val for key, val in yaml_dict.items()}
-            dataMap['identification']['extents']['spatial'] = [res]
-            logger.info("Modified dataMap: {} ".format(dataMap['identification']['extents']['spatial']))
-
-            # Update dates
-            logger.debug("dataMap: {} ".format(dataMap['identification']['extents']['temporal']))
-            fdate = file.split("_")[0]
-            dateval = datetime(int(fdate[0:4]), int(fdate[4:6]), int(fdate[6:8]), int(fdate[9:11]), int(fdate[11:13]),
-                               int(fdate[13:15]))
-            date_string = dateval.strftime("%Y-%m-%d")
-            if args.netcdfsingle:
-                end_date_string = end_dateval.strftime("%Y-%m-%d")
-            else:
-                end_date_string = date_string
-
-            yaml_dict = {}
-            yaml_dict.update({'begin': date_string})
-            yaml_dict.update({'end': end_date_string})
-            dataMap['identification']['extents']['temporal'] = [yaml_dict]
-            logger.debug("Modified dataMap: {} ".format(dataMap['identification']['extents']['temporal']))
-
-            # Update filename
-            logger.debug("dataMap: {} ".format(dataMap['metadata']['dataseturi']))
-            dataMap['metadata']['dataseturi'] = url + file
-            logger.debug("Modified dataMap: {} ".format(dataMap['metadata']['dataseturi']))
-
-            # Updated url and file type
-            dataMap['distribution']['s3']['url'] = url + file
-            if os.path.splitext(file) == "tif":
-                dataMap['distribution']['s3']['type'] = 'GeoTIFF'
-            else:
-                dataMap['distribution']['s3']['type'] = 'NetCDF'
-            logger.debug("Modified dataMap type: {} ".format(dataMap['distribution']['s3']['type']))
-            logger.debug("Modified dataMap url: {} ".format(dataMap['distribution']['s3']['url']))
-
-            # Remove single quotes
-            dataDict = {re.sub("'", "", key): val for key, val in dataMap.items()}
-
-            # Output modified version of YAML
-            with open(out_yaml, 'w') as f:
-                yaml.dump(dataDict, f)
-                f.close()
-
-            # Read modified YAML into dictionary
-            mcf_dict = read_mcf(out_yaml)
-
-            # JSON dataset files
-            dataset = "{}{}".format(os.path.basename(yaml_file).split(".")[0], count + 1)
-            # create dataset folder
-            dset_folder = os.path.join(cat_folder, dataset)
-            os.mkdir(dset_folder)
-            json_file = os.path.join(dset_folder, dataset + ".json")
-            link_dict.update({dataset: "{}/".format(dataset) + os.path.basename(json_file)})
-
-            # Choose API Records output schema
-            records_os = OGCAPIRecordOutputSchema()
-
-            # Default schema
-            json_string = records_os.write(mcf_dict)
-
-            # Write to disk
-            with open(json_file, 'w') as ff:
-                ff.write(json_string)
-                ff.close()
-
-            # Last loop
-            if files[-1] == files[count]:
-
-                # For the catalog, update generic record yaml
-                cat_yaml = yaml_file.replace("record","catalog")
-                out_yaml = os.path.join(os.path.dirname(__file__), os.path.splitext(os.path.basename(cat_yaml))[0] + "-updated.yml")
-
-                # Read original YML contents
-                print(out_yaml)
-                with open(os.path.join(os.path.dirname(__file__), cat_yaml)) as f:
-                    # use safe_load instead of load
-                    dataMap = yaml.safe_load(f)
-                    f.close()
-
-                # Update details
-                dataMap['identification']['extents']['spatial'] = [res]
-                yaml_dict = {}
-                yaml_dict.update({'begin': date_string})
-                yaml_dict.update({'end': end_date_string})
-                dataMap['identification']['extents']['temporal'] = [yaml_dict]
-
-                # Remove single quotes
-                dataDict = {re.sub("'", "", key): val for key, val in dataMap.items()}
-
-                # Output modified version of YAML
-                with open(out_yaml, 'w') as f:
-                    yaml.dump(dataDict, f)
-                    f.close()
-
-                # Read modified YAML into dictionary
-                mcf_dict = read_mcf(out_yaml)
-
-                # Add record links
-                catalog_dict.update({'cat_file': link_dict})
-                mcf_dict.update(catalog_dict)
-
-                # Catalog adjustments
-                mcf_dict['metadata']['identifier'] = catalog_id
-                mcf_dict['identification']['title'] = catalog_title
-                mcf_dict['identification']['name'] = 'sam'
-                mcf_dict['identification']['abstract'] = catalog_desc
-
-                now_dateval = datetime.utcnow().strftime("%Y-%m-%d")
-
-                mcf_dict['identification']['dates']['creation'] = now_dateval
-                mcf_dict['identification']['dates']['revision'] = now_dateval
-                mcf_dict['distribution']['s3']['url'] = link_dict
-                print("Links: ",mcf_dict)
-                # Choose API Dataset Record as catalog
-                # https://github.com/cholmes/ogc-collection/blob/main/ogc-dataset-record-spec.md - see examples
-                records_os = OGCAPIRecordOutputSchema()
-
-                # Default catalog schema
-                #print(mcf_dict)
-                json_string = records_os.write(mcf_dict)
-                logging.debug(json_string)
-
-                # Write catalog to disk
-                cat_file = os.path.join(cat_folder, "catalog.json")
-                with open(cat_file, 'w') as ff:
-                    ff.write(json_string)
-                    ff.close()
+            imgfile = os.path.join(urlpath, os.path.join(os.path.join(cfg['input_dir'], "image"), files[0]))
+
+        source = extract_source(logger, args, cache, cfg, imgfile, tmp_dir, per_file=(src != "tds"))
+
+        # The time coordinates of NetCDFs give the date range rather than their filenames
+        if source['cubes'] and not args.test:
+            begin, end = cube_dates(source['cubes'][files[0]])[0], cube_dates(source['cubes'][files[-1]])[1]
+            try:
+                dateval, end_dateval = datetime.fromisoformat(begin), datetime.fromisoformat(end)
+            except (TypeError, ValueError):
+                logger.warning("No time coordinate in {}, using the dates of the filenames".format(files[0]))
+        source['dateval'] = dateval
+        source['end_dateval'] = end_dateval
+
+        return source
+
+    with ThreadPoolExecutor(max_workers=max(1, len(sources))) as executor:
+        extracted = dict(zip(sources, executor.map(prepare, sources)))
+
+    # Catalogs are written to a partial folder that replaces the catalog folder once complete
+    def build(job):
+        fmt, src = job
+        cfg, source = configs[src], extracted[src]
+        cat_folder, pytdml_folder = folders[job]
+        build_folder = partial_path(cat_folder)
+        logger.info("Generating catalog at {}".format(cat_folder))
 
+        if not args.s3:
+            if os.path.exists(build_folder):
+                shutil.rmtree(build_folder)
+            os.mkdir(build_folder)
+
+        if fmt in ["stac", "collection"]:
+            write_stac(logger, args, cfg, source, build_folder, source['dateval'], source['end_dateval'],
+                       collection=(fmt == "collection"))
+        elif fmt == "tds":  # Create T18 TDS catalog
+            write_tds(logger, args, cfg, source, build_folder, pytdml_folder, CONFIGURATION_PYTDML, tmp_dir)
+        else:  # OGC Records
+            write_records(logger, cfg, source, build_folder, source['dateval'], source['end_dateval'], tmp_dir,
+                          single=(src == "nc-single"), levels=args.partition, grid_size=args.grid_size)
+        if os.path.exists(build_folder):
+            commit_output(build_folder, cat_folder)
+        outputs = [cat_folder]
+
+        # Manifest of the shard, used to merge the shards into one catalog
+        if args.shard:
+            outputs.append(write_manifest(cat_folder, fmt, src, args.shard, cfg, source))
+
+        # Bulk file so the catalog can be indexed with one sequential read
+        if args.bulk and fmt != "tds":
+            max_bytes = args.bulk_size * 1024 * 1024 if args.bulk_size else None
+            outputs += export_catalog(logger, cat_folder, max_bytes=max_bytes)
+
+        # Minified and pre-compressed JSON for static hosting
+        if args.compact:
+            compact_catalog(logger, cat_folder)
+        if args.publish:
+            publish_catalog(logger, cat_folder, args.publish, encoding=args.encoding)
+
+        journal.complete(cat_folder, outputs)
+
+        return cat_folder
+
+    # Output writers run concurrently from the shared metadata
+    with ThreadPoolExecutor(max_workers=max(1, len(jobs))) as executor:
+        cat_folders = list(executor.map(build, jobs)) + [folders[job][0] for job in completed]
 
     # Clean up
     tmp_dir.cleanup()
+    if cache is not None:
+        cache.close()
 
-    logger.info("Processing completed successfully for {}".format(cat_folder))
+    logger.info("Processing completed successfully for {}".format(", ".join(cat_folders)))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,141 @@
+import os
+import re
+import fnmatch
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlparse
+import boto3
+from botocore import UNSIGNED
+from botocore.config import Config
+
+# Acquisition date in the filenames, e.g. 20200831T101156_classification.tif
+DATE_PATTERN = r"(\d{8}T\d{6})"
+DATE_FORMAT = "%Y%m%dT%H%M%S"
+# Number of prefixes or folders listed at the same time
+LIST_WORKERS = 8
+
+
+def parse_date(name, date_pattern=DATE_PATTERN, date_format=DATE_FORMAT):
+    """
+    Date in a filename, from the 'date' group of the pattern if it has one, or else its first group
+
+    :raises ValueError: if the pattern does not match or the date does not have the format
+    """
+    match = re.search(date_pattern, os.path.basename(name))
+    if match is None:
+        raise ValueError("No date matching {} in {}".format(date_pattern, name))
+    if "date" in match.re.groupindex:
+        value = match.group("date")
+    else:
+        value = match.group(1 if match.re.groups else 0)
+
+    return datetime.strptime(value, date_format)
+
+
+def s3_location(url):
+    """
+    Bucket and key prefix of an s3:// url or an https://<bucket>.s3.<region>.amazonaws.com/ url
+
+    :return: (bucket, prefix), or None if the url is not on S3
+    """
+    parts = urlparse(url)
+    if parts.scheme == "s3":
+        return parts.netloc, parts.path.lstrip("/")
+    if parts.scheme in ["http", "https"] and ".s3" in parts.netloc and parts.netloc.endswith("amazonaws.com"):
+        return parts.netloc.split(".s3")[0], parts.path.lstrip("/")
+
+    return None
+
+
+def list_s3_keys(client, bucket, prefix, delimiter=None):
+    """
+    Keys and common prefixes under a prefix, following the continuation tokens of every page
+    """
+    keys, prefixes = [], []
+    options = {'Bucket': bucket, 'Prefix': prefix}
+    if delimiter:
+        options['Delimiter'] = delimiter
+    for page in client.get_paginator("list_objects_v2").paginate(**options):
+        keys += [entry['Key'] for entry in page.get('Contents', [])]
+        prefixes += [entry['Prefix'] for entry in page.get('CommonPrefixes', [])]
+
+    return keys, prefixes
+
+
+def list_s3(bucket, prefix, recursive=False, workers=LIST_WORKERS, anon=True):
+    """
+    Keys under an S3 prefix, listed one level at a time with the sub-prefixes listed in parallel
+
+    :return: generator of keys, in the order their listings complete
+    """
+    if prefix and not prefix.endswith("/"):
+        prefix += "/"
+    client = boto3.client("s3", config=Config(signature_version=UNSIGNED) if anon else None)
+    keys, prefixes = list_s3_keys(client, bucket, prefix, delimiter="/")
+    for key in keys:
+        yield key
+    if not recursive or not prefixes:
+        return
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(list_s3_keys, client, bucket, sub_prefix) for sub_prefix in prefixes]
+        for future in as_completed(futures):
+            for key in future.result()[0]:
+                yield key
+
+
+def walk_folder(folder):
+    return [os.path.join(root, name) for root, dirs, names in os.walk(folder) for name in names]
+
+
+def list_local(folder, recursive=False, workers=LIST_WORKERS):
+    """
+    Files in a folder, with each sub-folder walked in parallel if recursive
+
+    :return: generator of paths, in the order their listings complete
+    """
+    folders = []
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            if entry.is_file():
+                yield entry.path
+            elif entry.is_dir() and recursive:
+                folders.append(entry.path)
+    if not folders:
+        return
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for future in as_completed([executor.submit(walk_folder, sub_folder) for sub_folder in folders]):
+            for path in future.result():
+                yield path
+
+
+def discover(logger, location, pattern="*", regex=None, recursive=False, date_pattern=DATE_PATTERN,
+             date_format=DATE_FORMAT, workers=LIST_WORKERS, anon=True):
+    """
+    Streams the dated files under a local folder or S3 prefix as they are listed
+
+    Files are selected by a glob on their name and, if given, a regular expression searched in
+    their path relative to the location. Files without a date are skipped with a warning
+
+    :return: generator of (path relative to the location, datetime)
+    """
+    s3 = s3_location(location)
+    if s3 is not None:
+        bucket, prefix = s3
+        base = prefix if not prefix or prefix.endswith("/") else prefix + "/"
+        names = (key[len(base):] for key in list_s3(bucket, prefix, recursive=recursive, workers=workers, anon=anon))
+    else:
+        names = (os.path.relpath(path, location) for path in list_local(location, recursive=recursive,
+                                                                       workers=workers))
+
+    matcher = re.compile(regex) if regex else None
+    for name in names:
+        if not name or not fnmatch.fnmatch(os.path.basename(name), pattern):
+            continue
+        if matcher is not None and not matcher.search(name):
+            continue
+        try:
+            yield name, parse_date(name, date_pattern, date_format)
+        except ValueError as err:
+            logger.warning("Skipping {}: {}".format(name, err))
@@ -0,0 +1,96 @@
+import numpy as np
+from affine import Affine
+from rasterio.enums import MaskFlags, Resampling
+from rasterio.features import shapes
+from shapely.geometry import shape, Polygon, MultiPolygon
+from shapely.ops import transform, unary_union
+from utils.transforms import get_transformer
+
+# Defaults used when the configuration does not set them
+FOOTPRINT_TOLERANCE = 0.0001
+FOOTPRINT_MAX_VERTICES = 250
+FOOTPRINT_OVERVIEW_SIZE = 1024
+# Parts and holes smaller than this fraction of the footprint area are dropped before simplifying
+FOOTPRINT_MIN_AREA = 0.001
+# Number of times the tolerance is doubled before falling back to the convex hull
+FOOTPRINT_MAX_ITERATIONS = 16
+
+
+def count_vertices(geometry):
+    if geometry.geom_type == "MultiPolygon":
+        return sum(count_vertices(polygon) for polygon in geometry.geoms)
+
+    return len(geometry.exterior.coords) + sum(len(ring.coords) for ring in geometry.interiors)
+
+
+def drop_small(geometry, min_area):
+    """
+    Removes the parts and holes of a polygon smaller than min_area, always keeping the largest part
+    """
+    parts = list(geometry.geoms) if geometry.geom_type == "MultiPolygon" else [geometry]
+    kept = [Polygon(part.exterior, [ring for ring in part.interiors if Polygon(ring).area >= min_area])
+            for part in parts if part.area >= min_area]
+    if not kept:
+        largest = max(parts, key=lambda part: part.area)
+        kept = [Polygon(largest.exterior)]
+
+    return kept[0] if len(kept) == 1 else MultiPolygon(kept)
+
+
+def valid_mask(src, overview_size=FOOTPRINT_OVERVIEW_SIZE):
+    """
+    Coarse valid-data mask, read at a reduced size so GDAL serves it from the overviews
+
+    :return: boolean mask and the affine transform of the reduced grid
+    """
+    scale = max(1.0, float(max(src.width, src.height)) / overview_size)
+    out_shape = (max(1, int(round(src.height / scale))), max(1, int(round(src.width / scale))))
+    out_transform = src.transform * Affine.scale(src.width / out_shape[1], src.height / out_shape[0])
+
+    if src.nodata is None and all(MaskFlags.all_valid in flags for flags in src.mask_flag_enums):
+        # No mask or no data value is set, so use the classification fill value of 0
+        data = src.read(1, out_shape=out_shape, resampling=Resampling.nearest)
+        mask = data != 0
+    else:
+        mask = src.dataset_mask(out_shape=out_shape, resampling=Resampling.nearest) > 0
+
+    return mask, out_transform
+
+
+def valid_footprint(src, dst_crs, tolerance=FOOTPRINT_TOLERANCE, max_vertices=FOOTPRINT_MAX_VERTICES,
+                    overview_size=FOOTPRINT_OVERVIEW_SIZE):
+    """
+    Polygon of the valid data in a raster, reprojected to dst_crs and simplified
+
+    Small parts and holes are dropped, then the tolerance, in dst_crs units, is doubled until the
+    polygon fits in the vertex budget. A mask with too many parts to ever fit falls back to its
+    convex hull, or else its envelope
+
+    :return: shapely geometry or None if the raster has no valid data
+    """
+    mask, out_transform = valid_mask(src, overview_size)
+    if not np.any(mask):
+        return None
+
+    polygons = [shape(geom) for geom, value in shapes(mask.astype(np.uint8), mask=mask, transform=out_transform)]
+    footprint = unary_union(polygons)
+
+    if src.crs != dst_crs:
+        footprint = transform(get_transformer(src.crs.to_wkt(), dst_crs).transform, footprint)
+
+    footprint = drop_small(footprint, footprint.area * FOOTPRINT_MIN_AREA)
+    simplified = footprint.simplify(tolerance, preserve_topology=True)
+    for iteration in range(FOOTPRINT_MAX_ITERATIONS):
+        if count_vertices(simplified) <= max_vertices:
+            return simplified
+        tolerance *= 2.0
+        simplified = footprint.simplify(tolerance, preserve_topology=True)
+
+    # Each ring keeps at least 4 vertices however far it is simplified
+    if count_vertices(simplified) <= max_vertices:
+        return simplified
+    hull = footprint.convex_hull
+    if hull.geom_type == "Polygon" and count_vertices(hull) <= max_vertices:
+        return hull
+
+    return footprint.envelope
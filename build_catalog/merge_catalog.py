@@ -0,0 +1,224 @@
+import os
+import sys
+from argparse import ArgumentParser
+import glob
+import json
+import logging
+import re
+import shutil
+from tempfile import TemporaryDirectory
+
+# Allow the repository packages to be imported when run as a script
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from build_catalog.create_catalog import write_records_catalog
+from build_catalog.bulk_export import export_catalog
+from utils.checkpoint import partial_path, commit_output
+
+
+def find_shards(cat_folder):
+    """
+    Shard folders written by create_catalog.py --shard for a catalog, in shard order
+
+    Exits if shards are missing or were built with different shard counts
+    """
+    pattern = re.compile(r"-shard-(\d+)-of-(\d+)$")
+    shards = {}
+    for folder in glob.glob("{}-shard-*-of-*".format(cat_folder.rstrip("/"))):
+        match = pattern.search(folder)
+        if match and os.path.isdir(folder):
+            shards[(int(match.group(1)), int(match.group(2)))] = folder
+
+    counts = set(count for index, count in shards)
+    if len(counts) != 1:
+        logging.error("Expected shards of {} built with one shard count, found {}".format(cat_folder, sorted(shards)))
+        sys.exit(1)
+    count = counts.pop()
+    missing = [index for index in range(1, count + 1) if (index, count) not in shards]
+    if missing:
+        logging.error("Shards {} of {} are missing for {}".format(missing, count, cat_folder))
+        sys.exit(1)
+
+    return [shards[(index, count)] for index in range(1, count + 1)]
+
+
+def load_manifest(shard_folder):
+    with open("{}.manifest.json".format(shard_folder.rstrip("/")), "r") as f:
+        manifest = json.load(f)
+        f.close()
+
+    return manifest
+
+
+def stac_time(value):
+    # Naive UTC datetimes are written by pystac with a Z suffix
+    return value + "Z"
+
+
+def merge_stac(shard_folders, build_folder, entries, collection=False):
+    """
+    catalog.json linking to the items of every shard, with the collection extent covering them all
+    """
+    with open(os.path.join(shard_folders[0], "catalog.json"), "r") as f:
+        catalog = json.load(f)
+        f.close()
+
+    # Item links as written by pystac in each shard, in the order of the full file list
+    item_links = {}
+    for shard_folder in shard_folders:
+        with open(os.path.join(shard_folder, "catalog.json"), "r") as f:
+            for link in json.load(f)['links']:
+                if link['rel'] == "item":
+                    item_links[link['href']] = link
+            f.close()
+    catalog['links'] = [link for link in catalog['links'] if link['rel'] != "item"]
+    catalog['links'] += [item_links[entry['href']] for entry in entries if entry['href'] in item_links]
+
+    if collection:
+        bboxes = [entry['bbox'] for entry in entries]
+        catalog['extent']['spatial']['bbox'] = [[min(b[0] for b in bboxes), min(b[1] for b in bboxes),
+                                                 max(b[2] for b in bboxes), max(b[3] for b in bboxes)]]
+        catalog['extent']['temporal']['interval'] = [[stac_time(min(entry['start'] for entry in entries)),
+                                                      stac_time(max(entry['end'] for entry in entries))]]
+
+    with open(os.path.join(build_folder, "catalog.json"), "w") as f:
+        json.dump(catalog, f, indent=2)
+        f.close()
+
+
+def merge_records(logger, manifest, build_folder, entries, tmp_dir):
+    """
+    Records catalog.json linking to the records of every shard, as written for a single build
+    """
+    link_dict = {entry['name']: entry['href'] for entry in entries}
+    bboxes = [entry['bbox'] for entry in entries]
+    res = {'bbox': [round(min(b[0] for b in bboxes), 3), round(min(b[1] for b in bboxes), 3),
+                    round(max(b[2] for b in bboxes), 3), round(max(b[3] for b in bboxes), 3)],
+           'crs': int(manifest['crs'].split(":")[1])}
+    cat_begin = min(entry['start'] for entry in entries)[:10]
+    cat_end = max(entry['end'] for entry in entries)[:10]
+    write_records_catalog(logger, manifest['config'], build_folder, tmp_dir.name, link_dict, res, cat_begin, cat_end,
+                          entries[-1]['start'][:10], entries[-1]['end'][:10])
+
+
+def merge_catalog(logger, cat_folder, shard_folders, move=False):
+    """
+    Combines catalog shards into one catalog folder
+
+    The item or record folders of each shard are copied (or moved) as they are, as their links
+    are relative, and only catalog.json is rebuilt from the shard manifests
+
+    :return: number of items or records in the merged catalog
+    """
+    manifests = [load_manifest(shard_folder) for shard_folder in shard_folders]
+    formats = set(manifest['format'] for manifest in manifests)
+    if len(formats) != 1:
+        logger.error("Shards of {} were built as different formats: {}".format(cat_folder, sorted(formats)))
+        sys.exit(1)
+    fmt = formats.pop()
+    entries = sorted([entry for manifest in manifests for entry in manifest['entries']],
+                     key=lambda entry: entry['index'])
+
+    build_folder = partial_path(cat_folder)
+    if os.path.exists(build_folder):
+        shutil.rmtree(build_folder)
+    os.makedirs(build_folder)
+
+    for shard_folder in shard_folders:
+        for name in sorted(os.listdir(shard_folder)):
+            if name == "catalog.json" or name.startswith("catalog.json."):
+                continue
+            source, target = os.path.join(shard_folder, name), os.path.join(build_folder, name)
+            if os.path.exists(target):
+                logger.warning("{} is in more than one shard, keeping the copy from {}".format(name, shard_folder))
+                continue
+            if move:
+                os.rename(source, target)
+            elif os.path.isdir(source):
+                shutil.copytree(source, target)
+            else:
+                shutil.copy2(source, target)
+
+    if fmt == "records":
+        tmp_dir = TemporaryDirectory()
+        merge_records(logger, manifests[0], build_folder, entries, tmp_dir)
+        tmp_dir.cleanup()
+    else:
+        merge_stac(shard_folders, build_folder, entries, collection=(fmt == "collection"))
+
+    commit_output(build_folder, cat_folder)
+    logger.info("Merged {} entries from {} shards into {}".format(len(entries), len(shard_folders), cat_folder))
+
+    return len(entries)
+
+
+def main():
+    parser = ArgumentParser(
+        description="Merges catalogs built with create_catalog.py --shard into one catalog",
+        epilog="Should be run in the 'ogcapi' environment",
+    )
+    parser.add_argument(
+        "-c",
+        "--catalog",
+        type=str,
+        dest="catalog",
+        help="Merged catalog folder, the shards are the <folder>-shard-i-of-N folders next to it",
+    )
+    parser.add_argument(
+        "-s",
+        "--shards",
+        type=str,
+        nargs="+",
+        dest="shards",
+        help="Shard folders to merge, rather than finding them from the catalog folder name",
+        default=None,
+    )
+    parser.add_argument(
+        "-m",
+        "--move",
+        help="Move the item folders out of the shards rather than copying them",
+        action="store_true",
+        default=False,
+    )
+    parser.add_argument(
+        "-b",
+        "--bulk",
+        help="Also write the merged items/records as gzipped NDJSON for the Elasticsearch bulk API",
+        action="store_true",
+        default=False,
+    )
+    parser.add_argument(
+        "--bulk-size",
+        type=int,
+        dest="bulk_size",
+        help="Start a new bulk file after this many MB (uncompressed)",
+        default=None,
+    )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        help="Add extra information to logs.",
+        action="store_true",
+        default=False,
+    )
+
+    # define arguments
+    args = parser.parse_args()
+
+    # Start logging
+    code_dir, program = os.path.split(__file__)
+    logger = logging.getLogger(program)
+    logger.setLevel(logging.DEBUG if "verbose" in args and args.verbose else logging.INFO)
+
+    cat_folder = args.catalog.rstrip("/")
+    shard_folders = args.shards if args.shards else find_shards(cat_folder)
+    merge_catalog(logger, cat_folder, shard_folders, move=args.move)
+
+    if args.bulk:
+        max_bytes = args.bulk_size * 1024 * 1024 if args.bulk_size else None
+        export_catalog(logger, cat_folder, max_bytes=max_bytes)
+
+    logger.info("Processing completed successfully for {}".format(cat_folder))
+
+
+if __name__ == "__main__":
+    exit(main())
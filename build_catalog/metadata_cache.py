@@ -0,0 +1,135 @@
+import os
+import json
+import sqlite3
+import threading
+import time
+from urllib.request import Request, urlopen
+from urllib.error import HTTPError, URLError
+
+# Default location and size of the cache
+CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "ogcapi", "raster-metadata.sqlite")
+CACHE_SIZE = 256 * 1024 * 1024
+
+
+class MetadataCache:
+    """
+    On-disk cache of raster metadata keyed by asset URL and validated by ETag
+
+    Each asset row holds a JSON dictionary of named sections (bounds, footprint, statistics, ...)
+    so that a section only has to be extracted once. A row is revalidated at most once per run,
+    with a conditional HEAD request for remote assets or the modification time and size for
+    local files. Rows that cannot be revalidated are reused, and the least recently used rows are
+    evicted when the cache exceeds max_bytes
+    """
+
+    def __init__(self, logger, path=CACHE_PATH, max_bytes=CACHE_SIZE):
+        self.logger = logger
+        self.max_bytes = max_bytes
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS assets (url TEXT PRIMARY KEY, validator TEXT, "
+                          "metadata TEXT, nbytes INTEGER, accessed REAL)")
+        self.conn.commit()
+        self.validated = {}
+        self.unvalidated = set()
+        self.hits = 0
+        self.misses = 0
+
+    def validator(self, url):
+        """
+        ETag (or modification time and size) of the asset as it is now, None if it cannot be found
+        """
+        if not url.startswith("http"):
+            try:
+                info = os.stat(url)
+            except OSError:
+                return None
+            return "{}-{}".format(info.st_mtime_ns, info.st_size)
+
+        with self.lock:
+            row = self.conn.execute("SELECT validator FROM assets WHERE url = ?", (url,)).fetchone()
+        headers = {"If-None-Match": row[0]} if row is not None and row[0] else {}
+        try:
+            with urlopen(Request(url, method="HEAD", headers=headers)) as response:
+                return response.headers.get("ETag") or response.headers.get("Last-Modified")
+        except HTTPError as err:
+            if err.code == 304:
+                return row[0]
+            self.logger.warning("HEAD request failed for {}: {}".format(url, err))
+        except URLError as err:
+            self.logger.warning("HEAD request failed for {}: {}".format(url, err))
+
+        return None
+
+    def load(self, url):
+        """
+        Cached sections for an asset, after revalidating them once per run
+        """
+        # Requests are made outside the lock so assets can be revalidated in parallel
+        if url not in self.validated:
+            current = self.validator(url)
+        with self.lock:
+            row = self.conn.execute("SELECT validator, metadata FROM assets WHERE url = ?", (url,)).fetchone()
+            if url not in self.validated:
+                self.validated[url] = current
+                if row is not None and current is None:
+                    # Entries that cannot be checked, such as when HEAD fails, are reused as they are
+                    self.logger.debug("Cache entry for {} cannot be revalidated, reusing it".format(url))
+                elif row is not None and row[0] != current:
+                    self.logger.debug("Cache entry for {} is out of date".format(url))
+                    self.conn.execute("DELETE FROM assets WHERE url = ?", (url,))
+                    self.conn.commit()
+                    row = None
+            if row is None:
+                return {}
+            self.conn.execute("UPDATE assets SET accessed = ? WHERE url = ?", (time.time(), url))
+            self.conn.commit()
+
+        return json.loads(row[1])
+
+    def store(self, url, sections):
+        with self.lock:
+            if self.validated.get(url) is None and url not in self.unvalidated:
+                self.unvalidated.add(url)
+                self.logger.info("No ETag or Last-Modified for {}, its cache entry will be reused without "
+                                 "revalidation".format(url))
+            metadata = json.dumps(sections)
+            self.conn.execute("INSERT OR REPLACE INTO assets VALUES (?, ?, ?, ?, ?)",
+                              (url, self.validated.get(url), metadata, len(metadata), time.time()))
+            self.conn.commit()
+            self.evict()
+
+    def evict(self):
+        # Remove least recently used rows until the cache fits in max_bytes
+        total = self.conn.execute("SELECT COALESCE(SUM(nbytes), 0) FROM assets").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for url, nbytes in self.conn.execute("SELECT url, nbytes FROM assets ORDER BY accessed").fetchall():
+            self.conn.execute("DELETE FROM assets WHERE url = ?", (url,))
+            total -= nbytes
+            if total <= self.max_bytes:
+                break
+        self.conn.commit()
+
+    def fetch(self, url, section, extract):
+        """
+        Cached section for an asset, calling extract() and storing the result if it is missing
+        """
+        sections = self.load(url)
+        if section in sections:
+            self.hits += 1
+            return sections[section]
+
+        self.misses += 1
+        value = extract()
+        sections = self.load(url)
+        sections[section] = value
+        self.store(url, sections)
+
+        return value
+
+    def close(self):
+        self.logger.info("Metadata cache: {} hits, {} misses".format(self.hits, self.misses))
+        self.conn.close()
@@ -0,0 +1,157 @@
+import os
+import fsspec
+import h5py
+import numpy as np
+import cftime
+import pyproj
+from shapely.geometry import Polygon, mapping
+
+from utils.transforms import get_transformer
+
+DATACUBE_SCHEMA = "https://stac-extensions.github.io/datacube/v2.2.0/schema.json"
+# Coordinate variables written by convert_gtiff.writeNetCDF
+X_DIM, Y_DIM, TIME_DIM = "x0", "y0", "time"
+# Small blocks, as only the HDF5 headers and coordinate chunks are fetched
+BLOCK_SIZE = 64 * 1024
+
+
+def decode(value):
+    if isinstance(value, bytes):
+        return value.decode("utf-8")
+    if isinstance(value, np.ndarray):
+        return [decode(v) for v in value.tolist()] if value.dtype.kind in "SO" else value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+
+    return value
+
+
+def attributes(obj):
+    return {key: decode(value) for key, value in obj.attrs.items() if key not in ["DIMENSION_LIST", "REFERENCE_LIST",
+                                                                                  "CLASS", "NAME", "_Netcdf4Dimid",
+                                                                                  "_Netcdf4Coordinates"]}
+
+
+def dimension_names(dataset):
+    """
+    Dimension names of a NetCDF4 variable from its HDF5 dimension scales
+    """
+    names = []
+    for k, dim in enumerate(dataset.dims):
+        scales = list(dim.values())
+        names.append(os.path.basename(scales[0].name) if scales else "dim_{}".format(k))
+
+    return names
+
+
+def time_values(dataset):
+    """
+    ISO datetimes of a CF time coordinate
+    """
+    attrs = attributes(dataset)
+    dates = cftime.num2date(dataset[:], attrs['units'], calendar=attrs.get('calendar', "standard"),
+                            only_use_cftime_datetimes=False, only_use_python_datetimes=True)
+
+    return [date.isoformat() for date in np.atleast_1d(dates)]
+
+
+def axis_extent(values):
+    """
+    Edges and step of a regular coordinate of pixel centres
+    """
+    values = np.asarray(values, dtype=np.float64)
+    step = float(values[1] - values[0]) if len(values) > 1 else 0.0
+    edges = [float(values[0] - step / 2), float(values[-1] + step / 2)]
+
+    return sorted(edges), abs(step)
+
+
+def netcdf_metadata(url, storage_options=None):
+    """
+    Dimensions, coordinates, CRS and variables of a NetCDF, read from its header only
+
+    The file is opened through fsspec, so a remote file is read with range requests, and only the
+    time, x0 and y0 coordinates and the attributes are read, never the data variable
+
+    :return: dictionary of bounds, footprint, CRS, time steps and variable descriptions
+    """
+    with fsspec.open(url, mode="rb", block_size=BLOCK_SIZE, **(storage_options or {})) as infile:
+        with h5py.File(infile, "r") as nc:
+            global_attrs = attributes(nc)
+            crs_attrs = attributes(nc['crs']) if 'crs' in nc else {}
+            xs, ys = nc[X_DIM][:], nc[Y_DIM][:]
+            times = time_values(nc[TIME_DIM]) if TIME_DIM in nc else []
+            variables = {}
+            for name, dataset in nc.items():
+                if not isinstance(dataset, h5py.Dataset) or name in [X_DIM, Y_DIM, TIME_DIM, 'crs']:
+                    continue
+                variables[name] = {'dimensions': dimension_names(dataset),
+                                   'shape': list(dataset.shape),
+                                   'dtype': str(dataset.dtype),
+                                   'attrs': attributes(dataset)}
+
+    x_extent, x_step = axis_extent(xs)
+    y_extent, y_step = axis_extent(ys)
+    wkt = crs_attrs.get('spatial_ref') or crs_attrs.get('crs_wkt')
+    if wkt:
+        bounds = get_transformer(wkt).transform_bounds(x_extent[0], y_extent[0], x_extent[1], y_extent[1],
+                                                       densify_pts=21)
+    else:
+        bounds = (x_extent[0], y_extent[0], x_extent[1], y_extent[1])
+    footprint = Polygon([[bounds[0], bounds[1]], [bounds[2], bounds[1]], [bounds[2], bounds[3]],
+                         [bounds[0], bounds[3]]])
+
+    return {'bbox': list(bounds),
+            'footprint': mapping(footprint),
+            'crs': wkt,
+            'epsg': pyproj.CRS.from_wkt(wkt).to_epsg() if wkt else None,
+            'dst_crs': "EPSG:4326",
+            'x': {'extent': x_extent, 'step': x_step, 'size': len(xs)},
+            'y': {'extent': y_extent, 'step': y_step, 'size': len(ys)},
+            'time': times,
+            'time_coverage_start': global_attrs.get('time_coverage_start'),
+            'time_coverage_end': global_attrs.get('time_coverage_end'),
+            'variables': variables}
+
+
+def datacube_fields(cube):
+    """
+    cube:dimensions and cube:variables of the STAC datacube extension for a NetCDF header
+    """
+    reference = cube['epsg'] if cube['epsg'] is not None else cube['crs']
+    dimensions = {
+        X_DIM: {'type': "spatial", 'axis': "x", 'extent': cube['x']['extent'], 'step': cube['x']['step'],
+                'reference_system': reference},
+        Y_DIM: {'type': "spatial", 'axis': "y", 'extent': cube['y']['extent'], 'step': cube['y']['step'],
+                'reference_system': reference},
+    }
+    if cube['time']:
+        dimensions[TIME_DIM] = {'type': "temporal", 'extent': [cube['time'][0], cube['time'][-1]],
+                                'values': cube['time']}
+
+    variables = {}
+    for name, variable in cube['variables'].items():
+        attrs = variable['attrs']
+        # Data variables span the time dimension, lat and lon are 2D auxiliary coordinates
+        entry = {'dimensions': variable['dimensions'],
+                 'type': "data" if TIME_DIM in variable['dimensions'] else "auxiliary",
+                 'data_type': variable['dtype']}
+        if attrs.get('long_name'):
+            entry['description'] = attrs['long_name']
+        if attrs.get('units') and attrs['units'] != "None":
+            entry['unit'] = attrs['units']
+        if 'flag_values' in attrs:
+            entry['values'] = attrs['flag_values']
+        variables[name] = entry
+
+    return {'cube:dimensions': dimensions, 'cube:variables': variables}
+
+
+def cube_dates(cube):
+    """
+    First and last time steps of a NetCDF, from its time coordinate or else its coverage attributes
+    """
+    if cube['time']:
+        return cube['time'][0], cube['time'][-1]
+
+    return cube['time_coverage_start'], cube['time_coverage_end']
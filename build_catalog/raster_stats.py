@@ -0,0 +1,97 @@
+import os
+import math
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import rasterio
+
+# Mean Earth radius in metres, used for pixel areas of geographic rasters
+EARTH_RADIUS = 6371008.8
+# Classification products are 8-bit, so every class value fits in 256 bins
+NBINS = 256
+
+
+def raster_uri(url):
+    """
+    Path that rasterio can open with windowed (range) reads, NetCDFs are opened on the data variable
+    """
+    if os.path.splitext(url)[1] == ".nc":
+        if url.startswith("http"):
+            return 'netcdf:"/vsicurl/{}":data'.format(url)
+        return 'netcdf:"{}":data'.format(url)
+
+    return url
+
+
+def row_areas(transform, crs, row_off, height, width):
+    """
+    Area in square metres of one pixel in each row of a window
+
+    Projected rasters have a constant pixel area from the geotransform, geographic rasters use the
+    area of the cell on a sphere so the value changes with latitude
+    """
+    if crs is not None and crs.is_geographic:
+        dlon = math.radians(abs(transform.a))
+        rows = np.arange(row_off, row_off + height, dtype=np.float64)
+        lat_top = np.radians(transform.f + rows * transform.e)
+        lat_bottom = np.radians(transform.f + (rows + 1) * transform.e)
+        return EARTH_RADIUS ** 2 * dlon * np.abs(np.sin(lat_top) - np.sin(lat_bottom))
+
+    return np.full(height, abs(transform.a * transform.e - transform.b * transform.d), dtype=np.float64)
+
+
+def block_counts(uri, windows, band):
+    """
+    Class pixel counts and areas for a batch of windows, using one dataset handle per worker
+    """
+    counts = np.zeros(NBINS, dtype=np.int64)
+    areas = np.zeros(NBINS, dtype=np.float64)
+    with rasterio.open(uri) as src:
+        for window in windows:
+            data = src.read(band, window=window)
+            values = data.ravel().astype(np.intp)
+            counts += np.bincount(values, minlength=NBINS)[:NBINS]
+            rareas = row_areas(src.transform, src.crs, int(window.row_off), data.shape[0], data.shape[1])
+            weights = np.repeat(rareas, data.shape[1])
+            areas += np.bincount(values, weights=weights, minlength=NBINS)[:NBINS]
+
+    return counts, areas
+
+
+def class_statistics(logger, uri, band=1, workers=4):
+    """
+    Single pass per-class histogram, area and valid-data fraction for a classification raster
+
+    The raster is read block by block, so memory is bounded by the block size, and the blocks are
+    split between a pool of workers whose partial histograms are summed at the end
+
+    :return: dictionary of class counts, class areas in m2 and the valid-data fraction
+    """
+    with rasterio.open(uri) as src:
+        windows = [window for ij, window in src.block_windows(band)]
+        nodata = src.nodata if src.nodata is not None else 0
+        dtype = src.dtypes[band - 1]
+        resolution = abs(src.transform.a)
+        total = src.width * src.height
+
+    batches = [windows[i::workers] for i in range(workers) if len(windows[i::workers]) > 0]
+    with ThreadPoolExecutor(max_workers=len(batches)) as executor:
+        results = list(executor.map(lambda batch: block_counts(uri, batch, band), batches))
+    counts = sum(result[0] for result in results)
+    areas = sum(result[1] for result in results)
+
+    nodata = int(nodata)
+    valid = int(counts.sum() - counts[nodata])
+    classes = [value for value in np.nonzero(counts)[0] if value != nodata]
+    stats = {
+        'nodata': nodata,
+        'data_type': dtype,
+        'spatial_resolution': resolution,
+        'total_pixels': int(total),
+        'valid_pixels': valid,
+        'valid_fraction': float(valid) / total if total > 0 else 0.0,
+        'class_counts': {str(value): int(counts[value]) for value in classes},
+        'class_area_m2': {str(value): float(areas[value]) for value in classes},
+    }
+    logger.debug("Statistics for {} from {} blocks: {}".format(uri, len(windows), stats))
+
+    return stats
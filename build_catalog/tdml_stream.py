@@ -0,0 +1,112 @@
+import os
+import json
+from tempfile import NamedTemporaryFile
+import yaml
+# pip install boto3
+import boto3
+import pytdml
+from pytdml.type import EOTask, EODataSource, EOTrainingDataset, EOTrainingData, PixelLabel
+from pytdml.utils import remove_empty
+
+# Training samples written per batch, which bounds the memory used
+BATCH_SIZE = 1000
+
+
+def tdml_dataset(config, amount):
+    """
+    Training dataset without its data from the pytdml YAML, built as by yaml_to_tdml.yaml_to_eo_tdml()
+    but without listing the training samples
+    """
+    tasks = [EOTask(task_type=task.get('task_type') or "", description=task.get('description') or "")
+             for task in config['tasks']]
+    data_sources = [EODataSource(id=source.get('id') or "", data_type=source.get('data_type') or "",
+                                 platform=source.get('platform') or "", sensor=source.get('sensor') or "",
+                                 citation=source.get('citation') or "", resolution=source.get('resolution') or "")
+                    for source in config['data_sources']]
+
+    return EOTrainingDataset(id=config['id'], name=config['name'], description=config['description'],
+                             tasks=tasks, data=[], version=config['version'], amount_of_training_data=amount,
+                             created_time=config['created_time'], updated_time=config['updated_time'],
+                             providers=config['providers'], keywords=config['keywords'],
+                             data_sources=data_sources, classes=config['classes'],
+                             number_of_classes=len(config['classes']), bands=config['bands'],
+                             image_size=config['image_size'])
+
+
+def data_paths(config):
+    """
+    Root path and format of the images and labels from the data section of the pytdml YAML
+    """
+    paths = {}
+    for data_path in config['data']['data_path']:
+        paths[data_path['type']] = (data_path['root_path'].rstrip("/"), data_path['format'])
+
+    return paths
+
+
+def training_sample(index, image, label, paths):
+    """
+    TrainingDML-AI EOTrainingData for one image and label pair, numbered as by pytdml
+    """
+    sample = EOTrainingData(id=str(index),
+                            labels=[PixelLabel(image_url="{}/{}".format(paths['label'][0], label))],
+                            data_url="{}/{}".format(paths['image'][0], image))
+
+    return remove_empty(sample.to_dict())
+
+
+def write_tdml_stream(logger, pytdml_yaml, files, label_files, pytdml_json, url=None, encoder=None,
+                      batch_size=BATCH_SIZE):
+    """
+    Writes a pytdml training dataset incrementally rather than building it in memory
+
+    The dataset fields are encoded by pytdml, as by TDML.write_pytdml(), then the training samples
+    are built from the image and label lists one batch at a time and appended to the JSON array, so
+    memory is bounded by the batch size rather than the number of samples
+
+    :param encoder: JSONEncoder class used for the dataset fields
+
+    :param url: S3 bucket url, if set the JSON is uploaded to the pytdml_json s3:// path
+    """
+    with open(pytdml_yaml, "r") as f:
+        config = yaml.safe_load(f)
+        f.close()
+
+    if config['data'].get('label_type', 'PixelLabel') != 'PixelLabel':
+        raise ValueError("Only PixelLabel training datasets can be streamed")
+    pairs = list(zip(files, label_files))
+    paths = data_paths(config)
+    tdset = tdml_dataset(config, len(pairs))
+    header = json.dumps(remove_empty(EOTrainingDataset.to_dict(tdset)), indent=4, cls=encoder)
+
+    # Write locally, or to a temporary file that is then uploaded in parts
+    if url is not None:
+        outfile = NamedTemporaryFile(mode="w", suffix=".json", delete=False)
+    else:
+        outfile = open(pytdml_json, "w")
+
+    # Header without its closing brace, followed by the data array
+    outfile.write(header[:header.rfind("}")].rstrip() + ',\n    "data": [\n')
+    for start in range(0, len(pairs), batch_size):
+        batch = pairs[start:start + batch_size]
+        samples = [training_sample(start + count, image, label, paths) for count, (image, label) in enumerate(batch)]
+        outfile.write("".join((",\n" if start + count > 0 else "") + "        " + json.dumps(sample)
+                              for count, sample in enumerate(samples)))
+        logger.debug("Written {} of {} training samples".format(start + len(batch), len(pairs)))
+    outfile.write("\n    ]\n}\n")
+    outfile.close()
+
+    if url is not None:
+        # Initialize S3client using the stored OGC profile
+        session = boto3.Session(profile_name='ogc')
+        s3_client = session.client('s3')
+
+        # Multipart upload streams the file rather than loading it into memory
+        bucket, key = pytdml.io.S3_reader.parse_s3_path(pytdml_json)
+        logger.info("Writing to S3 bucket {}: {}".format(bucket, key))
+        s3_client.upload_file(outfile.name, bucket, key)
+        os.remove(outfile.name)
+    else:
+        logger.info("Writing to: {}".format(pytdml_json))
+
+    return len(pairs)
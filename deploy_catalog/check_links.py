@@ -0,0 +1,357 @@
+import os
+import sys
+from argparse import ArgumentParser
+import asyncio
+import json
+import logging
+import time
+from urllib.parse import urljoin, urlparse
+# pip install aiohttp
+import aiohttp
+
+# Links that lead to further catalog, collection, item or record documents
+FOLLOW_RELS = ["child", "item"]
+# Statuses for which a ranged GET is tried when a server does not allow HEAD
+NO_HEAD = [403, 405, 501]
+# Content types served for files of an unknown type, which say nothing about a link type
+GENERIC_TYPES = ["application/octet-stream", "binary/octet-stream"]
+
+
+def is_remote(href):
+    return urlparse(href).scheme in ["http", "https"]
+
+
+def resolve(base, href):
+    """
+    Absolute url or normalised local path of a link relative to the document it is in
+    """
+    if is_remote(href) or is_remote(base):
+        return urljoin(base, href)
+    if href.startswith("file://"):
+        href = urlparse(href).path
+
+    return os.path.normpath(os.path.join(os.path.dirname(base), href))
+
+
+def find_links(doc, path=""):
+    """
+    Every dict with a string href in a STAC or OGC API Records document, such as the links,
+    the assets added by add_item() and the record distribution links
+
+    :return: list of (location in the document, link dict)
+    """
+    links = []
+    if isinstance(doc, dict):
+        if isinstance(doc.get('href'), str):
+            links.append((path, doc))
+        for key, value in doc.items():
+            links += find_links(value, "{}.{}".format(path, key) if path else key)
+    elif isinstance(doc, list):
+        for k, value in enumerate(doc):
+            links += find_links(value, "{}[{}]".format(path, k))
+
+    return links
+
+
+def base_type(media_type):
+    # image/tiff; application=geotiff matches image/tiff
+    return media_type.split(";")[0].strip().lower() if media_type else None
+
+
+def json_type(media_type):
+    return media_type == "application/json" or media_type.endswith("+json")
+
+
+def compatible_types(expected, actual):
+    """
+    True if a server's content type agrees with a link type, e.g. application/geo+json items served
+    as application/json. A generic binary type from S3 or a static server does not contradict a link
+    """
+    if expected == actual or actual in GENERIC_TYPES:
+        return True
+
+    return json_type(expected) and json_type(actual)
+
+
+class LinkChecker:
+    """
+    Walks a local or remote catalog and checks every link with HEAD or single byte range requests
+
+    Requests share one connection pool, limited overall and per host, and each url is only
+    requested once however many documents link to it. A host that refuses connections is
+    remembered, so its remaining links fail without waiting for further timeouts
+    """
+
+    def __init__(self, logger, concurrency=32, per_host=8, timeout=30.0, slow=2.0):
+        self.logger = logger
+        self.concurrency = concurrency
+        self.per_host = per_host
+        self.timeout = timeout
+        self.slow = slow
+        self.results = {}
+        self.walked = set()
+        self.hosts = {}
+        self.documents = 0
+        self.session = None
+        self.semaphore = None
+
+    def host_entry(self, url):
+        host = urlparse(url).netloc if is_remote(url) else "local"
+        return self.hosts.setdefault(host, {'links': 0, 'broken': 0, 'elapsed': 0.0, 'error': None})
+
+    async def request(self, url, get=False):
+        """
+        Status and Content-Type of a url, with the body if get is set
+        """
+        async with self.semaphore:
+            start = time.monotonic()
+            if get:
+                async with self.session.get(url) as response:
+                    body = await response.read()
+                    return response.status, response.headers.get("Content-Type"), time.monotonic() - start, body
+            async with self.session.head(url, allow_redirects=True) as response:
+                status, content_type = response.status, response.headers.get("Content-Type")
+            if status in NO_HEAD:
+                async with self.session.get(url, headers={'Range': "bytes=0-0"}) as response:
+                    status, content_type = response.status, response.headers.get("Content-Type")
+
+            return status, content_type, time.monotonic() - start, None
+
+    async def fetch(self, url, get=False):
+        result = {'url': url, 'status': None, 'content_type': None, 'elapsed': 0.0, 'error': None}
+        body = None
+        host = self.host_entry(url)
+        if not is_remote(url):
+            if os.path.exists(url):
+                result['status'] = 200
+                if get:
+                    with open(url, "rb") as f:
+                        body = f.read()
+                        f.close()
+            else:
+                result['error'] = "not found"
+        elif host['error']:
+            result['error'] = "host unreachable: {}".format(host['error'])
+        else:
+            try:
+                result['status'], result['content_type'], result['elapsed'], body = await self.request(url, get=get)
+                result['elapsed'] = round(result['elapsed'], 3)
+            except aiohttp.ClientConnectorError as e:
+                host['error'] = str(e)
+                result['error'] = str(e)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                result['error'] = str(e) or type(e).__name__
+
+        result['broken'] = result['error'] is not None or result['status'] >= 400
+        host['links'] += 1
+        host['broken'] += 1 if result['broken'] else 0
+        host['elapsed'] += result['elapsed']
+
+        return result, body
+
+    def check(self, url, get=False):
+        """
+        Result of a url, shared by every link to it, and the body of the first request if get is set
+        """
+        if url not in self.results:
+            self.results[url] = asyncio.ensure_future(self.fetch(url, get=get))
+
+        return self.results[url]
+
+    async def check_link(self, doc_url, location, link, url):
+        result, body = await self.check(url)
+        return self.link_result(doc_url, location, link, result)
+
+    def link_result(self, doc_url, location, link, result):
+        expected = base_type(link.get('type'))
+        actual = base_type(result['content_type'])
+        return dict(result, document=doc_url, location=location, rel=link.get('rel'), type=link.get('type'),
+                    slow=result['elapsed'] > self.slow,
+                    mismatch=bool(expected and actual and not compatible_types(expected, actual)
+                                  and not result['broken']))
+
+    async def walk(self, url, doc=None):
+        """
+        Checks the links of a document and walks the documents its child and item links lead to
+
+        :return: list of link results
+        """
+        self.walked.add(url)
+        if doc is None:
+            result, body = await self.check(url, get=True)
+            if result['broken'] or body is None:
+                return [dict(result, document=None, location=None, rel="root", type=None, slow=False, mismatch=False)]
+            try:
+                doc = json.loads(body)
+            except ValueError as e:
+                return [dict(result, document=None, location=None, rel="root", type=None, slow=False, mismatch=False,
+                             broken=True, error="not JSON: {}".format(e))]
+        self.documents += 1
+        if self.documents % 100 == 0:
+            self.logger.info("Checked {} documents, {} urls".format(self.documents, len(self.results)))
+
+        tasks = []
+        for location, link in find_links(doc):
+            target = resolve(url, link['href'])
+            if link.get('rel') in FOLLOW_RELS and target.split("?")[0].endswith(".json"):
+                tasks.append(self.follow(url, location, link, target))
+            else:
+                tasks.append(self.check_link(url, location, link, target))
+
+        results = []
+        for found in await asyncio.gather(*tasks):
+            results += found if isinstance(found, list) else [found]
+
+        return results
+
+    async def follow(self, doc_url, location, link, url):
+        # Fetched with GET, the request both checks the link and reads the linked document
+        seen = url in self.walked
+        self.walked.add(url)
+        result, body = await self.check(url, get=True)
+        if not seen and body is None and not result['broken']:
+            # Only checked with HEAD so far, by a link that is not followed
+            result, body = await self.fetch(url, get=True)
+        results = [self.link_result(doc_url, location, link, result)]
+        if seen or result['broken'] or body is None:
+            return results
+        try:
+            results += await self.walk(url, json.loads(body))
+        except ValueError as e:
+            results[0].update(broken=True, error="not JSON: {}".format(e))
+
+        return results
+
+    async def run(self, url):
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        connector = aiohttp.TCPConnector(limit=self.concurrency, limit_per_host=self.per_host)
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            self.session = session
+            results = await self.walk(url)
+        self.session = None
+
+        return results
+
+    def report(self, results):
+        """
+        Broken, slow and Content-Type mismatched links plus per host totals
+        """
+        hosts = {host: dict(entry, mean_elapsed=round(entry['elapsed'] / entry['links'], 3) if entry['links'] else 0.0,
+                            elapsed=round(entry['elapsed'], 3))
+                 for host, entry in self.hosts.items()}
+        return {'documents': self.documents,
+                'links': len(results),
+                'urls': len(self.results),
+                'broken': [result for result in results if result['broken']],
+                'slow': [result for result in results if result['slow'] and not result['broken']],
+                'mismatched': [result for result in results if result['mismatch']],
+                'hosts': hosts}
+
+
+def check_catalog(logger, catalog, concurrency=32, per_host=8, timeout=30.0, slow=2.0):
+    """
+    Checks every link reachable from a catalog.json given as a local path or url
+
+    :return: report dictionary
+    """
+    if not is_remote(catalog):
+        catalog = os.path.abspath(catalog)
+        if os.path.isdir(catalog):
+            catalog = os.path.join(catalog, "catalog.json")
+    checker = LinkChecker(logger, concurrency=concurrency, per_host=per_host, timeout=timeout, slow=slow)
+    results = asyncio.run(checker.run(catalog))
+
+    return checker.report(results)
+
+
+def main():
+    parser = ArgumentParser(
+        description="Checks that every link and asset in a published catalog resolves",
+        epilog="Should be run in the 'ogcapi' environment",
+    )
+    parser.add_argument(
+        "-c",
+        "--catalog",
+        type=str,
+        dest="catalog",
+        help="Catalog folder, catalog.json path or url",
+    )
+    parser.add_argument(
+        "-n",
+        "--concurrency",
+        type=int,
+        dest="concurrency",
+        help="Maximum number of requests in progress",
+        default=32,
+    )
+    parser.add_argument(
+        "--per-host",
+        type=int,
+        dest="per_host",
+        help="Maximum number of connections to each host",
+        default=8,
+    )
+    parser.add_argument(
+        "-t",
+        "--timeout",
+        type=float,
+        dest="timeout",
+        help="Seconds before a request is counted as broken",
+        default=30.0,
+    )
+    parser.add_argument(
+        "-s",
+        "--slow",
+        type=float,
+        dest="slow",
+        help="Seconds above which a link is reported as slow",
+        default=2.0,
+    )
+    parser.add_argument(
+        "-r",
+        "--report",
+        type=str,
+        dest="report",
+        help="Write the full report to this JSON file",
+        default=None,
+    )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        help="Add extra information to logs.",
+        action="store_true",
+        default=False,
+    )
+
+    # define arguments
+    args = parser.parse_args()
+
+    # Start logging
+    code_dir, program = os.path.split(__file__)
+    logger = logging.getLogger(program)
+    logger.setLevel(logging.DEBUG if "verbose" in args and args.verbose else logging.INFO)
+
+    report = check_catalog(logger, args.catalog, concurrency=args.concurrency, per_host=args.per_host,
+                           timeout=args.timeout, slow=args.slow)
+    for result in report['broken']:
+        logger.warning("Broken {} in {} at {}: {}".format(result['url'], result['document'], result['location'],
+                                                          result['error'] or result['status']))
+    for result in report['mismatched']:
+        logger.warning("{} is {} but linked as {}".format(result['url'], result['content_type'], result['type']))
+    logger.info("Checked {} links to {} urls in {} documents: {} broken, {} slow, {} mismatched".format(
+        report['links'], report['urls'], report['documents'], len(report['broken']), len(report['slow']),
+        len(report['mismatched'])))
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(report, f, indent=4)
+            f.close()
+
+    if report['broken']:
+        sys.exit(1)
+
+    logger.info("Processing completed successfully for {}".format(args.catalog))
+
+
+if __name__ == "__main__":
+    exit(main())
@@ -0,0 +1,409 @@
+import os
+import re
+import sys
+from argparse import ArgumentParser
+import json
+import logging
+import statistics
+
+# Allow the repository packages to be imported when run as a script
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from build_catalog.bulk_export import catalog_documents
+
+# Field that holds the denormalised copies used for filtering
+SEARCH_FIELD = "search"
+# Numbers of shards and replicas of the generated index
+INDEX_SHARDS = 1
+INDEX_REPLICAS = 0
+# Fields kept in _source for the clients but neither parsed nor indexed, at any depth, such as the
+# asset hrefs, band histograms and class lists, which are only needed once a document is found
+DISABLED_FIELDS = ["assets", "links", "contacts", "themes", "externalIds", "raster:bands",
+                   "classification:classes"]
+# Identifiers are always exact values, even when they look like dates or numbers
+KEYWORD_FIELDS = ["id"]
+# Free text fields, any other string is mapped as a keyword
+TEXT_FIELDS = ["title", "description"]
+# ISO 8601 dates and datetimes, as written by pystac and pygeometa
+DATE_VALUE = re.compile(r"^\d{4}-\d{2}-\d{2}([T ]\d{2}:\d{2}(:\d{2}(\.\d+)?)?(Z|[+-]\d{2}:?\d{2})?)?$")
+
+
+def catalog_format(catalog):
+    """
+    Document format of a catalog folder, from its name as written by create_catalog.py
+    """
+    return "records" if "-records" in os.path.basename(catalog.rstrip("/")) else "stac"
+
+
+def keyword_text(field_type="text"):
+    # Full text search plus exact match and sorting on the raw value
+    return {'type': field_type, 'fields': {'raw': {'type': 'keyword', 'ignore_above': 256}}}
+
+
+def disabled():
+    # Kept in _source for the clients but neither parsed nor indexed
+    return {'type': 'object', 'enabled': False}
+
+
+def search_properties():
+    return {'bbox': {'type': 'geo_shape'},
+            'datetime': {'type': 'date'},
+            'start_datetime': {'type': 'date'},
+            'end_datetime': {'type': 'date'},
+            'epsg': {'type': 'integer'},
+            'gsd': {'type': 'float'}}
+
+
+def value_type(value):
+    if isinstance(value, bool):
+        return 'boolean'
+    if isinstance(value, int):
+        return 'long'
+    if isinstance(value, float):
+        return 'double'
+    if isinstance(value, str):
+        return 'date' if DATE_VALUE.match(value) else 'keyword'
+
+    return None
+
+
+def merge_type(current, found):
+    # Fields that hold different types in different documents fall back to a keyword
+    if current is None or current == found:
+        return found
+    if {current, found} == {'long', 'double'}:
+        return 'double'
+
+    return 'keyword'
+
+
+def add_fields(fields, doc):
+    """
+    Adds the fields of a document to a tree of inferred field types, lists are mapped by the type of
+    their elements as Elasticsearch does
+    """
+    for key, value in doc.items():
+        entry = fields.setdefault(key, {})
+        if key in DISABLED_FIELDS:
+            entry['disabled'] = True
+            continue
+        if key == "geometry":
+            entry['type'] = 'geo_shape'
+            continue
+        if key in KEYWORD_FIELDS:
+            entry['type'] = 'keyword'
+            continue
+        values = list(value) if isinstance(value, list) else [value]
+        while values:
+            item = values.pop()
+            if isinstance(item, list):
+                values += item
+            elif isinstance(item, dict):
+                if item and all(name.isdigit() for name in item):
+                    # One entry per class value, mapped by the dynamic templates
+                    entry['dynamic'] = True
+                else:
+                    add_fields(entry.setdefault('fields', {}), item)
+            elif item is not None:
+                entry['type'] = merge_type(entry.get('type'), value_type(item))
+
+
+def field_mapping(name, entry):
+    if entry.get('disabled') or ('type' in entry and ('fields' in entry or entry.get('dynamic'))):
+        # Disabled, or an object in some documents and a value in others
+        return disabled()
+    if entry.get('dynamic'):
+        return {'type': 'object', 'dynamic': True}
+    if 'fields' in entry:
+        return {'properties': fields_mapping(entry['fields'])}
+    if name in TEXT_FIELDS and entry['type'] == 'keyword':
+        return keyword_text() if name == "title" else {'type': 'text'}
+
+    return {'type': entry['type']}
+
+
+def fields_mapping(fields):
+    # Fields only ever null are left out
+    return {name: field_mapping(name, entry) for name, entry in sorted(fields.items())
+            if set(entry) - {'fields'} or entry.get('fields')}
+
+
+def document_properties(documents):
+    """
+    Mapped fields of the items or records of a catalog, inferred from every document so the mapping
+    follows the fields that add_item(), add_statistics() and write_records() actually write
+
+    :param documents: iterable of documents, or of (document, document id) from catalog_documents()
+    """
+    fields = {}
+    for doc in documents:
+        add_fields(fields, doc[0] if isinstance(doc, tuple) else doc)
+
+    return fields_mapping(fields)
+
+
+def generate_mapping(documents):
+    """
+    Explicit index settings and mapping for the items or records of a catalog
+
+    Only the fields found in the documents are indexed, any field added later stays in _source
+    without growing the mapping, and the bbox, datetimes, EPSG code and GSD are also mapped as flat
+    search fields, which denormalise() adds to each document
+
+    :param documents: items or records of a catalog, e.g. from catalog_documents()
+    """
+    properties = document_properties(documents)
+    properties[SEARCH_FIELD] = {'properties': search_properties()}
+
+    return {'settings': {'number_of_shards': INDEX_SHARDS, 'number_of_replicas': INDEX_REPLICAS},
+            'mappings': {'dynamic': False,
+                         'dynamic_templates': [
+                             {'class_counts': {'path_match': "*class_counts.*", 'mapping': {'type': 'long'}}},
+                             {'class_areas': {'path_match': "*class_area_m2.*", 'mapping': {'type': 'double'}}}],
+                         'properties': properties}}
+
+
+def geometry_bbox(geometry):
+    coords = []
+    stack = [geometry.get('coordinates', [])] if geometry else []
+    while stack:
+        value = stack.pop()
+        if value and isinstance(value[0], (int, float)):
+            coords.append(value)
+        else:
+            stack += list(value)
+    if not coords:
+        return None
+
+    return [min(c[0] for c in coords), min(c[1] for c in coords), max(c[0] for c in coords), max(c[1] for c in coords)]
+
+
+def envelope(bbox):
+    # Elasticsearch envelopes are [[minx, maxy], [maxx, miny]]
+    return {'type': 'envelope', 'coordinates': [[bbox[0], bbox[3]], [bbox[2], bbox[1]]]}
+
+
+def open_value(value):
+    # Open ended record intervals are written as '..' or None
+    return None if value in [None, "..", ""] else value
+
+
+def denormalise(doc):
+    """
+    Copy of a STAC item or record with the search fields of generate_mapping() added
+    """
+    props = doc.get('properties') or {}
+    bbox = doc.get('bbox') or geometry_bbox(doc.get('geometry'))
+    search = {}
+    if bbox:
+        search['bbox'] = envelope([bbox[0], bbox[1], bbox[3], bbox[4]] if len(bbox) == 6 else bbox)
+
+    if 'time' in doc:
+        # Records time is an interval list or an object with an interval
+        interval = doc['time'].get('interval', []) if isinstance(doc['time'], dict) else doc['time'] or []
+        if isinstance(interval, str):
+            interval = [interval]
+        start = open_value(interval[0]) if interval else None
+        end = open_value(interval[-1]) if interval else None
+    else:
+        start = props.get('start_datetime') or props.get('datetime')
+        end = props.get('end_datetime') or props.get('datetime')
+    if start:
+        search['start_datetime'] = start
+        search['datetime'] = props.get('datetime') or start
+    if end:
+        search['end_datetime'] = end
+
+    if props.get('proj:epsg') is not None:
+        search['epsg'] = int(props['proj:epsg'])
+    if props.get('gsd') is not None:
+        search['gsd'] = float(props['gsd'])
+
+    return dict(doc, **{SEARCH_FIELD: search})
+
+
+def count_fields(properties):
+    """
+    Number of mapped leaf fields in the properties of a mapping
+    """
+    count = 0
+    for field in properties.values():
+        count += count_fields(field['properties']) if 'properties' in field else 1
+        count += len(field.get('fields', {}))
+
+    return count
+
+
+def filter_query(bbox, start, end, epsg=None, generated=False, fmt="stac"):
+    """
+    Spatial and temporal filter, on the search fields for the generated mapping
+
+    Records are only filtered spatially, as the record time is not a date field in the current mapping
+    """
+    if generated:
+        shape_field, start_field, end_field = "search.bbox", "search.start_datetime", "search.end_datetime"
+    else:
+        shape_field, start_field, end_field = "geometry", "properties.datetime", "properties.datetime"
+    filters = [{'geo_shape': {shape_field: {'shape': envelope(bbox), 'relation': 'intersects'}}}]
+    if fmt != "records" and start and end:
+        filters += [{'range': {start_field: {'lte': end}}},
+                    {'range': {end_field: {'gte': start}}}]
+    if epsg is not None and fmt != "records":
+        filters.append({'term': {"search.epsg" if generated else "properties.proj:epsg": epsg}})
+
+    return {'query': {'bool': {'filter': filters}}}
+
+
+def load_index(es, file_index, mapping, documents, prepare=None):
+    """
+    Creates an index with a mapping and bulk loads the documents into it, merged to one segment
+    """
+    from elasticsearch.helpers import bulk
+
+    es.indices.delete(index=file_index, ignore=[400, 404])
+    es.indices.create(index=file_index, body=mapping)
+    actions = ({'_op_type': 'index', '_index': file_index, '_id': doc_id,
+                '_source': prepare(doc) if prepare else doc} for doc, doc_id in documents)
+    count, errors = bulk(es, actions, raise_on_error=False)
+    es.indices.refresh(index=file_index)
+    es.indices.forcemerge(index=file_index, max_num_segments=1)
+
+    return count
+
+
+def index_summary(es, file_index, query, repeats):
+    mapping = es.indices.get_mapping(index=file_index)[file_index]['mappings']
+    store = es.indices.stats(index=file_index)['indices'][file_index]['total']['store']['size_in_bytes']
+    took = []
+    hits = 0
+    for repeat in range(repeats):
+        response = es.search(index=file_index, body=query, request_cache=False)
+        took.append(response['took'])
+        hits = response['hits']['total']['value']
+
+    return {'index': file_index,
+            'mapped_fields': count_fields(mapping.get('properties', {})),
+            'mapping_bytes': len(json.dumps(mapping)),
+            'store_bytes': store,
+            'hits': hits,
+            'median_took_ms': statistics.median(took),
+            'max_took_ms': max(took)}
+
+
+def compare_mappings(logger, es, cat_folder, current, fmt="stac", repeats=20):
+    """
+    Loads a catalog into one index with the current mapping and one with the generated mapping,
+    and compares their mapping and store sizes and the time taken by the same filter query
+
+    :param current: current index settings and mapping, e.g. index_settings_file.json
+    :return: summaries of the current and generated indices
+    """
+    documents = list(catalog_documents(cat_folder))
+    if not documents:
+        logger.error("No items or records found in {}".format(cat_folder))
+        return []
+
+    # Query the extent and time range of the first document
+    first = denormalise(documents[0][0])[SEARCH_FIELD]
+    coords = first['bbox']['coordinates']
+    bbox = [coords[0][0], coords[1][1], coords[1][0], coords[0][1]]
+    start, end = first.get('start_datetime'), first.get('end_datetime')
+    epsg = first.get('epsg')
+
+    summaries = []
+    for name, mapping, generated in [("current", current, False), ("generated", generate_mapping(documents), True)]:
+        file_index = "mapping-compare-{}".format(name)
+        count = load_index(es, file_index, mapping, documents, prepare=denormalise if generated else None)
+        summary = index_summary(es, file_index, filter_query(bbox, start, end, epsg=epsg, generated=generated,
+                                                             fmt=fmt), repeats)
+        summary.update(mapping=name, documents=count)
+        logger.info("{} mapping: {} fields, {} byte mapping, {} byte store, median query {} ms for {} hits".format(
+            name, summary['mapped_fields'], summary['mapping_bytes'], summary['store_bytes'],
+            summary['median_took_ms'], summary['hits']))
+        es.indices.delete(index=file_index, ignore=[400, 404])
+        summaries.append(summary)
+
+    return summaries
+
+
+def main():
+    parser = ArgumentParser(
+        description="Generates an explicit Elasticsearch mapping for the catalog items or records",
+        epilog="Should be run in the 'ogcapi' environment",
+    )
+    parser.add_argument(
+        "-f",
+        "--format",
+        type=str,
+        dest="format",
+        choices=["stac", "records"],
+        help="Document format, by default taken from the catalog folder name",
+        default=None,
+    )
+    parser.add_argument(
+        "-o",
+        "--outfile",
+        type=str,
+        dest="outfile",
+        help="Write the generated settings and mapping to this JSON file",
+        default=None,
+    )
+    parser.add_argument(
+        "-c",
+        "--catalog",
+        type=str,
+        dest="catalog",
+        help="Local catalog folder whose items or records the mapping is generated from and loaded when comparing",
+        default=None,
+    )
+    parser.add_argument(
+        "--compare",
+        help="Compare index size and query time against index_settings_file.json, using es_upload_conf.yaml",
+        action="store_true",
+        default=False,
+    )
+    parser.add_argument(
+        "--repeats",
+        type=int,
+        dest="repeats",
+        help="Number of times the comparison query is run on each index",
+        default=20,
+    )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        help="Add extra information to logs.",
+        action="store_true",
+        default=False,
+    )
+
+    # define arguments
+    args = parser.parse_args()
+
+    # Start logging
+    code_dir, program = os.path.split(__file__)
+    logger = logging.getLogger(program)
+    logger.setLevel(logging.DEBUG if "verbose" in args and args.verbose else logging.INFO)
+
+    if not args.catalog:
+        parser.error("the mapping is generated from the documents of a --catalog folder")
+    fmt = args.format or catalog_format(args.catalog)
+    mapping = generate_mapping(catalog_documents(args.catalog))
+    logger.info("Generated {} mapping with {} fields".format(fmt, count_fields(mapping['mappings']['properties'])))
+    if args.outfile:
+        with open(args.outfile, "w") as f:
+            json.dump(mapping, f, indent=2)
+            f.close()
+        logger.info("Mapping written to {}".format(args.outfile))
+
+    if args.compare:
+        from deploy_catalog.upload_esearch import iam_connect
+        with open(os.path.join(code_dir, "index_settings_file.json"), "r") as f:
+            current = json.load(f)
+            f.close()
+        compare_mappings(logger, iam_connect(), args.catalog, current, fmt=fmt, repeats=args.repeats)
+
+    logger.info("Processing completed successfully for {}".format(fmt))
+
+
+if __name__ == "__main__":
+    exit(main())
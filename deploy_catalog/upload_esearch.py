@@ -1,10 +1,13 @@
 import os
 import sys
+import gzip
+import io
 import boto3
 # pip install elasticsearch==7.13.4
 # More recent versions elasticsearch python library do not support AWS
 # see https://www.theregister.com/2021/08/09/elasticsearch_python_client_change/
 from elasticsearch import Elasticsearch, RequestsHttpConnection
+from elasticsearch.helpers import parallel_bulk
 # pip install requests-aws4auth
 from requests_aws4auth import AWS4Auth
 import click
@@ -13,6 +16,12 @@ from elasticsearch_loader.parsers import json
 import yaml
 import logging
 
+# Allow the repository packages to be imported when run as a script
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from build_catalog.bulk_export import index_name, read_bulk
+from build_catalog.compact_output import decompress
+from deploy_catalog.es_mapping import denormalise
+
 home = os.path.expanduser("~")
 code_dir, program = os.path.split(__file__)
 CONFIGURATION_FILE_PATH = os.path.join(code_dir, "es_upload_conf.yaml")
@@ -27,13 +36,7 @@ try:
         my_service = config["my_service"]
         my_eshost = config["my_eshost"]
         catalog = config["catalog"]
-        splits = catalog.split("-")
-        if splits[4] == "single":
-            index = "{}-index-nc-single".format(splits[2])
-        elif splits[3] == "nc":
-            index = "{}-index-nc".format(splits[2])
-        else:
-            index = "{}-index".format(splits[2])
+        index = index_name(catalog)
         print("Linking to Elasticsearch index: {}".format(index))
         # S3 bucket
         bucket = config["bucket"]
@@ -93,22 +96,22 @@ def master_connect():
 
 def s3_iterator(s3bucket, folder):
     for file in s3bucket.objects.all():
-        if folder in file.key and "catalog.json" not in file.key:
-            content = json.load(file.get()['Body'])
+        # Only the JSON documents, not the .json.gz/.json.br variants written by --compact
+        if folder in file.key and file.key.endswith(".json") and "catalog.json" not in file.key:
+            # Published catalogs are stored compressed, boto3 does not decode Content-Encoding
+            obj = file.get()
+            content = json.load(io.BytesIO(decompress(obj['Body'].read(), obj.get('ContentEncoding'))))
             print("Uploading {} from {}".format(content, file.key))
             yield content
 
 
-def load_s3(ctx, file_index, s3bucket, folder):
-    # Access bucket
-    session = boto3.session.Session(profile_name=iam_name)
-    s3 = session.resource('s3')
-    bucket_obj = s3.Bucket(s3bucket)
-
-    # Create index and upload mapping to index file
-    map_file = open(os.path.join(code_dir, "index_settings_file.json"), 'rb')
-    response = ctx.obj['es_conn'].indices.create(index=file_index, body=json.load(map_file))
-    map_file.close()
+def create_index(es, file_index, mapping=None):
+    # Create index and upload mapping to index file, or the generated mapping if given
+    if mapping is None:
+        map_file = open(os.path.join(code_dir, "index_settings_file.json"), 'rb')
+        mapping = json.load(map_file)
+        map_file.close()
+    response = es.indices.create(index=file_index, body=mapping)
     if 'acknowledged' in response:
         if response['acknowledged'] is True:
             print("Index mapping success for: {}".format(response['index']))
@@ -116,6 +119,73 @@ def load_s3(ctx, file_index, s3bucket, folder):
     elif 'error' in response:
         print("ERROR:", response['error']['root_cause'])
         print("TYPE:", response['error']['type'])
+        return False
+
+    return True
+
+
+def open_bulk(bulk_file, s3bucket):
+    # Stream a gzipped bulk file from local disk, or from the S3 bucket if not found locally
+    if os.path.exists(bulk_file):
+        return gzip.open(bulk_file, "rt", encoding="utf-8")
+
+    session = boto3.session.Session(profile_name=iam_name)
+    body = session.client('s3').get_object(Bucket=s3bucket, Key=bulk_file)['Body']
+    return io.TextIOWrapper(gzip.GzipFile(fileobj=body), encoding="utf-8")
+
+
+def prepare_doc(ctx, doc):
+    # Search fields are only added for the generated mapping that indexes them
+    return denormalise(doc) if ctx.obj.get('mapping') else doc
+
+
+def bulk_actions(ctx, bulk_files, s3bucket, file_index):
+    for bulk_file in bulk_files:
+        infile = open_bulk(bulk_file, s3bucket)
+        for action, doc in read_bulk(infile):
+            yield {'_op_type': 'index', '_index': file_index, '_id': action['index']['_id'],
+                   '_source': prepare_doc(ctx, doc)}
+        infile.close()
+
+
+def load_bulk(ctx, file_index, s3bucket, bulk_files):
+    # Create index and upload mapping to index file
+    if not create_index(ctx.obj['es_conn'], file_index, mapping=ctx.obj.get('mapping')):
+        return
+
+    # Stream the bulk files to the bulk API, with requests sent by several threads
+    count = 0
+    failed = 0
+    for success, info in parallel_bulk(ctx.obj['es_conn'], bulk_actions(ctx, bulk_files, s3bucket, file_index),
+                                       thread_count=ctx.obj['threads'], chunk_size=ctx.obj['bulk_size'],
+                                       raise_on_error=False):
+        count += 1
+        if not success:
+            failed += 1
+            print("Failed to upload: {}".format(info))
+    if count == 0:
+        print("No documents found in {}".format(", ".join(bulk_files)))
+    else:
+        print("Completed uploading {} documents, {} failed".format(count, failed))
+
+
+def index_item(es, file_index, doc, mapping=None):
+    # Index one document, creating the index with the mapping on first use
+    if not es.indices.exists(index=file_index) and not create_index(es, file_index, mapping=mapping):
+        return None
+    response = es.index(index=file_index, id=doc['id'], body=denormalise(doc) if mapping else doc)
+
+    return response['result']
+
+
+def load_s3(ctx, file_index, s3bucket, folder):
+    # Access bucket
+    session = boto3.session.Session(profile_name=iam_name)
+    s3 = session.resource('s3')
+    bucket_obj = s3.Bucket(s3bucket)
+
+    # Create index and upload mapping to index file
+    if not create_index(ctx.obj['es_conn'], file_index, mapping=ctx.obj.get('mapping')):
         return
 
     # Load data from S3 bucket to Elasticsearch
@@ -123,9 +193,10 @@ def load_s3(ctx, file_index, s3bucket, folder):
     count = 0
     for file in bucket_obj.objects.all():
         # print("File: {}".format(file.key))
-        if folder in file.key and "catalog.json" not in file.key:
-            content = json.load(file.get()['Body'])
-            response = ctx.obj['es_conn'].index(index=file_index, id=count, body=content)
+        if folder in file.key and file.key.endswith(".json") and "catalog.json" not in file.key:
+            obj = file.get()
+            content = json.load(io.BytesIO(decompress(obj['Body'].read(), obj.get('ContentEncoding'))))
+            response = ctx.obj['es_conn'].index(index=file_index, id=count, body=prepare_doc(ctx, content))
             print("Uploading {} from {}: {}".format(content, file.key, response['result']))
 
             count += 1
@@ -145,6 +216,10 @@ def load_s3(ctx, file_index, s3bucket, folder):
 @click.option('--with-retry', default=False, is_flag=True, help='Retry if ES bulk insertion failed')
 @click.option('--diagnose', default=False, is_flag=True, help='Run diagnosis as master user')
 @click.option('--upload', default=False, is_flag=True, help='Upload as master user')
+@click.option('--bulk-file', multiple=True, help='Upload from a gzipped NDJSON bulk file (local or S3 key), can be repeated')
+@click.option('--threads', default=4, help='Number of parallel bulk requests when uploading bulk files')
+@click.option('--generated-mapping', default=None, type=click.Path(exists=True),
+              help='Create the index with this mapping written by es_mapping.py rather than index_settings_file.json')
 @click.option('--verbose', default=False, is_flag=True, help='Add extra information to logs')
 @click.pass_context
 def main(ctx, **opts):
@@ -173,12 +248,20 @@ def main(ctx, **opts):
         ctx.obj['index'] = index
         ctx.obj['type'] = 'json'
         ctx.obj['es_conn'] = iam_connect()
+        ctx.obj['mapping'] = None
+        if opts['generated_mapping']:
+            with open(opts['generated_mapping'], "r") as f:
+                ctx.obj['mapping'] = json.load(f)
+                f.close()
 
         # Delete index before uploading
         ctx.obj['es_conn'].indices.delete(index=index, ignore=[400, 404])
 
         # Upload data to elasticsearch
-        load_s3(ctx, index, bucket, folder=catalog)
+        if opts['bulk_file']:
+            load_bulk(ctx, index, bucket, opts['bulk_file'])
+        else:
+            load_s3(ctx, index, bucket, folder=catalog)
 
     else:
         # Query test-index
@@ -0,0 +1,12 @@
+# =================================================================
+#
+# Terms and Conditions of Use
+#
+# Unless otherwise noted, computer program source code of this
+# distribution is distributed under the MIT License.
+#
+# Copyright (c) 2021 Pixalytics Ltd
+#
+# =================================================================
+
+__version__ = '0-1'
\ No newline at end of file
@@ -0,0 +1,234 @@
+import os
+import sys
+from argparse import ArgumentParser
+import json
+import logging
+
+# Allow the repository packages to be imported when run as a script
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from pipeline.stages import QUEUE_SIZE
+from build_catalog.create_catalog import PARTITION_LEVELS, GRID_SIZE
+from build_catalog.discovery import discover
+from pipeline.tasks import CatalogTasks, catalog_pipeline
+
+
+def main():
+    parser = ArgumentParser(
+        description="Converts, catalogues and indexes a batch of GeoTIFFs as overlapping pipeline stages",
+        epilog="Should be run in the 'ogcapi' environment",
+    )
+    parser.add_argument(
+        "-i",
+        "--indir",
+        type=str,
+        dest="indir",
+        help="Input data folder",
+    )
+    parser.add_argument(
+        "-o",
+        "--outdir",
+        type=str,
+        dest="outdir",
+        help="Output folder for the converted files",
+    )
+    parser.add_argument(
+        "-c",
+        "--config",
+        type=str,
+        dest="config",
+        help="Catalog configuration, the converted files are added to its files list",
+        default=None,
+    )
+    parser.add_argument(
+        "-f",
+        "--format",
+        type=str,
+        dest="format",
+        choices=["cog", "netcdf"],
+        help="Output format of the conversion",
+        default="cog",
+    )
+    parser.add_argument(
+        "--catalog",
+        type=str,
+        dest="catalog",
+        help="STAC catalog folder to add items to, by default the versioned folder in the configured output_dir",
+        default=None,
+    )
+    parser.add_argument(
+        "--pattern",
+        type=str,
+        dest="pattern",
+        help="Glob pattern of the input files",
+        default="*_classification.tif",
+    )
+    parser.add_argument(
+        "--regex",
+        type=str,
+        dest="regex",
+        help="Only process the input files whose path in the input folder matches this regular expression",
+        default=None,
+    )
+    parser.add_argument(
+        "--recursive",
+        help="Also find input files in the sub-folders of the input folder",
+        action="store_true",
+        default=False,
+    )
+    parser.add_argument(
+        "-u",
+        "--upload",
+        help="Upload the converted files to the S3 folder of the configured url",
+        action="store_true",
+        default=False,
+    )
+    parser.add_argument(
+        "-I",
+        "--index",
+        help="Index each item in Elasticsearch, using deploy_catalog/es_upload_conf.yaml",
+        action="store_true",
+        default=False,
+    )
+    parser.add_argument(
+        "-p",
+        "--previews",
+        type=str.upper,
+        dest="previews",
+        choices=["PNG", "WEBP"],
+        help="Create thumbnail and overview images and add them to the items",
+        default=None,
+    )
+    parser.add_argument(
+        "-st",
+        "--stats",
+        help="Add per-class pixel counts, areas and valid-data fraction to each item",
+        action="store_true",
+        default=False,
+    )
+    parser.add_argument(
+        "-e",
+        "--exact-footprint",
+        dest="exact_footprint",
+        help="Use the valid-data polygon of each file as its footprint",
+        action="store_true",
+        default=False,
+    )
+    parser.add_argument(
+        "-P",
+        "--partition",
+        type=str,
+        dest="partition",
+        help="Add items to sub-catalogs by these comma separated levels: {}".format(",".join(PARTITION_LEVELS)),
+        default=None,
+    )
+    parser.add_argument(
+        "--grid-size",
+        type=int,
+        dest="grid_size",
+        help="Size in degrees of the grid tiles used to partition by grid",
+        default=GRID_SIZE,
+    )
+    parser.add_argument(
+        "--convert-workers",
+        type=int,
+        dest="convert_workers",
+        help="Number of files converted (and uploaded) at the same time",
+        default=2,
+    )
+    parser.add_argument(
+        "--describe-workers",
+        type=int,
+        dest="describe_workers",
+        help="Number of files whose metadata is read at the same time",
+        default=4,
+    )
+    parser.add_argument(
+        "--index-workers",
+        type=int,
+        dest="index_workers",
+        help="Number of concurrent Elasticsearch index requests",
+        default=2,
+    )
+    parser.add_argument(
+        "--queue-size",
+        type=int,
+        dest="queue_size",
+        help="Number of files that can wait between stages before the previous stage is held up",
+        default=QUEUE_SIZE,
+    )
+    parser.add_argument(
+        "--report",
+        type=float,
+        dest="report",
+        help="Seconds between progress reports",
+        default=30.0,
+    )
+    parser.add_argument(
+        "-m",
+        "--metrics",
+        type=str,
+        dest="metrics",
+        help="Write the per-stage metrics to this JSON file",
+        default=None,
+    )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        help="Add extra information to logs.",
+        action="store_true",
+        default=False,
+    )
+
+    # define arguments
+    args = parser.parse_args()
+
+    # Start logging
+    code_dir, program = os.path.split(__file__)
+    logger = logging.getLogger(program)
+    logger.setLevel(logging.DEBUG if "verbose" in args and args.verbose else logging.INFO)
+
+    levels = [level.strip() for level in args.partition.split(",")] if args.partition else None
+    if levels and any(level not in PARTITION_LEVELS for level in levels):
+        parser.error("Partition levels should be from {}".format(",".join(PARTITION_LEVELS)))
+
+    # Configuration matching the output format
+    if args.config:
+        config_path = args.config
+    elif args.format == "netcdf":
+        config_path = os.path.join(os.path.dirname(code_dir), "build_catalog", "configuration-nc.yaml")
+    else:
+        config_path = os.path.join(os.path.dirname(code_dir), "build_catalog", "configuration.yaml")
+
+    tasks = CatalogTasks(logger, config_path, args.outdir, fmt=args.format, cat_folder=args.catalog,
+                         upload=args.upload, index=args.index, previews=args.previews, stats=args.stats,
+                         exact=args.exact_footprint, levels=levels, grid_size=args.grid_size)
+    pipeline = catalog_pipeline(logger, tasks, convert_workers=args.convert_workers,
+                                describe_workers=args.describe_workers, index_workers=args.index_workers,
+                                queue_size=args.queue_size)
+
+    # Files are fed as they are listed and as fast as the convert stage accepts them,
+    # later stages start on the first file
+    logger.info("Processing files in {} into {}".format(args.indir, tasks.cat_folder))
+    pipeline.start(report_interval=args.report)
+    count = 0
+    for name, dateval in discover(logger, args.indir, pattern=args.pattern, regex=args.regex,
+                                  recursive=args.recursive):
+        pipeline.put(os.path.join(args.indir, name))
+        count += 1
+    pipeline.stop()
+    if count == 0:
+        logger.info("Could not find any input files in {}".format(args.indir))
+        sys.exit(1)
+
+    metrics = pipeline.metrics()
+    logger.info("Wall time {}s for {}s of stage work".format(metrics['wall_s'], metrics['busy_s']))
+    if args.metrics:
+        with open(args.metrics, "w") as f:
+            json.dump(metrics, f, indent=4)
+            f.close()
+
+    logger.info("Processing completed successfully for {}".format(args.indir))
+
+
+if __name__ == "__main__":
+    exit(main())
@@ -0,0 +1,155 @@
+import queue
+import threading
+import time
+
+# Items that can wait between two stages, a full queue blocks the stage or watcher feeding it
+QUEUE_SIZE = 16
+
+# Marks the end of the input to a stage
+STOP = object()
+
+
+class Stage:
+    """
+    Pool of worker threads that applies func to each queued item and passes on the result
+
+    The input queue is bounded, so put() blocks when the stage falls behind and the
+    backpressure reaches the stages (or watcher) that feed it. Results that are None,
+    and items for which func raises, are not passed on
+    """
+
+    def __init__(self, logger, name, func, workers=1, queue_size=QUEUE_SIZE):
+        self.logger = logger
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.inbox = queue.Queue(maxsize=queue_size)
+        self.next = None
+        self.threads = []
+        self.lock = threading.Lock()
+        self.processed = 0
+        self.failed = 0
+        self.busy = 0.0
+        self.blocked = 0.0
+        self.first = None
+        self.last = None
+
+    def start(self):
+        for count in range(self.workers):
+            thread = threading.Thread(target=self.run, name="{}-{}".format(self.name, count), daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def put(self, item):
+        self.inbox.put(item)
+
+    def run(self):
+        while True:
+            item = self.inbox.get()
+            if item is STOP:
+                break
+            start = time.perf_counter()
+            try:
+                result = self.func(item)
+            except Exception:
+                self.logger.exception("{} failed for {}".format(self.name, item))
+                with self.lock:
+                    self.failed += 1
+                continue
+            end = time.perf_counter()
+            with self.lock:
+                self.processed += 1
+                self.busy += end - start
+                self.first = start if self.first is None else min(self.first, start)
+                self.last = end if self.last is None else max(self.last, end)
+            if result is not None and self.next is not None:
+                # Time spent waiting on a full queue shows where the bottleneck is
+                self.next.put(result)
+                with self.lock:
+                    self.blocked += time.perf_counter() - end
+
+    def metrics(self):
+        """
+        Counts, mean time per item, throughput and worker utilisation of the stage
+        """
+        with self.lock:
+            elapsed = self.last - self.first if self.first is not None else 0.0
+            return {'workers': self.workers,
+                    'processed': self.processed,
+                    'failed': self.failed,
+                    'queued': self.inbox.qsize(),
+                    'busy_s': round(self.busy, 3),
+                    'blocked_s': round(self.blocked, 3),
+                    'mean_s': round(self.busy / self.processed, 3) if self.processed else None,
+                    'throughput_per_s': round(self.processed / elapsed, 3) if elapsed > 0 else None,
+                    'utilisation': round(self.busy / (self.workers * elapsed), 3) if elapsed > 0 else None}
+
+    def stop(self):
+        # One marker per worker, queued behind the remaining items so they are finished first
+        for thread in self.threads:
+            self.inbox.put(STOP)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+
+class Pipeline:
+    """
+    Stages connected in order by their bounded queues
+    """
+
+    def __init__(self, logger, stages):
+        self.logger = logger
+        self.stages = stages
+        for stage, next_stage in zip(stages[:-1], stages[1:]):
+            stage.next = next_stage
+        self.started = None
+        self.stopped = None
+        self.reporting = threading.Event()
+
+    def start(self, report_interval=None):
+        self.started = time.perf_counter()
+        for stage in self.stages:
+            stage.start()
+        if report_interval:
+            threading.Thread(target=self.report, args=(report_interval,), daemon=True).start()
+
+    def report(self, interval):
+        # Periodic progress while running, until the pipeline is stopped
+        while not self.reporting.wait(interval):
+            self.logger.info("Pipeline progress: {}".format(self.summary()))
+
+    def put(self, item):
+        self.stages[0].put(item)
+
+    def pending(self):
+        return sum(stage.inbox.qsize() for stage in self.stages)
+
+    def stop(self):
+        # Stages are stopped in order, so each one has received all of its input first
+        for stage in self.stages:
+            stage.stop()
+        self.stopped = time.perf_counter()
+        self.reporting.set()
+        self.logger.info("Pipeline stopped: {}".format(self.summary()))
+
+    def metrics(self):
+        """
+        Metrics of each stage, with the wall time and the total time spent in all stages
+
+        When the stages overlap well the wall time approaches that of the slowest stage
+        rather than the total busy time divided by the workers
+        """
+        end = self.stopped if self.stopped is not None else time.perf_counter()
+        stages = {stage.name: stage.metrics() for stage in self.stages}
+        return {'wall_s': round(end - self.started, 3) if self.started is not None else None,
+                'busy_s': round(sum(stage['busy_s'] for stage in stages.values()), 3),
+                'stages': stages}
+
+    def summary(self):
+        parts = []
+        for name, stage in self.metrics()['stages'].items():
+            parts.append("{} {} done {} failed {} queued {}/s".format(
+                name, stage['processed'], stage['failed'], stage['queued'], stage['throughput_per_s'] or 0))
+
+        return ", ".join(parts)
@@ -0,0 +1,123 @@
+import os
+import sys
+import threading
+# pip install boto3
+import boto3
+
+# Allow the repository packages to be imported when run as a script
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from pipeline.stages import Stage, Pipeline, QUEUE_SIZE
+from utils.convert_gtiff import convert_file
+from build_catalog import __version__
+from build_catalog.bulk_export import index_name
+from build_catalog.create_catalog import load_configuration, file_item, append_item, add_config_files, GRID_SIZE
+
+
+class CatalogTasks:
+    """
+    Per-file convert, upload, describe, catalogue and index steps, used as pipeline stage functions
+
+    Each step takes the output of the previous one. Converting, uploading and describing can
+    run in several workers, the catalogue step writes catalog.json and the configuration so
+    must run in a single worker
+    """
+
+    def __init__(self, logger, config_path, outdir, fmt="cog", cat_folder=None, upload=False, index=False,
+                 previews=None, stats=False, exact=False, workers=4, levels=None, grid_size=GRID_SIZE):
+        self.logger = logger
+        self.config_path = config_path
+        self.cfg = load_configuration(logger, config_path)
+        self.outdir = outdir
+        self.fmt = fmt
+        self.upload_outputs = upload
+        self.previews = previews
+        self.stats = stats
+        self.exact = exact
+        self.workers = workers
+        self.levels = levels
+        self.grid_size = grid_size
+        if cat_folder is None:
+            cat_folder = os.path.join(self.cfg['output_dir'], "{}-stac{}-v{}".format(
+                self.cfg['catalog_id'], "-nc" if fmt == "netcdf" else "", __version__))
+        self.cat_folder = cat_folder
+        self.catalog = None
+        if not os.path.exists(outdir):
+            os.makedirs(outdir)
+
+        # Clients are created per thread, as boto3 sessions are not thread safe
+        self.local = threading.local()
+
+        # Elasticsearch connection, upload_esearch reads its configuration when imported
+        self.es = None
+        if index:
+            from deploy_catalog import upload_esearch
+            self.es = upload_esearch.iam_connect()
+            self.index_item = upload_esearch.index_item
+            self.index_name = index_name(self.cat_folder)
+
+    def s3_client(self):
+        if not hasattr(self.local, "s3_client"):
+            session = boto3.Session(profile_name='ogc')
+            self.local.s3_client = session.client('s3')
+
+        return self.local.s3_client
+
+    def convert(self, infile):
+        self.logger.info("Converting {}".format(infile))
+        outfile = convert_file(infile, self.outdir, self.logger, fmt=self.fmt, workers=self.workers,
+                               previews=self.previews)
+
+        return outfile
+
+    def upload(self, outfile):
+        """
+        Copies the converted file and its previews to the bucket folder of the configured url
+        """
+        url = self.cfg['url']
+        bucket = url.split(".s3")[0].split("//")[1]
+        prefix = url.split(".amazonaws.com/")[1]
+        name = os.path.splitext(os.path.basename(outfile))[0]
+        paths = [outfile]
+        if self.previews:
+            paths += [os.path.join(self.outdir, "{}_{}.{}".format(name, key, self.previews.lower()))
+                      for key in ['thumbnail', 'overview']]
+        for path in paths:
+            key = prefix + os.path.basename(path)
+            self.logger.debug("Uploading {} to s3://{}/{}".format(path, bucket, key))
+            self.s3_client().upload_file(path, bucket, key)
+
+        return outfile
+
+    def describe(self, outfile):
+        return file_item(self.logger, self.cfg, os.path.basename(outfile), outfile,
+                         previews=self.previews, stats=self.stats, exact=self.exact)
+
+    def catalogue(self, item):
+        self.catalog = append_item(self.logger, self.cfg, self.cat_folder, item, catalog=self.catalog,
+                                   levels=self.levels, grid_size=self.grid_size)
+        href = item.assets['image'].href
+        add_config_files(self.config_path, [href[len(self.cfg['url']):]])
+
+        return item.to_dict()
+
+    def index(self, doc):
+        result = self.index_item(self.es, self.index_name, doc)
+        self.logger.info("Indexed {} in {}: {}".format(doc['id'], self.index_name, result))
+
+        return doc['id']
+
+
+def catalog_pipeline(logger, tasks, convert_workers=2, describe_workers=4, index_workers=2,
+                     queue_size=QUEUE_SIZE):
+    """
+    Convert, upload, describe, catalogue and index stages for the tasks, connected by bounded queues
+    """
+    stages = [Stage(logger, "convert", tasks.convert, workers=convert_workers, queue_size=queue_size)]
+    if tasks.upload_outputs:
+        stages.append(Stage(logger, "upload", tasks.upload, workers=convert_workers, queue_size=queue_size))
+    stages.append(Stage(logger, "describe", tasks.describe, workers=describe_workers, queue_size=queue_size))
+    stages.append(Stage(logger, "catalogue", tasks.catalogue, workers=1, queue_size=queue_size))
+    if tasks.es is not None:
+        stages.append(Stage(logger, "index", tasks.index, workers=index_workers, queue_size=queue_size))
+
+    return Pipeline(logger, stages)
@@ -0,0 +1,196 @@
+import os
+import sys
+from argparse import ArgumentParser
+import logging
+import signal
+import threading
+
+# Allow the repository packages to be imported when run as a script
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from pipeline.stages import QUEUE_SIZE
+from build_catalog.create_catalog import PARTITION_LEVELS, GRID_SIZE
+from pipeline.tasks import CatalogTasks, catalog_pipeline
+from pipeline.watcher import DirectoryWatcher, POLL_INTERVAL
+
+
+def main():
+    parser = ArgumentParser(
+        description="Watches a folder for new GeoTIFFs and converts, catalogues and indexes each as it arrives",
+        epilog="Should be run in the 'ogcapi' environment",
+    )
+    parser.add_argument(
+        "-i",
+        "--indir",
+        type=str,
+        dest="indir",
+        help="Input folder to watch",
+    )
+    parser.add_argument(
+        "-o",
+        "--outdir",
+        type=str,
+        dest="outdir",
+        help="Output folder for the converted files",
+    )
+    parser.add_argument(
+        "-c",
+        "--config",
+        type=str,
+        dest="config",
+        help="Catalog configuration, the converted files are added to its files list",
+        default=None,
+    )
+    parser.add_argument(
+        "-f",
+        "--format",
+        type=str,
+        dest="format",
+        choices=["cog", "netcdf"],
+        help="Output format of the conversion",
+        default="cog",
+    )
+    parser.add_argument(
+        "--catalog",
+        type=str,
+        dest="catalog",
+        help="STAC catalog folder to add items to, by default the versioned folder in the configured output_dir",
+        default=None,
+    )
+    parser.add_argument(
+        "--pattern",
+        type=str,
+        dest="pattern",
+        help="Glob pattern of the files to pick up",
+        default="*_classification.tif",
+    )
+    parser.add_argument(
+        "--existing",
+        help="Also process the files already in the input folder",
+        action="store_true",
+        default=False,
+    )
+    parser.add_argument(
+        "--interval",
+        type=float,
+        dest="interval",
+        help="Seconds between scans of the input folder",
+        default=POLL_INTERVAL,
+    )
+    parser.add_argument(
+        "-u",
+        "--upload",
+        help="Upload the converted files to the S3 folder of the configured url",
+        action="store_true",
+        default=False,
+    )
+    parser.add_argument(
+        "-I",
+        "--index",
+        help="Index each item in Elasticsearch, using deploy_catalog/es_upload_conf.yaml",
+        action="store_true",
+        default=False,
+    )
+    parser.add_argument(
+        "-p",
+        "--previews",
+        type=str.upper,
+        dest="previews",
+        choices=["PNG", "WEBP"],
+        help="Create thumbnail and overview images and add them to the items",
+        default=None,
+    )
+    parser.add_argument(
+        "-st",
+        "--stats",
+        help="Add per-class pixel counts, areas and valid-data fraction to each item",
+        action="store_true",
+        default=False,
+    )
+    parser.add_argument(
+        "-e",
+        "--exact-footprint",
+        dest="exact_footprint",
+        help="Use the valid-data polygon of each file as its footprint",
+        action="store_true",
+        default=False,
+    )
+    parser.add_argument(
+        "-P",
+        "--partition",
+        type=str,
+        dest="partition",
+        help="Add items to sub-catalogs by these comma separated levels: {}".format(",".join(PARTITION_LEVELS)),
+        default=None,
+    )
+    parser.add_argument(
+        "--grid-size",
+        type=int,
+        dest="grid_size",
+        help="Size in degrees of the grid tiles used to partition by grid",
+        default=GRID_SIZE,
+    )
+    parser.add_argument(
+        "--convert-workers",
+        type=int,
+        dest="convert_workers",
+        help="Number of files converted at the same time",
+        default=2,
+    )
+    parser.add_argument(
+        "--queue-size",
+        type=int,
+        dest="queue_size",
+        help="Number of files that can wait between stages before the previous stage is held up",
+        default=QUEUE_SIZE,
+    )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        help="Add extra information to logs.",
+        action="store_true",
+        default=False,
+    )
+
+    # define arguments
+    args = parser.parse_args()
+
+    # Start logging
+    code_dir, program = os.path.split(__file__)
+    logger = logging.getLogger(program)
+    logger.setLevel(logging.DEBUG if "verbose" in args and args.verbose else logging.INFO)
+
+    levels = [level.strip() for level in args.partition.split(",")] if args.partition else None
+    if levels and any(level not in PARTITION_LEVELS for level in levels):
+        parser.error("Partition levels should be from {}".format(",".join(PARTITION_LEVELS)))
+
+    # Configuration matching the output format
+    if args.config:
+        config_path = args.config
+    elif args.format == "netcdf":
+        config_path = os.path.join(os.path.dirname(code_dir), "build_catalog", "configuration-nc.yaml")
+    else:
+        config_path = os.path.join(os.path.dirname(code_dir), "build_catalog", "configuration.yaml")
+
+    tasks = CatalogTasks(logger, config_path, args.outdir, fmt=args.format, cat_folder=args.catalog,
+                         upload=args.upload, index=args.index, previews=args.previews, stats=args.stats,
+                         exact=args.exact_footprint, levels=levels, grid_size=args.grid_size)
+    pipeline = catalog_pipeline(logger, tasks, convert_workers=args.convert_workers, queue_size=args.queue_size)
+    watcher = DirectoryWatcher(logger, args.indir, args.pattern, interval=args.interval, existing=args.existing)
+
+    # Stop watching on Ctrl-C or SIGTERM, the files already queued are still finished
+    stop = threading.Event()
+    signal.signal(signal.SIGINT, lambda signum, frame: stop.set())
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+
+    pipeline.start()
+    logger.info("Watching {} for {}, adding items to {}".format(args.indir, args.pattern, tasks.cat_folder))
+    for path in watcher.watch(stop):
+        logger.info("Queueing {}, {} files in progress".format(path, pipeline.pending()))
+        pipeline.put(path)
+    pipeline.stop()
+
+    logger.info("Processing completed successfully for {}".format(args.indir))
+
+
+if __name__ == "__main__":
+    exit(main())
@@ -0,0 +1,63 @@
+import os
+import glob
+
+# Seconds between scans of the input folder
+POLL_INTERVAL = 10.0
+
+
+class DirectoryWatcher:
+    """
+    Polls a folder for new files matching a glob pattern
+
+    Polling works on local, network and mounted bucket folders alike. A file is only
+    reported once its size and modification time are unchanged between two scans, so
+    files that are still being copied in are not picked up early
+    """
+
+    def __init__(self, logger, indir, pattern, interval=POLL_INTERVAL, existing=False):
+        self.logger = logger
+        self.indir = indir
+        self.pattern = pattern
+        self.interval = interval
+        self.pending = {}
+        self.seen = set()
+        if not existing:
+            self.seen.update(self.scan())
+            self.logger.info("Ignoring {} files already in {}".format(len(self.seen), indir))
+
+    def scan(self):
+        files = {}
+        for path in glob.glob(os.path.join(self.indir, self.pattern)):
+            try:
+                info = os.stat(path)
+            except OSError:
+                continue
+            files[path] = (info.st_size, info.st_mtime_ns)
+
+        return files
+
+    def poll(self):
+        """
+        New files that have settled since the previous scan, oldest first
+        """
+        ready = []
+        for path, state in sorted(self.scan().items()):
+            if path in self.seen:
+                continue
+            if self.pending.get(path) == state:
+                ready.append(path)
+                self.seen.add(path)
+                del self.pending[path]
+            else:
+                self.pending[path] = state
+
+        return ready
+
+    def watch(self, stop):
+        """
+        Yields each new file until the stop event is set
+        """
+        while not stop.is_set():
+            for path in self.poll():
+                yield path
+            stop.wait(self.interval)
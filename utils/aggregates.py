@@ -0,0 +1,215 @@
+import os
+import numpy as np
+from netCDF4 import Dataset
+
+from utils.checkpoint import partial_path, commit_output
+
+# Tile sizes in pixels of the pyramid levels, each a multiple of the first
+AGGREGATE_TILES = [64, 256, 1024]
+AGGREGATE_SUFFIX = ".agg.nc"
+
+
+def aggregate_path(ofile):
+    """
+    Sidecar aggregate file written next to a NetCDF, e.g. x.nc -> x.agg.nc
+    """
+    return os.path.splitext(ofile)[0] + AGGREGATE_SUFFIX
+
+
+def tile_counts(data, tile, nclasses):
+    """
+    Per-time, per-class pixel counts of square tiles in one vectorised pass over the data
+
+    Each band of tile rows is counted with a single bincount over a combined tile column and
+    class index, so memory is bounded by one band rather than the whole cube
+
+    :param data: class values of shape (time, y, x)
+    :return: counts of shape (time, tile rows, tile columns, classes)
+    """
+    times, ydim, xdim = data.shape
+    ty, tx = -(-ydim // tile), -(-xdim // tile)
+    counts = np.zeros((times, ty, tx, nclasses), dtype=np.uint32)
+    tile_col = (np.arange(xdim) // tile) * nclasses
+    for t in range(times):
+        for row in range(ty):
+            band = data[t, row * tile:(row + 1) * tile, :]
+            index = (tile_col[np.newaxis, :] + band).ravel()
+            counts[t, row] = np.bincount(index, minlength=tx * nclasses).reshape(tx, nclasses)
+
+    return counts
+
+
+def coarsen(counts, factor):
+    """
+    Counts of tiles factor times larger, summed from the counts of the smaller tiles
+    """
+    times, ty, tx, nclasses = counts.shape
+    pad = ((0, 0), (0, -ty % factor), (0, -tx % factor), (0, 0))
+    counts = np.pad(counts, pad)
+
+    return counts.reshape(times, counts.shape[1] // factor, factor, counts.shape[2] // factor, factor,
+                          nclasses).sum(axis=(2, 4), dtype=np.uint32)
+
+
+def aggregate_pyramid(data, tiles=AGGREGATE_TILES, nclasses=None):
+    """
+    Tile counts at every level, only the finest level is counted from the pixels
+
+    :return: list of (tile size, counts) from the finest to the coarsest level
+    """
+    if nclasses is None:
+        nclasses = int(data.max()) + 1
+    counts = tile_counts(data, tiles[0], nclasses)
+    levels = [(tiles[0], counts)]
+    for tile in tiles[1:]:
+        if tile % levels[-1][0] != 0:
+            raise ValueError("Aggregate tile sizes {} should each be a multiple of the previous".format(tiles))
+        counts = coarsen(counts, tile // levels[-1][0])
+        levels.append((tile, counts))
+
+    return levels
+
+
+def write_aggregates(data, gt, ofile, times, logger, tiles=AGGREGATE_TILES, class_names=None):
+    """
+    Writes the aggregate pyramid of a NetCDF cube to its sidecar file
+
+    Each level is a group named by its tile size holding a counts(time, tile_y, tile_x, class)
+    variable, so area and time series summaries can be read without touching the pixels
+
+    :param data: class values of shape (time, y, x) as written to ofile
+    :param times: time values of the NetCDF time variable
+    :return: path of the sidecar file
+    """
+    levels = aggregate_pyramid(data, tiles=tiles)
+    times_dim, ydim, xdim = data.shape
+    nclasses = levels[0][1].shape[3]
+
+    agg_file = aggregate_path(ofile)
+    nc_fid = Dataset(partial_path(agg_file), 'w', format='NETCDF4')
+    nc_fid.setncatts({'source': os.path.basename(ofile),
+                      'geotransform': np.array(gt, dtype='f8'),
+                      'height': ydim,
+                      'width': xdim,
+                      'tile_sizes': np.array(tiles, dtype='i4')})
+    nc_fid.createDimension('time', times_dim)
+    nc_fid.createDimension('class', nclasses)
+    time_var = nc_fid.createVariable('time', 'f8', ('time',))
+    time_var[:] = times
+    classes = nc_fid.createVariable('class', 'u1', ('class',))
+    classes[:] = np.arange(nclasses)
+    if class_names:
+        classes.setncattr('flag_meanings', " ".join(class_names))
+
+    for tile, counts in levels:
+        group = nc_fid.createGroup(str(tile))
+        group.setncattr('tile_size', tile)
+        group.createDimension('tile_y', counts.shape[1])
+        group.createDimension('tile_x', counts.shape[2])
+        var = group.createVariable('counts', 'u4', ('time', 'tile_y', 'tile_x', 'class'), zlib=True)
+        var[:] = counts
+    nc_fid.close()
+    commit_output(partial_path(agg_file), agg_file)
+    logger.info("Writing aggregates at tile sizes {} to: {}".format(tiles, agg_file))
+
+    return agg_file
+
+
+def pixel_window(gt, bbox):
+    """
+    Row and column window (row_start, row_end, col_start, col_end) of a projected bbox in a north-up image
+    """
+    col_start = int(np.floor((bbox[0] - gt[0]) / gt[1]))
+    col_end = int(np.ceil((bbox[2] - gt[0]) / gt[1]))
+    row_start = int(np.floor((bbox[3] - gt[3]) / gt[5]))
+    row_end = int(np.ceil((bbox[1] - gt[3]) / gt[5]))
+
+    return row_start, row_end, col_start, col_end
+
+
+class AggregateReader:
+    """
+    Answers class count queries on a NetCDF cube from its aggregate pyramid
+
+    A window is covered by the whole tiles of the coarsest level that fit inside it, and the
+    strips left at its edges by the finer levels in turn, so only the pixels of partial tiles
+    at the finest level are read from the cube itself
+    """
+
+    def __init__(self, ofile, agg_file=None):
+        self.data_fid = Dataset(ofile, 'r')
+        self.agg_fid = Dataset(agg_file or aggregate_path(ofile), 'r')
+        self.gt = [float(v) for v in self.agg_fid.getncattr('geotransform')]
+        self.height = int(self.agg_fid.getncattr('height'))
+        self.width = int(self.agg_fid.getncattr('width'))
+        self.nclasses = len(self.agg_fid.dimensions['class'])
+        self.times = self.agg_fid.variables['time'][:]
+        # Coarsest level first
+        self.levels = sorted(((int(name), group.variables['counts']) for name, group in self.agg_fid.groups.items()),
+                             reverse=True)
+        self.pixels_read = 0
+
+    def close(self):
+        self.data_fid.close()
+        self.agg_fid.close()
+
+    def raw_counts(self, row_start, row_end, col_start, col_end, time):
+        block = self.data_fid.variables['data'][time, row_start:row_end, col_start:col_end]
+        block = np.ma.filled(block, 0).astype(np.int64)
+        self.pixels_read += block.size
+        counts = np.zeros((block.shape[0], self.nclasses), dtype=np.int64)
+        for t in range(block.shape[0]):
+            counts[t] = np.bincount(block[t].ravel(), minlength=self.nclasses)[:self.nclasses]
+
+        return counts
+
+    def window_counts(self, row_start, row_end, col_start, col_end, time, level=0):
+        if row_start >= row_end or col_start >= col_end:
+            return 0
+        if level == len(self.levels):
+            return self.raw_counts(row_start, row_end, col_start, col_end, time)
+
+        tile, counts = self.levels[level]
+        # Whole tiles inside the window, tiles at the image edge are whole up to the edge
+        tile_rows = (-(-row_start // tile), row_end // tile if row_end < self.height else -(-row_end // tile))
+        tile_cols = (-(-col_start // tile), col_end // tile if col_end < self.width else -(-col_end // tile))
+        if tile_rows[0] >= tile_rows[1] or tile_cols[0] >= tile_cols[1]:
+            return self.window_counts(row_start, row_end, col_start, col_end, time, level + 1)
+
+        inner = counts[time, tile_rows[0]:tile_rows[1], tile_cols[0]:tile_cols[1], :]
+        total = np.asarray(inner, dtype=np.int64).sum(axis=(1, 2))
+        top, bottom = tile_rows[0] * tile, min(tile_rows[1] * tile, row_end)
+        left, right = tile_cols[0] * tile, min(tile_cols[1] * tile, col_end)
+        # Edge strips above, below, left and right of the whole tiles
+        for window in [(row_start, top, col_start, col_end), (bottom, row_end, col_start, col_end),
+                       (top, bottom, col_start, left), (top, bottom, right, col_end)]:
+            total = total + self.window_counts(*window, time=time, level=level + 1)
+
+        return total
+
+    def class_counts(self, bbox=None, window=None, time=slice(None)):
+        """
+        Pixel counts per time and class within a projected bbox or a pixel window
+
+        :param window: (row_start, row_end, col_start, col_end), the whole image by default
+        :param time: index or slice of the time steps
+        :return: counts of shape (time, classes)
+        """
+        if bbox is not None:
+            window = pixel_window(self.gt, bbox)
+        if window is None:
+            window = (0, self.height, 0, self.width)
+        row_start, row_end = max(0, window[0]), min(self.height, window[1])
+        col_start, col_end = max(0, window[2]), min(self.width, window[3])
+        time = slice(time, time + 1) if isinstance(time, int) else time
+        counts = self.window_counts(row_start, row_end, col_start, col_end, time)
+        if np.isscalar(counts):
+            counts = np.zeros((len(self.times[time]), self.nclasses), dtype=np.int64)
+
+        return counts
+
+    def class_areas(self, bbox=None, window=None, time=slice(None)):
+        """
+        Area per time and class in square units of the projection
+        """
+        return self.class_counts(bbox=bbox, window=window, time=time) * abs(self.gt[1] * self.gt[5])
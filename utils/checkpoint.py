@@ -0,0 +1,147 @@
+import os
+import gzip
+import json
+import shutil
+import threading
+import time
+from osgeo import gdal
+from netCDF4 import Dataset
+import zarr
+
+
+def partial_path(path):
+    """
+    Hidden name in the same folder that an output is written to before being renamed into place
+
+    The extension is kept so that GDAL and the other writers pick the same format
+    """
+    folder, name = os.path.split(path.rstrip("/"))
+    base, ext = os.path.splitext(name)
+
+    return os.path.join(folder, ".{}.part{}".format(base, ext))
+
+
+def commit_output(tmp_path, path):
+    """
+    Moves a completed output into place, replacing any earlier or partial version
+    """
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    os.replace(tmp_path, path)
+
+    return path
+
+
+def write_json(path, doc):
+    # Temp file plus rename, so a reader never sees a partly written file
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(doc, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+    os.replace(tmp_path, path)
+
+
+def output_size(path):
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(root, name))
+                   for root, dirs, names in os.walk(path) for name in names)
+
+    return os.path.getsize(path)
+
+
+def readable(path):
+    """
+    Checks that an output can be opened by its reader, which catches truncated headers
+    """
+    ext = os.path.splitext(path.rstrip("/"))[1].lower()
+    if not os.path.exists(path):
+        return False
+    try:
+        # Merged stacks are written by gdal_merge.py without an extension
+        if ext in [".tif", ".tiff"] or (not ext and os.path.isfile(path)):
+            ds = gdal.Open(path)
+            if ds is None:
+                return False
+            # Reading the last block fails if the file was cut short
+            band = ds.GetRasterBand(1)
+            xblock, yblock = band.GetBlockSize()
+            block = band.ReadBlock((ds.RasterXSize - 1) // xblock, (ds.RasterYSize - 1) // yblock)
+            ds = None
+            if block is None:
+                return False
+        elif ext == ".nc":
+            Dataset(path, "r").close()
+        elif ext == ".zarr":
+            zarr.open_consolidated(path, mode="r")
+        elif ext == ".json":
+            with open(path, "r") as f:
+                json.load(f)
+                f.close()
+        elif ext == ".gz":
+            # Decompressing to the end fails if the bulk file was cut short
+            with gzip.open(path, "rb") as f:
+                while f.read(1024 * 1024):
+                    pass
+                f.close()
+        elif os.path.isdir(path) and os.path.exists(os.path.join(path, "catalog.json")):
+            return readable(os.path.join(path, "catalog.json"))
+        else:
+            # Outputs that cannot be verified are redone rather than trusted
+            return False
+    except Exception:
+        return False
+
+    return True
+
+
+class Journal:
+    """
+    Checkpoint journal of completed units of work and the outputs each one produced
+
+    The journal is rewritten atomically after every completed unit. On resume a unit is
+    only skipped if all of its outputs still exist with the recorded size and can be
+    opened, so units that were interrupted, or whose outputs were damaged, are redone
+    """
+
+    def __init__(self, logger, path, resume=False):
+        self.logger = logger
+        self.path = path
+        self.lock = threading.Lock()
+        self.units = {}
+        if resume and os.path.exists(path):
+            try:
+                with open(path, "r") as f:
+                    self.units = json.load(f)['units']
+                    f.close()
+                logger.info("Resuming from {} with {} completed units".format(path, len(self.units)))
+            except (ValueError, KeyError):
+                logger.warning("Journal {} could not be read, starting again".format(path))
+
+    def done(self, key):
+        """
+        True if the unit was completed and its outputs are intact
+        """
+        with self.lock:
+            unit = self.units.get(key)
+        if unit is None:
+            return False
+        for path, size in unit['outputs'].items():
+            if not os.path.exists(path) or output_size(path) != size or not readable(path):
+                self.logger.warning("Output {} of {} is missing or incomplete, redoing".format(path, key))
+                with self.lock:
+                    self.units.pop(key, None)
+                return False
+
+        return True
+
+    def complete(self, key, outputs):
+        """
+        Records a unit as done with the current sizes of its outputs
+        """
+        unit = {'outputs': {path: output_size(path) for path in outputs if path and os.path.exists(path)},
+                'completed': time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())}
+        with self.lock:
+            self.units[key] = unit
+            write_json(self.path, {'units': self.units})
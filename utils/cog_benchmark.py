@@ -0,0 +1,336 @@
+import os
+import sys
+from argparse import Namespace, ArgumentParser
+import csv
+import itertools
+import json
+import logging
+import shutil
+import threading
+import time
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+from functools import partial
+from tempfile import TemporaryDirectory
+import numpy as np
+from osgeo import gdal
+
+# Allow the utils package to be imported when run as a script
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.convert_gtiff import cog_commands, COG_OVERVIEWS, gdal_home
+from utils.executor import execute
+
+# Codecs that take a compression level
+LEVEL_CODECS = ["DEFLATE", "ZSTD"]
+
+
+class RangeRequestHandler(SimpleHTTPRequestHandler):
+    """
+    Static file handler with HTTP Range support that counts requests and bytes sent per file
+    """
+
+    def __init__(self, *args, stats=None, lock=None, **kwargs):
+        self.stats = stats
+        self.lock = lock
+        super().__init__(*args, **kwargs)
+
+    def log_message(self, format, *args):
+        pass
+
+    def record(self, nbytes):
+        with self.lock:
+            entry = self.stats.setdefault(self.path, {'requests': 0, 'bytes': 0})
+            entry['requests'] += 1
+            entry['bytes'] += nbytes
+
+    def send_body(self, path, start, end, status):
+        with open(path, "rb") as f:
+            f.seek(start)
+            body = f.read(end - start + 1)
+        self.send_response(status)
+        self.send_header("Content-Type", "image/tiff")
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Length", str(len(body)))
+        if status == 206:
+            self.send_header("Content-Range", "bytes {}-{}/{}".format(start, end, os.path.getsize(path)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+            self.record(len(body))
+        else:
+            self.record(0)
+
+    def do_GET(self):
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+        size = os.path.getsize(path)
+        header = self.headers.get("Range")
+        if header is None or not header.startswith("bytes="):
+            self.send_body(path, 0, size - 1, 200)
+            return
+
+        start, _, end = header[6:].split(",")[0].partition("-")
+        if start == "":
+            start, end = max(0, size - int(end)), size - 1
+        else:
+            start, end = int(start), min(int(end) if end else size - 1, size - 1)
+        self.send_body(path, start, end, 206)
+
+    def do_HEAD(self):
+        self.do_GET()
+
+
+def start_server(folder):
+    """
+    Local HTTP server for the variants folder, on a free port in a background thread
+    """
+    stats = {}
+    handler = partial(RangeRequestHandler, directory=folder, stats=stats, lock=threading.Lock())
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    return server, stats
+
+
+def parameter_grid(blocksizes, codecs, levels, predictors, overviews):
+    """
+    Combinations of COG layout parameters, levels are only varied for codecs that use them
+    """
+    grid = []
+    for blocksize, codec, predictor, levels_list in itertools.product(blocksizes, codecs, predictors, overviews):
+        for level in (levels if codec in LEVEL_CODECS else [None]):
+            grid.append({'blocksize': blocksize, 'compress': codec, 'level': level,
+                         'predictor': predictor, 'overviews': levels_list})
+
+    return grid
+
+
+def variant_name(params):
+    return "bs{}_{}{}_p{}_ov{}.tif".format(params['blocksize'], params['compress'].lower(),
+                                            params['level'] if params['level'] is not None else "",
+                                            params['predictor'] if params['predictor'] is not None else 1,
+                                            max(params['overviews']) if params['overviews'] else 0)
+
+
+def synthetic_workload(xdim, ydim, tiles, tile_size=256, seed=0):
+    """
+    Random tile requests spread over full resolution and each power of two zoom out
+
+    :return: list of tile requests as dictionaries of level, x, y and size
+    """
+    rng = np.random.default_rng(seed)
+    requests = []
+    max_level = int(np.log2(max(xdim, ydim) / tile_size)) if max(xdim, ydim) > tile_size else 0
+    for count in range(tiles):
+        level = int(rng.integers(0, max_level + 1))
+        span = tile_size * 2 ** level
+        x = int(rng.integers(0, max(1, xdim - span + 1)))
+        y = int(rng.integers(0, max(1, ydim - span + 1)))
+        requests.append({'level': level, 'x': x, 'y': y, 'size': tile_size})
+
+    return requests
+
+
+def replay(url, workload):
+    """
+    Reads each tile through /vsicurl/ with a cold cache, as an uncached tile server would
+
+    :return: latency of each tile in seconds
+    """
+    latencies = []
+    for tile in workload:
+        gdal.VSICurlClearCache()
+        start = time.perf_counter()
+        ds = gdal.Open("/vsicurl/" + url)
+        span = tile['size'] * 2 ** tile['level']
+        xsize = min(span, ds.RasterXSize - tile['x'])
+        ysize = min(span, ds.RasterYSize - tile['y'])
+        ds.GetRasterBand(1).ReadAsArray(tile['x'], tile['y'], xsize, ysize,
+                                        buf_xsize=max(1, xsize // 2 ** tile['level']),
+                                        buf_ysize=max(1, ysize // 2 ** tile['level']),
+                                        resample_alg=gdal.GRIORA_NearestNeighbour)
+        ds = None
+        latencies.append(time.perf_counter() - start)
+
+    return latencies
+
+
+def benchmark(logger, infile, workdir, grid, workload=None, tiles=200):
+    """
+    Creates a COG for each parameter set and measures the tile workload against it
+
+    :return: list of result dictionaries, one per variant
+    """
+    # GDAL settings so that only the requested ranges are fetched
+    gdal.SetConfigOption("GDAL_DISABLE_READDIR_ON_OPEN", "EMPTY_DIR")
+    gdal.SetConfigOption("CPL_VSIL_CURL_ALLOWED_EXTENSIONS", ".tif")
+    gdal.SetConfigOption("GDAL_HTTP_MERGE_CONSECUTIVE_RANGES", "YES")
+    gdal.SetConfigOption("VSI_CACHE", "FALSE")
+
+    ds = gdal.Open(infile)
+    xdim, ydim = ds.RasterXSize, ds.RasterYSize
+    ds = None
+    if workload is None:
+        workload = synthetic_workload(xdim, ydim, tiles)
+
+    server, stats = start_server(workdir)
+    port = server.server_address[1]
+    results = []
+    for params in grid:
+        name = variant_name(params)
+        outfile = os.path.join(workdir, name)
+
+        # Overviews are built in place, so each variant starts from a fresh copy of the input with any
+        # overviews it already has removed, as gdaladdo would otherwise add to them
+        source = os.path.join(workdir, "source.tif")
+        shutil.copyfile(infile, source)
+        commands = ["{}/gdaladdo -clean {}".format(gdal_home, source)]
+        commands += cog_commands(source, outfile, blocksize=params['blocksize'], compress=params['compress'],
+                                 level=params['level'], predictor=params['predictor'], overviews=params['overviews'])
+        for cmd in commands:
+            if execute(logger, cmd)['returncode'] != 0:
+                break
+        os.remove(source)
+        if not os.path.exists(outfile):
+            logger.warning("Failed to create {}".format(name))
+            continue
+
+        latencies = np.array(replay("http://127.0.0.1:{}/{}".format(port, name), workload))
+        counts = stats.pop("/" + name, {'requests': 0, 'bytes': 0})
+        result = dict(params)
+        result['overviews'] = " ".join(str(o) for o in params['overviews'])
+        result.update({'variant': name,
+                       'file_size': os.path.getsize(outfile),
+                       'tiles': len(workload),
+                       'requests': counts['requests'],
+                       'bytes_fetched': counts['bytes'],
+                       'mean_latency_ms': 1000.0 * float(latencies.mean()),
+                       'p95_latency_ms': 1000.0 * float(np.percentile(latencies, 95))})
+        logger.info("{}: {} bytes on disk, {} requests, {} bytes fetched, {:.1f} ms mean".format(
+            name, result['file_size'], result['requests'], result['bytes_fetched'], result['mean_latency_ms']))
+        results.append(result)
+        os.remove(outfile)
+
+    server.shutdown()
+
+    return results
+
+
+def main(args: Namespace = None) -> int:
+    if args is None:
+        parser = ArgumentParser(
+            description="Benchmarks COG layouts against a tile-request workload over HTTP range reads",
+            epilog="Should be run with GDAL installed",
+        )
+        parser.add_argument(
+            "-i",
+            "--infile",
+            type=str,
+            dest="infile",
+            help="Input GeoTIFF",
+        )
+        parser.add_argument(
+            "-o",
+            "--outfile",
+            type=str,
+            dest="outfile",
+            help="Output CSV report",
+        )
+        parser.add_argument(
+            "--blocksizes",
+            type=str,
+            help="Comma separated block sizes",
+            default="256,512",
+        )
+        parser.add_argument(
+            "--codecs",
+            type=str,
+            help="Comma separated compression codecs",
+            default="DEFLATE,ZSTD,LZW",
+        )
+        parser.add_argument(
+            "--levels",
+            type=str,
+            help="Comma separated compression levels for DEFLATE and ZSTD",
+            default="6,9",
+        )
+        parser.add_argument(
+            "--predictors",
+            type=str,
+            help="Comma separated TIFF predictors",
+            default="1,2",
+        )
+        parser.add_argument(
+            "--overviews",
+            type=str,
+            help="Semi-colon separated lists of overview levels",
+            default="2 4 8 16;{}".format(" ".join(str(o) for o in COG_OVERVIEWS)),
+        )
+        parser.add_argument(
+            "-w",
+            "--workload",
+            type=str,
+            dest="workload",
+            help="JSON list of tile requests ({level, x, y, size}) to replay rather than random tiles",
+            default=None,
+        )
+        parser.add_argument(
+            "-n",
+            "--tiles",
+            type=int,
+            dest="tiles",
+            help="Number of random tile requests when no workload is given",
+            default=200,
+        )
+        parser.add_argument(
+            "-v",
+            "--verbose",
+            help="Add extra information to logs.",
+            action="store_true",
+            default=False,
+        )
+
+        # define arguments
+        args = parser.parse_args()
+
+    # Start logging
+    codedir, program = os.path.split(__file__)
+    logger = logging.getLogger(program)
+    logger.setLevel(logging.DEBUG if "verbose" in args and args.verbose else logging.INFO)
+
+    workload = None
+    if args.workload:
+        with open(args.workload, "r") as f:
+            workload = json.load(f)
+            f.close()
+
+    grid = parameter_grid([int(b) for b in args.blocksizes.split(",")],
+                          args.codecs.upper().split(","),
+                          [int(l) for l in args.levels.split(",")],
+                          [int(p) for p in args.predictors.split(",")],
+                          [[int(o) for o in levels.split()] for levels in args.overviews.split(";")])
+    logger.info("Benchmarking {} COG variants of {}".format(len(grid), args.infile))
+
+    tmp_dir = TemporaryDirectory()
+    results = benchmark(logger, args.infile, tmp_dir.name, grid, workload=workload, tiles=args.tiles)
+    tmp_dir.cleanup()
+
+    if len(results) == 0:
+        logger.info("No variants could be created from {}".format(args.infile))
+        sys.exit(1)
+
+    with open(args.outfile, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=list(results[0].keys()))
+        writer.writeheader()
+        writer.writerows(results)
+        f.close()
+
+    logger.info("Processing completed successfully, report written to {}".format(args.outfile))
+
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
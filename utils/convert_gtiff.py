@@ -1,6 +1,5 @@
 import os
 import sys
-import subprocess
 from argparse import Namespace, ArgumentParser
 import glob
 import numpy as np
@@ -9,30 +8,62 @@ import datetime as dt
 import time
 import uuid
 from netCDF4 import Dataset, date2num
-import pyproj
-from osgeo import osr, gdal
+from osgeo import gdal
 import logging
+from concurrent.futures import ThreadPoolExecutor
+from tempfile import TemporaryDirectory
+import zarr
+from numcodecs import Blosc
+
+# Allow the utils package to be imported when run as a script
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils import palette
+from utils.transforms import pixel_centres, latlon_rows, cf_grid_mapping, cf_coordinate_attributes
+from utils.checkpoint import Journal, partial_path, commit_output
+from utils.shards import shard_files, shard_suffix
+from utils.aggregates import write_aggregates, aggregate_path
+from utils.tiling import tile_scene
+from utils.executor import execute, run_batch, COMMAND_TIMEOUT
 
 home = os.path.expanduser("~")
 print("Home directory: {}".format(home))
 gdal_home = os.path.join(home, "anaconda3/envs/rsgislib_dev/bin")
 python = os.path.join(home, "anaconda3/envs/rsgislib_dev/bin/python")
 
-# Run external shell command
-def execmd(command):
+# Default COG layout
+COG_BLOCKSIZE = 512
+COG_COMPRESS = "DEFLATE"
+COG_OVERVIEWS = [2, 4, 8, 16, 32, 64, 128, 256, 512]
 
-        # Replaced due to shell=True being a security hazard
-        p = subprocess.Popen(command, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, close_fds=True)
-        output = p.stdout.read()
-        p.stdin.close()
-        p.stdout.close()
-        # p.communicate()
 
-        if output:
-            return output
+def cog_commands(infile, outfile, blocksize=COG_BLOCKSIZE, compress=COG_COMPRESS, level=None, predictor=None,
+                 overviews=COG_OVERVIEWS, source=None):
+    """
+    GDAL commands that build the overviews in the input file and then copy it to a COG
 
+    :param level: compression level for DEFLATE (ZLEVEL) or ZSTD (ZSTD_LEVEL)
+    :param predictor: TIFF predictor, 2 for horizontal differencing
+    :param source: dataset copied to the COG instead of the input, such as a VRT of it with a colour table
+    :return: list of commands to be run in order
+    """
+    options = "-co COMPRESS={} -co BIGTIFF=YES -co TILED=YES -co BLOCKXSIZE={} -co BLOCKYSIZE={}".format(
+        compress, blocksize, blocksize)
+    if level is not None:
+        if compress == "ZSTD":
+            options += " -co ZSTD_LEVEL={}".format(level)
         else:
-            return None
+            options += " -co ZLEVEL={}".format(level)
+    if predictor is not None:
+        options += " -co PREDICTOR={}".format(predictor)
+
+    commands = []
+    if overviews:
+        commands.append("{}/gdaladdo -r nearest {} {}".format(gdal_home, infile, " ".join(str(o) for o in overviews)))
+    commands.append("{}/gdal_translate {} --config GDAL_TIFF_OVR_BLOCKSIZE {} -co COPY_SRC_OVERVIEWS=YES {} {}".format(
+        gdal_home, options, blocksize, source or infile, outfile))
+
+    return commands
+
 
 def read_geotiff(file):
 
@@ -55,81 +86,185 @@ def read_geotiff(file):
         return darray, geotransform, wkt
 
 
-def writeNetCDF(infile, outdir, description, logger, datelist=False):
+def preview_shape(xdim, ydim, size):
+    # Longest side scaled to size, never enlarged
+    scale = min(1.0, float(size) / max(xdim, ydim))
+    return max(1, int(round(ydim * scale))), max(1, int(round(xdim * scale)))
+
+
+def decimate(data, shape):
+    # Nearest neighbour decimation, so class values are never blended
+    rows = np.linspace(0, data.shape[0] - 1, shape[0]).astype(int)
+    cols = np.linspace(0, data.shape[1] - 1, shape[1]).astype(int)
+    return data[np.ix_(rows, cols)]
+
+
+def write_previews(infile, outdir, logger, data=None, fmt="PNG", thumb_size=256, overview_size=1024):
     """
-    Writes a data array to a given file along with the relevant metadata for each array being written to file
+    Writes a colour-mapped thumbnail and low resolution overview image for a classification
 
-    :param infile: path to desired input file
+    If the data has already been read for the conversion it is decimated in memory, otherwise a single
+    decimated read is made that GDAL serves from the internal overviews, and the thumbnail is derived
+    from the overview so the image is only read once
+
+    :param data: optional 2D array of the first layer, already in memory
+    :param fmt: PNG or WEBP
+    :return: paths of the thumbnail and overview images
     """
+    ds = gdal.Open(infile)
+    band = ds.GetRasterBand(1)
+    lut = palette.get_lut(band)
+    xdim, ydim = ds.RasterXSize, ds.RasterYSize
+
+    oshape = preview_shape(xdim, ydim, overview_size)
+    if data is not None:
+        overview = decimate(data, oshape)
+    else:
+        overview = band.ReadAsArray(0, 0, xdim, ydim, buf_xsize=oshape[1], buf_ysize=oshape[0],
+                                    resample_alg=gdal.GRIORA_NearestNeighbour)
+    ds = None
+    thumbnail = decimate(overview, preview_shape(oshape[1], oshape[0], thumb_size))
 
-    # Extract date from filename
+    ext = "webp" if fmt == "WEBP" else "png"
+    base = os.path.join(outdir, os.path.basename(infile).split(".")[0])
+    thumb_file = palette.write_image(palette.colourise(thumbnail, lut), "{}_thumbnail.{}".format(base, ext), fmt)
+    overview_file = palette.write_image(palette.colourise(overview, lut), "{}_overview.{}".format(base, ext), fmt)
+    logger.info("Previews written to {} and {}".format(thumb_file, overview_file))
+
+    return thumb_file, overview_file
+
+
+def get_version(logger):
+    """
+    Reads the utils package version used to tag output products
+    """
+    f = open(os.path.join(os.path.dirname(__file__),'__init__.py'), "r")
+    version_file = f.read()
+    f.close()
+    version_line = re.search(r"^__version__ = ['\"]([^'\"]*)['\"]",version_file, re.M)
+    logger.info("Running {}".format(version_line.group()))
+    return version_line.group().split("'")[1]
+
+
+def get_file_date(infile, logger):
+    """
+    Extracts the acquisition date from the start of the filename
+
+    :return: date string from the filename and the matching datetime
+    """
     elements = os.path.basename(infile).split("_")
     sub_element = elements[0]
     date = dt.datetime(int(sub_element[0:4]), int(sub_element[4:6]), int(sub_element[6:8]))
     logger.info("Date: {} as {}".format(sub_element, date))
 
+    return sub_element, date
+
+
+def global_attributes(description, sub_element, version, datelist=False):
+    """
+    CF/ACDD global attributes shared by the NetCDF and Zarr outputs
+    """
+    attrs = {}
+    attrs['title'] = "OGC API: {}".format(description)
+    attrs['summary'] = "Product from the OGC API project, produced using an approached developed by Pixalytics Ltd."
+    attrs['description'] = description
+    attrs['history'] = 'Created ' + time.ctime(time.time())
+    attrs['time_coverage_start'] = sub_element
+    attrs['time_coverage_end'] = sub_element
+    if datelist:
+        attrs['time_coverage_duration'] = "{} days".format(len(datelist))
+    else:
+        attrs['time_coverage_duration'] = "1 day"
+    attrs['source'] = 'Pixalytics Ltd'
+    attrs['product_version'] = "Version " + version
+    attrs['uuid'] = str(uuid.uuid1())
+    # Will be the DOI
+    # attrs['tracking_id'] = "xxxx"
+    attrs['Conventions'] = 'CF-1.5'
+    attrs['iso19115_topic_categories'] = "Environment; GeoscientificInformation"
+    attrs['standard_name_vocabulary'] = "NetCDF Climate and Forecast (CF) Metadata Convention"
+    attrs['acknowledgment'] = "Testbed 17 activity supported by OGC"
+    attrs['creator_name'] = "Pixalytics Ltd"
+    attrs['creator_email'] = "helpdesk@pixalytics.com"
+    attrs['creator_url'] = "https://www.pixalytics.com"
+
+    return attrs
+
+
+def grid_coordinates(gt, wkt, xdim, ydim):
+    """
+    Projected pixel centre coordinates plus the grid mapping attributes for an image
+
+    The 2D latitude and longitude are written separately in row blocks with latlon_rows
+
+    :return: x and y arrays, their variable attributes and the crs variable attributes
+    """
+    xs, ys = pixel_centres(gt, xdim, ydim)
+    x_attrs, y_attrs = cf_coordinate_attributes(wkt)
+    crs_attrs = cf_grid_mapping(wkt, gt)
+    print("Spatial Ref: {}".format(crs_attrs['spatial_ref']))
+    print("Grid mapping: {}".format(crs_attrs['grid_mapping_name']))
+    print("Data X(min,max): {:.2f} {:.2f} Y(min,max): {:.2f} {:.2f}".format(xs.min(), xs.max(), ys.min(), ys.max()))
+
+    return xs, ys, x_attrs, y_attrs, crs_attrs
+
+
+# Rows of 2D latitude and longitude computed per transformer call
+LATLON_ROWS = 256
+
+# Variable attributes shared by the NetCDF and Zarr outputs, x and y are set from the CRS by grid_coordinates
+TIME_UNITS = 'hours since 0001-01-01 00:00:00'
+TIME_ATTRS = {'units': TIME_UNITS,
+              'calendar': 'gregorian',
+              'axis': 'T',
+              'standard_name': 'time'}
+LON_ATTRS = {'long_name': 'longitude', 'units': 'degree_east'}
+LAT_ATTRS = {'long_name': 'latitude', 'units': 'degree_north'}
+
+
+def data_attributes(description, legend=None):
+    # CF Standard Names: http://cfconventions.org/standard-names.html
+    attrs = {'long_name': u"{}".format(description),
+             'units': u'None',
+             'level_desc': u'Surface',
+             'var_desc': u"Surface Classification",
+             'grid_mapping': "crs",
+             'coordinates': "lat lon"}
+    # Class names, and with a legend their colours so RGB can be expanded by palette.lut_from_flags
+    attrs.update(palette.flag_attributes(legend))
+
+    return attrs
+
+
+def writeNetCDF(infile, outdir, description, logger, datelist=False, previews=None, aggregates=False, legend=None):
+    """
+    Writes a data array to a given file along with the relevant metadata for each array being written to file
+
+    :param infile: path to desired input file
+    :param previews: optional preview format (PNG or WEBP), previews are created from the data already read
+    :param aggregates: also write the class count pyramid of the data to a sidecar .agg.nc file
+    """
+
+    # Extract date from filename
+    sub_element, date = get_file_date(infile, logger)
+
     # Setup file to write
     ofile = os.path.join(outdir, os.path.basename(infile).split(".")[0]+".nc")
-    nc_fid = Dataset(ofile, 'w', format='NETCDF4')
+    nc_fid = Dataset(partial_path(ofile), 'w', format='NETCDF4')
 
     # Global Attributes & min/max
     null_value = 0
     # Version
-    f = open(os.path.join(os.path.dirname(__file__),'__init__.py'), "r")
-    version_file = f.read()
-    version_line = re.search(r"^__version__ = ['\"]([^'\"]*)['\"]",version_file, re.M)
-    logger.info("Running {}".format(version_line.group()))
-    version = version_line.group().split("'")[1]
+    version = get_version(logger)
 
     # Load data
     data, gt, wkt = read_geotiff(infile)
     print('Data array: {}'.format(data.shape))
     bands, ydim, xdim = data.shape
 
-    # Calculate four corners of image
-    minx = gt[0]
-    maxx = gt[0] + xdim * gt[1] + ydim * gt[2]
-    miny = gt[3] + xdim * gt[4] + ydim * gt[5]
-    maxy = gt[3]
-
-    cs = osr.SpatialReference()
-    cs.ImportFromWkt(wkt)
-    zone = cs.GetAttrValue("PROJCS").split(" ")[5]
-    if zone[-1:] == "S":
-        correction = -1.0
-    else:
-        correction = 1.0
-    utmz = int(zone[:-1]) * correction
-    prj = cs.GetAttrValue("AUTHORITY", 1)
-    sref = cs.ExportToWkt()
-    print("Spatial Ref: {}".format(sref))
-    print("EPSG Projection: {} Zone: {}".format(prj, utmz))
-    lons = np.linspace(minx, maxx, num=xdim)
-    lats = np.linspace(miny, maxy, num=ydim)
-
-    nc_fid.title = "OGC API: {}".format(description)
-    nc_fid.summary = "Product from the OGC API project, produced using an approached developed by Pixalytics Ltd."
-    nc_fid.description = description
-    nc_fid.history = 'Created ' + time.ctime(time.time())
-    nc_fid.time_coverage_start = sub_element
-    nc_fid.time_coverage_end = sub_element
-    if datelist:
-        nc_fid.time_coverage_duration = "{} days".format(len(datelist))
-    else:
-        nc_fid.time_coverage_duration = "1 day"
-    nc_fid.source = 'Pixalytics Ltd'
-    nc_fid.product_version = "Version " + version
-    x = uuid.uuid1()
-    nc_fid.uuid = str(x)
-    # Will be the DOI
-    # nc_fid.tracking_id = "xxxx"
-    nc_fid.Conventions = 'CF-1.5'
-    nc_fid.iso19115_topic_categories = "Environment; GeoscientificInformation"
-    nc_fid.standard_name_vocabulary = "NetCDF Climate and Forecast (CF) Metadata Convention"
-    nc_fid.acknowledgment = "Testbed 17 activity supported by OGC"
-    nc_fid.creator_name = "Pixalytics Ltd"
-    nc_fid.creator_email = "helpdesk@pixalytics.com"
-    nc_fid.creator_url = "https://www.pixalytics.com"
+    xs, ys, x_attrs, y_attrs, crs_attrs = grid_coordinates(gt, wkt, xdim, ydim)
+
+    nc_fid.setncatts(global_attributes(description, sub_element, version, datelist))
 
     # Dimensions - 3D, time plus number of rows and columns
     if datelist:
@@ -137,78 +272,51 @@ def writeNetCDF(infile, outdir, description, logger, datelist=False):
     else:
         nc_fid.createDimension('time', 1)
 
-    nc_fid.createDimension('x0', lons.shape[0])
-    nc_fid.createDimension('y0', lats.shape[0])
+    nc_fid.createDimension('x0', xs.shape[0])
+    nc_fid.createDimension('y0', ys.shape[0])
 
-    print("Data X(min,max): {:.2f} {:.2f} Y(min,max): {:.2f} {:.2f}".format(minx, maxx, miny, maxy))
-    print("writeNetCDF, Dimensions YX: {} {}".format(len(lats), len(lons)))
+    print("writeNetCDF, Dimensions YX: {} {}".format(len(ys), len(xs)))
 
     # Variable Attributes for each projection type
     x = nc_fid.createVariable('x0', 'f8', ('x0',))
-    x[:] = lons
+    x[:] = xs
     y = nc_fid.createVariable('y0', 'f8', ('y0',))
-    y[:] = lats
-    x.long_name = 'x coordinate of projection'
-    x.standard_name = 'projection_x_coordinate'
-    x.units = 'm'
-    y.long_name = 'y coordinate of projection'
-    y.standard_name = 'projection_y_coordinate'
-    y.units = 'm'
-    x.reference_datum = "cartesian coordinates, UTM projection"
-    y.reference_datum = "cartesian coordinates, UTM projection"
+    y[:] = ys
+    x.setncatts(x_attrs)
+    y.setncatts(y_attrs)
 
     # Temporal attribute setting
     times = nc_fid.createVariable('time', 'f8', ('time',))
-    times.units = 'hours since 0001-01-01 00:00:00'
+    times.setncatts(TIME_ATTRS)
     if datelist:
-        times[:] = datelist[:]
+        timevals = datelist[:]
     else:
-        ctime = date2num(date, times.units, calendar='gregorian')
-        times[:] = [ctime]
-    times.calendar = 'gregorian'  # variables
-    times.axis = 'T'
-    times.standard_name = 'time'
+        timevals = [date2num(date, TIME_UNITS, calendar='gregorian')]
+    times[:] = timevals
 
     # Global attributes are set up for each variable
-    # CF Standard Names: http://cfconventions.org/standard-names.html
     # Use zlib option to apply compression
     nc_var = nc_fid.createVariable('data', 'u1', ('time', 'y0', 'x0'), fill_value=null_value, zlib=True)
-    nc_var.setncatts({'long_name': u"{}".format(description),
-                      'units': u'None',
-                      'level_desc': u'Surface',
-                      'var_desc': u"Surface Classification"})
+    attrs = data_attributes(description, legend)
+    # CF requires flag_values to have the type of the variable
+    attrs['flag_values'] = np.array(attrs['flag_values'], dtype='u1')
+    nc_var.setncatts(attrs)
 
     # Defining the parameters and metadata for UTM aprojections
     crs = nc_fid.createVariable('crs', 'i4')
-    nc_var.grid_mapping = "crs"
-    # Converting the projection grid to WGS84
-    srcproj = pyproj.CRS("EPSG:{}".format(prj))
-    dstproj = pyproj.CRS("EPSG:4326")
-    transformer = pyproj.Transformer.from_crs(srcproj, dstproj)
-    minlat, minlon = transformer.transform(minx, miny)
-    maxlat, maxlon = transformer.transform(maxx, maxy)
-    lons = np.linspace(minlon, maxlon, num=xdim)
-    lats = np.linspace(minlat, maxlat, num=ydim)
-    print("Lon(min,max): {:.2f} {:.2f} Lat(min,max): {:.2f} {:.2f}".format(minlon, maxlon,minlat, maxlat))
-
-    # Defining the parameters and metadata for UTM projection
-    longitudes = nc_fid.createVariable('lon', 'f8', ('x0',))
-    longitudes[:] = lons[:]
-    latitudes = nc_fid.createVariable('lat', 'f8', ('y0',))
-    latitudes[:] = lats[:]
-    longitudes.long_name = 'longitude'
-    longitudes.units = 'degree_east'
-    latitudes.long_name = 'latitude'
-    latitudes.units = 'degree_north'
-    crs.grid_mapping_name = "transverse_mercator"
-    crs.crs_type = "projected_2d"
-    crs.false_easting = 500000.0
-    crs.false_northing = 10000000.0
-    crs.latitude_of_projection_origin = 0.0
-    crs.scale_factor_at_central_meridian = 0.9996
-    crs.longitude_of_central_meridian = 39.0
-    crs.spatial_ref = sref
-    crs.GeoTransform = gt
+    crs.setncatts(crs_attrs)
+
+    # 2D auxiliary coordinates, transformed in row blocks to bound memory
+    chunks = (min(LATLON_ROWS, ydim), xdim)
+    longitudes = nc_fid.createVariable('lon', 'f8', ('y0', 'x0'), zlib=True, chunksizes=chunks)
+    latitudes = nc_fid.createVariable('lat', 'f8', ('y0', 'x0'), zlib=True, chunksizes=chunks)
+    longitudes.setncatts(LON_ATTRS)
+    latitudes.setncatts(LAT_ATTRS)
+    for row_start in range(0, ydim, LATLON_ROWS):
+        row_end = min(row_start + LATLON_ROWS, ydim)
+        lats, lons = latlon_rows(gt, wkt, xdim, row_start, row_end)
+        latitudes[row_start:row_end, :] = lats
+        longitudes[row_start:row_end, :] = lons
 
     # Scale data according to acceptable min max range
     print("writeNetCDF, {} Variable range: {} {}".format(ofile, np.amin(data[0,:,:]), np.amax(data[0,:,:])))
@@ -218,7 +326,244 @@ def writeNetCDF(infile, outdir, description, logger, datelist=False):
     else:
         nc_var[0, :, :] = data[0,:,:]
     nc_fid.close()
+    # Only a complete file is moved into place
+    commit_output(partial_path(ofile), ofile)
+
+    # Counted from the data already in memory
+    if aggregates:
+        write_aggregates(data if datelist else data[:1], gt, ofile, timevals, logger)
+
+    if previews:
+        write_previews(infile, outdir, logger, data=data[0,:,:], fmt=previews)
+
+    return ofile
+
+
+def write_zarr_rows(infile, root, row_start, row_end, layers):
+    """
+    Reads a block of rows from the GeoTIFF and writes it, with its latitude and longitude,
+    to the matching Zarr chunks
+
+    Each worker opens its own GDAL handle as datasets cannot be shared between threads
+    """
+    ds = gdal.Open(infile)
+    for layer in range(layers):
+        block = ds.GetRasterBand(layer+1).ReadAsArray(0, row_start, ds.RasterXSize, row_end - row_start)
+        root['data'][layer, row_start:row_end, :] = block
+
+    lats, lons = latlon_rows(ds.GetGeoTransform(), ds.GetProjection(), ds.RasterXSize, row_start, row_end)
+    root['lat'][row_start:row_end, :] = lats
+    root['lon'][row_start:row_end, :] = lons
+    ds = None
+
+    return row_end - row_start
+
+
+def writeZarr(infile, outdir, description, logger, datelist=False, chunk_size=512, workers=4, previews=None,
+              legend=None):
+    """
+    Writes the GeoTIFF to a chunked Zarr store with the same variables and attributes as writeNetCDF
+
+    Rows are read and written in chunk aligned blocks by a pool of workers, so no two workers touch
+    the same chunk, and the metadata is consolidated so a reader only needs one request to open the store
+
+    :param infile: path to desired input file
+    :param chunk_size: chunk size in pixels for the y0 and x0 dimensions
+    :param workers: number of parallel chunk writers
+    :param previews: optional preview format (PNG or WEBP)
+    """
+
+    # Extract date from filename
+    sub_element, date = get_file_date(infile, logger)
+
+    # Setup store to write
+    ofile = os.path.join(outdir, os.path.basename(infile).split(".")[0]+".zarr")
+    store = zarr.DirectoryStore(partial_path(ofile))
+    root = zarr.group(store=store, overwrite=True)
+
+    null_value = 0
+    version = get_version(logger)
+
+    # Only the header is read here, the data is read block by block by the workers
+    ds = gdal.Open(infile)
+    layers = ds.RasterCount
+    xdim, ydim = ds.RasterXSize, ds.RasterYSize
+    gt = ds.GetGeoTransform()
+    wkt = ds.GetProjection()
+    ds = None
+    print('Data array: {}'.format((layers, ydim, xdim)))
+
+    xs, ys, x_attrs, y_attrs, crs_attrs = grid_coordinates(gt, wkt, xdim, ydim)
+
+    root.attrs.update(global_attributes(description, sub_element, version, datelist))
+
+    # Coordinate variables, _ARRAY_DIMENSIONS allows xarray to read the store as a NetCDF equivalent
+    x = root.create_dataset('x0', data=xs, dtype='f8')
+    x.attrs.update(x_attrs)
+    x.attrs['_ARRAY_DIMENSIONS'] = ['x0']
+    y = root.create_dataset('y0', data=ys, dtype='f8')
+    y.attrs.update(y_attrs)
+    y.attrs['_ARRAY_DIMENSIONS'] = ['y0']
+
+    if datelist:
+        tvalues = np.array(datelist, dtype='f8')
+    else:
+        tvalues = np.array([date2num(date, TIME_UNITS, calendar='gregorian')], dtype='f8')
+    times = root.create_dataset('time', data=tvalues, dtype='f8')
+    times.attrs.update(TIME_ATTRS)
+    times.attrs['_ARRAY_DIMENSIONS'] = ['time']
+
+    # 2D auxiliary coordinates are filled by the workers alongside the data
+    longitudes = root.create_dataset('lon', shape=(ydim, xdim), chunks=(chunk_size, chunk_size), dtype='f8')
+    longitudes.attrs.update(LON_ATTRS)
+    longitudes.attrs['_ARRAY_DIMENSIONS'] = ['y0', 'x0']
+    latitudes = root.create_dataset('lat', shape=(ydim, xdim), chunks=(chunk_size, chunk_size), dtype='f8')
+    latitudes.attrs.update(LAT_ATTRS)
+    latitudes.attrs['_ARRAY_DIMENSIONS'] = ['y0', 'x0']
+
+    crs = root.create_dataset('crs', shape=(), dtype='i4')
+    crs.attrs.update(crs_attrs)
+    crs.attrs['_ARRAY_DIMENSIONS'] = []
+
+    # One chunk per time step so time-series reads only touch the chunks covering the window
+    zdata = root.create_dataset('data', shape=(layers, ydim, xdim), chunks=(1, chunk_size, chunk_size),
+                                dtype='u1', fill_value=null_value,
+                                compressor=Blosc(cname='zstd', clevel=5, shuffle=Blosc.BITSHUFFLE))
+    zdata.attrs.update(data_attributes(description, legend))
+    zdata.attrs['_ARRAY_DIMENSIONS'] = ['time', 'y0', 'x0']
+
+    # Write chunk aligned row blocks in parallel
+    blocks = [(row, min(row + chunk_size, ydim)) for row in range(0, ydim, chunk_size)]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(write_zarr_rows, infile, root, start, end, layers) for start, end in blocks]
+        rows = sum(future.result() for future in futures)
+    logger.debug("writeZarr, wrote {} rows in {} blocks".format(rows, len(blocks)))
+
+    zarr.consolidate_metadata(store)
+    commit_output(partial_path(ofile), ofile)
+    print("writeZarr, {} Dimensions TYX: {} {} {}".format(ofile, layers, ydim, xdim))
+
+    if previews:
+        write_previews(infile, outdir, logger, fmt=previews)
+
+    return ofile
+
+
+def legend_path(outfile):
+    """
+    VRT of the input with the legend, written next to the partial COG and removed once it is finished
+    """
+    return os.path.splitext(partial_path(outfile))[0] + ".vrt"
+
+
+def prepare_cog(infile, outdir, logger, legend=None):
+    """
+    GDAL commands that write a COG of a GeoTIFF, copied through a VRT that adds the legend as its
+    colour table so that the input is not modified
+
+    :param legend: lookup table from palette.read_legend, no colour table is added without one
+    :return: path of the COG and the GDAL commands that write it
+    """
+    outfile = os.path.join(outdir, os.path.basename(infile))
+    if os.path.exists(partial_path(outfile)):
+        os.remove(partial_path(outfile))
+    source = infile
+    if legend is not None:
+        source = palette.legend_vrt(infile, legend_path(outfile), legend)
+        logger.debug("Copying {} with the class colour table from {}".format(infile, source))
+
+    return outfile, cog_commands(infile, partial_path(outfile), source=source)
+
+
+def finish_cog(infile, outfile, outdir, logger, summary, previews=None):
+    """
+    Commits a COG once its GDAL commands have exited successfully
+
+    :param summary: summary of the commands from executor.run_steps()
+    :return: path of the COG, or None if a command failed or timed out
+    """
+    if os.path.exists(legend_path(outfile)):
+        os.remove(legend_path(outfile))
+    if summary['returncode'] != 0 or not os.path.exists(partial_path(outfile)):
+        logger.warning("Failed to create COG from {}{}".format(infile, ", timed out" if summary['timed_out'] else ""))
+        return None
+
+    # Previews read from the overviews built in the input
+    if previews:
+        write_previews(infile, outdir, logger, fmt=previews)
+    logger.info("Converted {} in {:.1f} seconds".format(infile, summary['elapsed']))
+
+    return commit_output(partial_path(outfile), outfile)
+
+
+def convert_cogs(infiles, outdir, logger, workers=4, previews=None, timeout=COMMAND_TIMEOUT, converted=None,
+                 legend=None):
+    """
+    Converts GeoTIFFs to COGs with the GDAL commands of up to workers files running at the same time
+
+    :param converted: function called with each input file and its COG as soon as it is written
+    :return: dictionary of input file to the path of its COG, or None if it failed
+    """
+    prepared = {infile: prepare_cog(infile, outdir, logger, legend=legend) for infile in infiles}
+    outputs = {}
+
+    def done(infile, summary):
+        outputs[infile] = finish_cog(infile, prepared[infile][0], outdir, logger, summary, previews=previews)
+        if converted is not None and outputs[infile] is not None:
+            converted(infile, outputs[infile])
+
+    run_batch(logger, {infile: commands for infile, (outfile, commands) in prepared.items()},
+              concurrency=workers, timeout=timeout, done=done)
+
+    return outputs
+
+
+def convert_file(infile, outdir, logger, fmt="cog", workers=4, previews=None, timeout=COMMAND_TIMEOUT, legend=None):
+    """
+    Converts a single GeoTIFF to a COG, NetCDF or Zarr store in the output folder
+
+    :param fmt: output format, cog, netcdf or zarr
+    :param legend: lookup table of the class colours written into the output, if any
+    :param timeout: seconds before each GDAL command writing a COG is stopped
+    :return: path of the converted file
+    """
+    description = 'EO4SAS Land Cover Classification'
+    if fmt == "zarr":
+        return writeZarr(infile, outdir, description, logger, workers=workers, previews=previews, legend=legend)
+    elif fmt == "netcdf":
+        return writeNetCDF(infile, outdir, description, logger, previews=previews, legend=legend)
+
+    return convert_cogs([infile], outdir, logger, workers=1, previews=previews, timeout=timeout,
+                        legend=legend)[infile]
+
 
+def convert_tiles(infile, outdir, logger, fmt="cog", tile_size=None, workers=4, previews=None, legend=None):
+    """
+    Cuts a GeoTIFF into grid aligned tiles, written as COGs or converted to NetCDF or Zarr
+
+    :return: paths of the converted tiles
+    """
+    if fmt == "cog":
+        # Tiles are cut from a VRT with the legend as its colour table, named after the scene
+        tmp_dir = TemporaryDirectory()
+        source = infile
+        if legend is not None:
+            vrtfile = os.path.join(tmp_dir.name, os.path.splitext(os.path.basename(infile))[0] + ".vrt")
+            source = palette.legend_vrt(infile, vrtfile, legend)
+        tiles = tile_scene(logger, source, outdir, tile_size=tile_size, workers=workers,
+                           blocksize=COG_BLOCKSIZE, compress=COG_COMPRESS)
+        tmp_dir.cleanup()
+
+        return tiles
+
+    # GeoTIFF tiles are only kept until they have been converted
+    tmp_dir = TemporaryDirectory()
+    tiles = tile_scene(logger, infile, tmp_dir.name, tile_size=tile_size, workers=workers, fmt="GTiff")
+    outputs = [convert_file(tile, outdir, logger, fmt=fmt, workers=workers, previews=previews, legend=legend)
+               for tile in tiles]
+    tmp_dir.cleanup()
+
+    return [output for output in outputs if output is not None]
 
 
 def main(args: Namespace = None) -> int:
@@ -248,6 +593,37 @@ def main(args: Namespace = None) -> int:
             action="store_true",
             default=False,
         )
+        parser.add_argument(
+            "-z",
+            "--zarr",
+            help="Convert to chunked Zarr store rather than COG.",
+            action="store_true",
+            default=False,
+        )
+        parser.add_argument(
+            "-w",
+            "--workers",
+            type=int,
+            dest="workers",
+            help="Number of parallel chunk writers for Zarr output, or of GDAL commands run at the same time for COGs",
+            default=4,
+        )
+        parser.add_argument(
+            "--timeout",
+            type=int,
+            dest="timeout",
+            help="Seconds before a GDAL command is stopped and its file counted as failed",
+            default=COMMAND_TIMEOUT,
+        )
+        parser.add_argument(
+            "-p",
+            "--previews",
+            type=str.upper,
+            dest="previews",
+            choices=["PNG", "WEBP"],
+            help="Also create colour-mapped thumbnail and overview images in this format",
+            default=None,
+        )
         parser.add_argument(
             "-r",
             "--rgb",
@@ -255,6 +631,15 @@ def main(args: Namespace = None) -> int:
             action="store_true",
             default=False,
         )
+        parser.add_argument(
+            "-c",
+            "--color-table",
+            type=str,
+            dest="color_table",
+            help="Embed the class colours of this legend, a GDAL colour file or 'rgb' to take them from the "
+                 "*_rgb_classification.tif files, as the COG colour table and NetCDF/Zarr flag_colors",
+            default=None,
+        )
         parser.add_argument(
             "-s",
             "--single",
@@ -262,6 +647,42 @@ def main(args: Namespace = None) -> int:
             action="store_true",
             default=False,
         )
+        parser.add_argument(
+            "-t",
+            "--tile-size",
+            type=int,
+            dest="tile_size",
+            help="Cut each file into grid aligned tiles of this many pixels, each written as its own output",
+            default=None,
+        )
+        parser.add_argument(
+            "-a",
+            "--aggregates",
+            help="With --single, also write per-tile class counts at several resolutions to a .agg.nc sidecar.",
+            action="store_true",
+            default=False,
+        )
+        parser.add_argument(
+            "--shard",
+            type=str,
+            dest="shard",
+            help="Only convert shard i of N of the input files, given as i/N",
+            default=None,
+        )
+        parser.add_argument(
+            "--shard-by",
+            type=str,
+            dest="shard_by",
+            choices=["hash", "date"],
+            help="Split the files between shards by a hash of the filename or by date range",
+            default="hash",
+        )
+        parser.add_argument(
+            "--resume",
+            help="Skip files that were converted completely by an earlier run.",
+            action="store_true",
+            default=False,
+        )
         parser.add_argument(
             "-v",
             "--verbose",
@@ -270,8 +691,8 @@ def main(args: Namespace = None) -> int:
             default=False,
         )
 
-    # define arguments
-    args = parser.parse_args()
+        # define arguments
+        args = parser.parse_args()
 
     # Start logging
     codedir, program = os.path.split(__file__)
@@ -293,10 +714,49 @@ def main(args: Namespace = None) -> int:
         logger.info("Could not find any input files in {}".format(args.indir))
         sys.exit(1)
 
-    if args.netcdf or args.single:
+    # Class colours are only written into the outputs from the product legend
+    color_table = args.color_table if "color_table" in args else None
+    legend = None
+    if color_table == "rgb":
+        pairs = [(fn, fn.replace("_classification.tif", "_rgb_classification.tif")) for fn in sorted(infiles)]
+        pairs = [pair for pair in pairs if os.path.exists(pair[1]) and pair[0] != pair[1]]
+        if not pairs:
+            logger.info("Could not find a *_rgb_classification.tif to take the legend from in {}".format(args.indir))
+            sys.exit(1)
+        legend = palette.legend_from_rgb(*pairs[0])
+        logger.info("Using the legend of {}".format(pairs[0][1]))
+    elif color_table:
+        legend = palette.read_legend(color_table)
+
+    # Files for this node when the conversion is split across several
+    shard = args.shard if "shard" in args else None
+    if shard:
+        if args.single:
+            logger.info("A single stacked output cannot be split into shards")
+            sys.exit(1)
+        infiles = shard_files(sorted(infiles), shard, by=args.shard_by)
+        logger.info("Shard {} has {} files".format(shard, len(infiles)))
+
+    tile_size = args.tile_size if "tile_size" in args else None
+    if tile_size and args.single:
+        logger.info("A single stacked output cannot be cut into tiles")
+        sys.exit(1)
+
+    if args.zarr:
+        logger.info("Converting TIFFs to Zarr format")
+        fmt = "zarr"
+    elif args.netcdf or args.single:
         logger.info("Converting TIFFs to NetCDF format")
+        fmt = "netcdf"
     else:
         logger.info("Converting TIFFs to COG format")
+        fmt = "cog"
+
+    timeout = args.timeout if "timeout" in args else COMMAND_TIMEOUT
+
+    # Journal of completed outputs, so an interrupted run can be resumed
+    journal = Journal(logger, os.path.join(args.outdir, ".convert-journal{}.json".format(shard_suffix(shard))),
+                      resume="resume" in args and args.resume)
 
     # Merge GeoTiFFs into stacked array
     if args.single:
@@ -316,29 +776,69 @@ def main(args: Namespace = None) -> int:
             datelist.append(ctime)
 
         outfile = os.path.join(args.outdir,"{}-{}_{}".format(start_element, elements[0], elements[1]))
-        cmd = "{} {}/gdal_merge.py -separate -o {} {}".format(python, gdal_home, outfile, intiffs)
-        if not os.path.exists(outfile):
+        cmd = "{} {}/gdal_merge.py -separate -o {} {}".format(python, gdal_home, partial_path(outfile), intiffs)
+        key = "merge:{}".format(os.path.basename(outfile))
+        if not journal.done(key):
             print(cmd)
-            execmd(cmd)
+            result = execute(logger, cmd, timeout=timeout)
+            if result['returncode'] != 0:
+                logger.info("Failed to merge the GeoTIFFs into {}".format(outfile))
+                sys.exit(1)
+            commit_output(partial_path(outfile), outfile)
+            journal.complete(key, [outfile])
         infiles = []
         infiles.append(outfile)
 
-    # Convert input files to COGs or NetCDFs
+    # The GDAL commands of the COGs run concurrently, each file is journalled as its commands complete
+    if fmt == "cog" and not tile_size:
+        pending = [infile for infile in infiles if not journal.done("{}:{}".format(fmt, os.path.basename(infile)))]
+        if len(pending) < len(infiles):
+            logger.info("Skipping {} files, already converted".format(len(infiles) - len(pending)))
+        converted = convert_cogs(pending, args.outdir, logger, workers=args.workers, previews=args.previews,
+                                 timeout=timeout, legend=legend, converted=lambda infile, ofile: journal.complete(
+                                     "{}:{}".format(fmt, os.path.basename(infile)), [ofile]))
+        failed = [infile for infile, ofile in converted.items() if ofile is None]
+        if failed:
+            logger.info("Failed to convert {} of {} files: {}".format(len(failed), len(pending), " ".join(failed)))
+            sys.exit(1)
+        infiles = []
+
+    # Convert input files to tiles, NetCDFs or Zarr stores
     for infile in infiles:
-        if args.netcdf or args.single: # Conversion to NetCDF
+        key = "{}:{}".format(fmt, os.path.basename(infile))
+        if journal.done(key):
+            logger.info("Skipping {}, already converted".format(infile))
+            continue
+
+        if tile_size: # Conversion of each tile
+            outputs = convert_tiles(infile, args.outdir, logger, fmt=fmt, tile_size=tile_size, workers=args.workers,
+                                    previews=args.previews, legend=legend)
+            journal.complete(key, outputs)
+            continue
+
+        if args.zarr: # Conversion to Zarr
+            if args.single:
+                print("Creating Zarr from {}".format(outfile))
+                ofile = writeZarr(outfile, args.outdir, 'EO4SAS Land Cover Classification', logger,
+                                  datelist=datelist, workers=args.workers, previews=args.previews, legend=legend)
+            else:
+                ofile = convert_file(infile, args.outdir, logger, fmt="zarr", workers=args.workers,
+                                     previews=args.previews, legend=legend)
+        else: # Conversion to NetCDF, COGs are converted above
             if args.single:
                 print("Creating NetCDF from {}".format(outfile))
-                writeNetCDF(outfile, args.outdir, 'EO4SAS Land Cover Classification', logger, datelist=datelist)
+                ofile = writeNetCDF(outfile, args.outdir, 'EO4SAS Land Cover Classification', logger,
+                                    datelist=datelist, previews=args.previews,
+                                    aggregates="aggregates" in args and args.aggregates, legend=legend)
             else:
-                writeNetCDF(infile, args.outdir, 'EO4SAS Land Cover Classification', logger)
-        else: # Conversion to COG
-            cmd = "{}/gladdo -r nearest {} 2 4 8 16 32 64 128 256 512".format(gdal_home, infile)
-            execmd(cmd)
-            outfile = os.path.join(args.outdir, os.path.basename(infile))
-            if os.path.exists(outfile):
-                os.remove(outfile)
-            cmd = "{}/gdal_translate -co COMPRESS=DEFLATE -co BIGTIFF=YES -co TILED=YES -co BLOCKXSIZE=512 -co BLOCKYSIZE=512 --config GDAL_TIFF_OVR_BLOCKSIZE 512 -co COPY_SRC_OVERVIEWS=YES {} {}".format(gdal_home, infile,outfile)
-            execmd(cmd)
+                ofile = convert_file(infile, args.outdir, logger, fmt="netcdf", previews=args.previews,
+                                     legend=legend)
+
+        if ofile is not None:
+            outputs = [ofile]
+            if os.path.exists(aggregate_path(ofile)):
+                outputs.append(aggregate_path(ofile))
+            journal.complete(key, outputs)
 
     logger.info("Processing completed successfully for {}".format(args.indir))
 
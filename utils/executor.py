@@ -0,0 +1,135 @@
+import os
+import signal
+import asyncio
+import time
+
+# Seconds before an external command is stopped, and number of commands run at the same time
+COMMAND_TIMEOUT = 3600
+COMMAND_CONCURRENCY = 4
+# Output lines kept in each result, the full output is only streamed to the logger
+OUTPUT_LINES = 20
+
+
+async def stream_output(logger, name, stream, start, lines):
+    """
+    Logs each line of a command's output as it is written, prefixed with the seconds since it started
+    """
+    while True:
+        line = await stream.readline()
+        if not line:
+            break
+        text = line.decode("utf-8", errors="replace").rstrip()
+        if text:
+            logger.debug("[{} +{:.1f}s] {}".format(name, time.monotonic() - start, text))
+            lines.append(text)
+            del lines[:-OUTPUT_LINES]
+
+
+async def wait_command(logger, name, proc, start, lines):
+    # Output is read to the end before waiting for the exit, so a full pipe cannot block the command
+    await stream_output(logger, name, proc.stdout, start, lines)
+    await proc.wait()
+
+
+async def run_command(logger, command, name=None, timeout=COMMAND_TIMEOUT):
+    """
+    Runs a shell command, or a list of arguments, streaming its output to the logger
+
+    The command runs in its own process group, so on a timeout the tool started by the shell is
+    killed along with it. The timeout covers the exit as well as the output, so a tool that closes
+    its output but keeps running is also stopped
+
+    :return: dictionary of the command, exit status, wall time, timeout flag and last output lines
+    """
+    name = name or os.path.basename((command if isinstance(command, str) else " ".join(command)).split()[0])
+    start = time.monotonic()
+    if isinstance(command, str):
+        proc = await asyncio.create_subprocess_shell(command, stdin=asyncio.subprocess.DEVNULL,
+                                                     stdout=asyncio.subprocess.PIPE,
+                                                     stderr=asyncio.subprocess.STDOUT, start_new_session=True)
+    else:
+        proc = await asyncio.create_subprocess_exec(*command, stdin=asyncio.subprocess.DEVNULL,
+                                                    stdout=asyncio.subprocess.PIPE,
+                                                    stderr=asyncio.subprocess.STDOUT, start_new_session=True)
+
+    lines = []
+    timed_out = False
+    try:
+        await asyncio.wait_for(wait_command(logger, name, proc, start, lines), timeout)
+    except asyncio.TimeoutError:
+        timed_out = True
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        await proc.wait()
+
+    result = {'command': command,
+              'returncode': proc.returncode,
+              'elapsed': round(time.monotonic() - start, 3),
+              'timed_out': timed_out,
+              'output': lines}
+    if timed_out:
+        logger.warning("{} timed out after {} seconds: {}".format(name, timeout, command))
+    elif proc.returncode != 0:
+        logger.warning("{} failed with exit status {}: {}".format(name, proc.returncode, "\n".join(lines[-5:])))
+    else:
+        logger.debug("{} completed in {:.1f} seconds".format(name, result['elapsed']))
+
+    return result
+
+
+async def run_steps(logger, name, commands, semaphore, timeout=COMMAND_TIMEOUT):
+    """
+    Runs the commands for one file in order, stopping at the first that fails
+
+    :return: dictionary of the overall exit status, wall time and per command results
+    """
+    async with semaphore:
+        start = time.monotonic()
+        results = []
+        for command in commands:
+            results.append(await run_command(logger, command, name=os.path.basename(name), timeout=timeout))
+            if results[-1]['returncode'] != 0:
+                break
+
+    return {'name': name,
+            'returncode': results[-1]['returncode'] if results else 0,
+            'timed_out': any(result['timed_out'] for result in results),
+            'elapsed': round(time.monotonic() - start, 3),
+            'results': results}
+
+
+async def run_jobs(logger, jobs, concurrency=COMMAND_CONCURRENCY, timeout=COMMAND_TIMEOUT, done=None):
+    semaphore = asyncio.Semaphore(concurrency)
+    summaries = {}
+    for future in asyncio.as_completed([run_steps(logger, name, commands, semaphore, timeout=timeout)
+                                        for name, commands in jobs.items()]):
+        summary = await future
+        summaries[summary['name']] = summary
+        if done is not None:
+            done(summary['name'], summary)
+
+    return summaries
+
+
+def run_batch(logger, jobs, concurrency=COMMAND_CONCURRENCY, timeout=COMMAND_TIMEOUT, done=None):
+    """
+    Runs the commands of many files concurrently, with the commands of each file run in order
+
+    A command that hangs is killed after the timeout, so it only fails its own file
+
+    :param jobs: dictionary of file name to list of commands
+    :param done: function called with the name and summary of each file as its commands complete
+    :return: dictionary of file name to the summary from run_steps()
+    """
+    return asyncio.run(run_jobs(logger, jobs, concurrency=concurrency, timeout=timeout, done=done))
+
+
+def execute(logger, command, timeout=COMMAND_TIMEOUT):
+    """
+    Runs a single command and waits for it, for callers that are not asynchronous
+
+    :return: result dictionary from run_command()
+    """
+    return asyncio.run(run_command(logger, command, timeout=timeout))
@@ -0,0 +1,198 @@
+import os
+import sys
+from argparse import Namespace, ArgumentParser
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+import fsspec
+# pip install kerchunk
+from kerchunk.hdf import SingleHdf5ToZarr
+from kerchunk.combine import MultiZarrToZarr
+from kerchunk.df import refs_to_dataframe
+import zarr
+
+# Variables that are the same in every per-date NetCDF written by writeNetCDF
+IDENTICAL_DIMS = ['x0', 'y0', 'lat', 'lon', 'crs']
+
+
+def list_netcdfs(inpath, storage_options):
+    """
+    Expands a folder, glob or single file (local or s3://) into a sorted list of NetCDF urls
+    """
+    fs, _, paths = fsspec.get_fs_token_paths(inpath, storage_options=storage_options)
+    if len(paths) == 1 and fs.isdir(paths[0]):
+        # Aggregate sidecars written by convert_gtiff.py --aggregates are not data files
+        paths = [path for path in fs.glob(os.path.join(paths[0], "*.nc")) if not path.endswith(".agg.nc")]
+    protocol = fs.protocol if isinstance(fs.protocol, str) else fs.protocol[0]
+    if protocol in ("file", "local"):
+        return sorted(paths)
+
+    return sorted("{}://{}".format(protocol, path) for path in paths)
+
+
+def scan_netcdf(url, logger, storage_options=None, inline_threshold=300):
+    """
+    Reads the HDF5 chunk layout of a NetCDF once and returns the kerchunk references
+
+    Only the HDF5 B-tree and attribute blocks are fetched, the chunk data is not read,
+    and chunks smaller than inline_threshold bytes are stored inline in the index
+
+    :return: reference dictionary mapping every chunk key to [url, offset, length]
+    """
+    with fsspec.open(url, mode="rb", **(storage_options or {})) as infile:
+        refs = SingleHdf5ToZarr(infile, url, inline_threshold=inline_threshold).translate()
+    logger.info("Scanned {} with {} references".format(url, len(refs["refs"])))
+
+    return refs
+
+
+def write_references(refs, outfile, logger):
+    """
+    Writes references as JSON, or as a Parquet reference store if outfile ends with .parq
+    """
+    if outfile.endswith(".parq"):
+        refs_to_dataframe(refs, outfile)
+    else:
+        with open(outfile, "w") as f:
+            json.dump(refs, f)
+            f.close()
+    logger.info("Writing references to: {}".format(outfile))
+
+    return outfile
+
+
+def combine_references(refs_list, logger, storage_options=None):
+    """
+    Combines per-date references into one virtual time-series cube concatenated along time
+    """
+    remote_protocol = None
+    for refs in refs_list:
+        for value in refs["refs"].values():
+            if isinstance(value, list) and "://" in value[0]:
+                remote_protocol = value[0].split("://")[0]
+                break
+        if remote_protocol is not None:
+            break
+
+    mzz = MultiZarrToZarr(refs_list,
+                          concat_dims=['time'],
+                          identical_dims=IDENTICAL_DIMS,
+                          remote_protocol=remote_protocol,
+                          remote_options=storage_options or {})
+    combined = mzz.translate()
+    logger.info("Combined {} files into a single time-series cube".format(len(refs_list)))
+
+    return combined
+
+
+def open_references(refs, storage_options=None):
+    """
+    Opens a reference index (dictionary, JSON or Parquet) as a read-only virtual Zarr group
+
+    Chunk reads are turned into range requests against the original NetCDFs
+    """
+    if isinstance(refs, str) and not refs.endswith(".parq"):
+        with fsspec.open(refs, "r") as f:
+            refs = json.load(f)
+    fs = fsspec.filesystem("reference", fo=refs, remote_options=storage_options or {})
+
+    return zarr.open(fs.get_mapper(""), mode="r")
+
+
+def main(args: Namespace = None) -> int:
+    if args is None:
+        parser = ArgumentParser(
+            description="Creates kerchunk byte-range reference indexes for NetCDFs from writeNetCDF",
+            epilog="Readers can open the index as a virtual Zarr without opening the HDF5 files",
+        )
+        parser.add_argument(
+            "-i",
+            "--input",
+            type=str,
+            dest="input",
+            help="Input NetCDF file, folder or glob (local or s3://)",
+        )
+        parser.add_argument(
+            "-o",
+            "--outdir",
+            type=str,
+            dest="outdir",
+            help="Output folder for the reference indexes",
+        )
+        parser.add_argument(
+            "-c",
+            "--combine",
+            type=str,
+            dest="combine",
+            help="Also combine the per-date files into a single time-series reference with this name",
+            default=None,
+        )
+        parser.add_argument(
+            "-p",
+            "--parquet",
+            help="Write Parquet reference stores rather than JSON",
+            action="store_true",
+            default=False,
+        )
+        parser.add_argument(
+            "-a",
+            "--anon",
+            help="Access the S3 bucket anonymously",
+            action="store_true",
+            default=False,
+        )
+        parser.add_argument(
+            "-w",
+            "--workers",
+            type=int,
+            dest="workers",
+            help="Number of files scanned in parallel",
+            default=8,
+        )
+        parser.add_argument(
+            "-v",
+            "--verbose",
+            help="Add extra information to logs.",
+            action="store_true",
+            default=False,
+        )
+
+        # define arguments
+        args = parser.parse_args()
+
+    # Start logging
+    codedir, program = os.path.split(__file__)
+    logger = logging.getLogger(program)
+    logger.setLevel(logging.DEBUG if "verbose" in args and args.verbose else logging.INFO)
+
+    # Create output directory if does not exist
+    if not os.path.exists(args.outdir):
+        os.mkdir(args.outdir)
+
+    storage_options = {"anon": True} if args.anon else {}
+    urls = list_netcdfs(args.input, storage_options)
+    if len(urls) == 0:
+        logger.info("Could not find any NetCDF files in {}".format(args.input))
+        sys.exit(1)
+
+    # Scan each file once, in parallel as the scans are dominated by request latency
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        refs_list = list(executor.map(lambda url: scan_netcdf(url, logger, storage_options), urls))
+
+    ext = ".parq" if args.parquet else ".json"
+    for url, refs in zip(urls, refs_list):
+        outfile = os.path.join(args.outdir, os.path.basename(url).split(".")[0] + ext)
+        write_references(refs, outfile, logger)
+
+    if args.combine:
+        combined = combine_references(refs_list, logger, storage_options)
+        write_references(combined, os.path.join(args.outdir, os.path.basename(args.combine).split(".")[0] + ext),
+                         logger)
+
+    logger.info("Processing completed successfully for {}".format(args.input))
+
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
@@ -0,0 +1,204 @@
+import numpy as np
+from osgeo import gdal
+
+# EO4SAS land cover classes, value 0 is the no data value
+# Names and values follow configuration-tds-pytdml.yaml. The colours are only used for previews,
+# the colours written into the outputs come from the product legend, see read_legend()
+CLASSES = [
+    (1, "clear water", (0, 92, 230, 255)),
+    (2, "algal blooms", (0, 168, 132, 255)),
+    (3, "aqueous deposits", (115, 178, 255, 255)),
+    (4, "bare ground", (205, 170, 102, 255)),
+    (5, "murrum soil", (168, 56, 0, 255)),
+    (6, "sand", (255, 235, 175, 255)),
+    (7, "grassland", (163, 255, 115, 255)),
+    (8, "shrubland", (112, 168, 0, 255)),
+    (9, "forest", (38, 115, 0, 255)),
+    (10, "cropland", (255, 255, 0, 255)),
+    (11, "palm", (76, 230, 0, 255)),
+    (12, "buildings", (230, 0, 0, 255)),
+    (13, "artificial surfaces", (156, 156, 156, 255)),
+    (14, "cloud", (255, 255, 255, 255)),
+    (15, "shadows", (52, 52, 52, 255)),
+    (16, "plastic", (255, 0, 197, 255)),
+    (17, "tyres", (0, 0, 0, 255)),
+    (18, "waves", (190, 232, 255, 255)),
+    (19, "greenhouses", (223, 115, 255, 255)),
+    (20, "waste sites", (137, 90, 68, 255)),
+]
+NODATA = 0
+
+
+def default_lut():
+    """
+    256 entry RGBA lookup table for the EO4SAS classes, unused values are transparent
+    """
+    lut = np.zeros((256, 4), dtype=np.uint8)
+    for value, name, colour in CLASSES:
+        lut[value] = colour
+
+    return lut
+
+
+def get_lut(band):
+    """
+    Lookup table from the colour table of a GDAL band, falling back to the EO4SAS classes
+    """
+    ctable = band.GetRasterColorTable()
+    if ctable is None:
+        return default_lut()
+
+    lut = np.zeros((256, 4), dtype=np.uint8)
+    for value in range(min(ctable.GetCount(), 256)):
+        lut[value] = ctable.GetColorEntry(value)
+    lut[NODATA, 3] = 0
+
+    return lut
+
+
+def read_legend(path):
+    """
+    Lookup table from a legend in the GDAL colour file format, a "value R G B [A]" line per class,
+    optionally followed by the class name
+
+    :raises ValueError: if a line cannot be parsed
+    """
+    lut = np.zeros((256, 4), dtype=np.uint8)
+    with open(path, "r") as f:
+        for line in f:
+            fields = line.split("#")[0].replace(",", " ").split()
+            if not fields or fields[0].lower() == "nv":
+                continue
+            if len(fields) < 4:
+                raise ValueError("Invalid legend line in {}: {}".format(path, line.strip()))
+            value = int(fields[0])
+            alpha = int(fields[4]) if len(fields) > 4 and fields[4].isdigit() else 255
+            lut[value] = [int(c) for c in fields[1:4]] + [alpha]
+        f.close()
+    lut[NODATA, 3] = 0
+
+    return lut
+
+
+def legend_from_rgb(class_file, rgb_file, size=1024):
+    """
+    Lookup table of the colours a classification is rendered with in its RGB version, taking the
+    most frequent colour of each class value from a reduced read of both images
+    """
+    class_ds, rgb_ds = gdal.Open(class_file), gdal.Open(rgb_file)
+    scale = max(1.0, float(max(class_ds.RasterXSize, class_ds.RasterYSize)) / size)
+    xsize = max(1, int(round(class_ds.RasterXSize / scale)))
+    ysize = max(1, int(round(class_ds.RasterYSize / scale)))
+    classes = class_ds.GetRasterBand(1).ReadAsArray(buf_xsize=xsize, buf_ysize=ysize).ravel()
+    rgb = np.stack([rgb_ds.GetRasterBand(band + 1).ReadAsArray(buf_xsize=xsize, buf_ysize=ysize).ravel()
+                    for band in range(3)], axis=1).astype(np.uint32)
+    class_ds = rgb_ds = None
+
+    packed = (rgb[:, 0] << 16) | (rgb[:, 1] << 8) | rgb[:, 2]
+    lut = np.zeros((256, 4), dtype=np.uint8)
+    for value in np.unique(classes):
+        if value == NODATA:
+            continue
+        colours, counts = np.unique(packed[classes == value], return_counts=True)
+        colour = int(colours[np.argmax(counts)])
+        lut[value] = [(colour >> 16) & 255, (colour >> 8) & 255, colour & 255, 255]
+
+    return lut
+
+
+def color_table(lut):
+    """
+    GDAL colour table of a lookup table
+    """
+    ctable = gdal.ColorTable()
+    for value in range(lut.shape[0]):
+        ctable.SetColorEntry(value, tuple(int(c) for c in lut[value]))
+
+    return ctable
+
+
+def legend_vrt(infile, vrtfile, lut):
+    """
+    Writes a VRT of a single band classification with the legend as its colour table, so that
+    copies of it, such as the COG, are displayed in colour without a separate RGB file. The
+    input is left unchanged and the overviews built in it are still read through the VRT
+
+    :return: path of the VRT, or the input if it is not a single band classification
+    """
+    ds = gdal.Open(infile)
+    if ds.RasterCount != 1:
+        ds = None
+        return infile
+    vrt = gdal.Translate(vrtfile, ds, format="VRT")
+    band = vrt.GetRasterBand(1)
+    band.SetRasterColorTable(color_table(lut))
+    band.SetRasterColorInterpretation(gdal.GCI_PaletteIndex)
+    vrt = ds = None
+
+    return vrtfile
+
+
+def flag_attributes(lut=None):
+    """
+    CF flag attributes of the classes, plus flag_colors as #rrggbb for the same values when a
+    legend lookup table is given
+    """
+    attrs = {'flag_values': [value for value, name, colour in CLASSES],
+             'flag_meanings': " ".join(name.replace(" ", "_") for value, name, colour in CLASSES)}
+    if lut is not None:
+        attrs['flag_colors'] = " ".join("#{:02x}{:02x}{:02x}".format(*lut[value][:3])
+                                        for value, name, colour in CLASSES)
+
+    return attrs
+
+
+def lut_from_flags(flag_values, flag_colors):
+    """
+    Lookup table from the flag_values and flag_colors attributes of a NetCDF or Zarr variable
+    """
+    lut = np.zeros((256, 4), dtype=np.uint8)
+    for value, colour in zip(np.atleast_1d(flag_values), flag_colors.split()):
+        colour = colour.lstrip("#")
+        lut[int(value)] = [int(colour[k:k+2], 16) for k in (0, 2, 4)] + [255]
+
+    return lut
+
+
+def colourise(data, lut):
+    """
+    Expands a class array to RGBA by indexing the lookup table
+
+    :return: array of shape (rows, cols, 4)
+    """
+    return lut[data]
+
+
+def expand_rgb(data, lut=None):
+    """
+    RGB of a class array for consumers that cannot use a colour table
+
+    Only the 256 entry table is copied, the image itself is expanded with a single fancy index,
+    so there is no need to store an RGB version of each classification
+
+    :return: array of shape data.shape + (3,)
+    """
+    if lut is None:
+        lut = default_lut()
+
+    return np.ascontiguousarray(lut[:, :3])[data]
+
+
+def write_image(rgba, outfile, fmt="PNG"):
+    """
+    Writes an RGBA array to a PNG or WEBP image through an in-memory GDAL dataset
+    """
+    rows, cols, bands = rgba.shape
+    mem = gdal.GetDriverByName("MEM").Create("", cols, rows, bands, gdal.GDT_Byte)
+    for band in range(bands):
+        mem.GetRasterBand(band+1).WriteArray(rgba[:, :, band])
+
+    options = ["QUALITY=85"] if fmt == "WEBP" else []
+    gdal.GetDriverByName(fmt).CreateCopy(outfile, mem, options=options)
+    mem = None
+
+    return outfile
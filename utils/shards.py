@@ -0,0 +1,49 @@
+import os
+import hashlib
+
+
+def parse_shard(shard):
+    """
+    Shard number and count from 'i/N', shards are numbered from 1
+    """
+    try:
+        index, count = [int(part) for part in shard.split("/")]
+    except ValueError:
+        raise ValueError("Shard {} should be given as i/N".format(shard))
+    if count < 1 or not 1 <= index <= count:
+        raise ValueError("Shard {} should be given as i/N with 1 <= i <= N".format(shard))
+
+    return index, count
+
+
+def shard_suffix(shard):
+    """
+    Suffix added to the output names of a shard, e.g. -shard-2-of-8
+    """
+    if shard is None:
+        return ""
+    index, count = parse_shard(shard)
+
+    return "-shard-{}-of-{}".format(index, count)
+
+
+def shard_indices(files, shard, by="hash"):
+    """
+    Positions of the files that belong to a shard
+
+    By hash, each file goes to the shard given by a hash of its name, so the split does not
+    depend on the order or number of files listed. By date, the files sorted by their date
+    prefix are split into contiguous ranges of equal size
+    """
+    index, count = parse_shard(shard)
+    if by == "date":
+        order = sorted(range(len(files)), key=lambda k: os.path.basename(files[k]))
+        bounds = [len(files) * k // count for k in range(count + 1)]
+        return sorted(order[bounds[index - 1]:bounds[index]])
+
+    return [k for k, file in enumerate(files)
+            if int(hashlib.md5(os.path.basename(file).encode("utf-8")).hexdigest(), 16) % count == index - 1]
+
+
+def shard_files(files, shard, by="hash"):
+    return [files[k] for k in shard_indices(files, shard, by=by)]
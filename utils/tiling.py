@@ -0,0 +1,130 @@
+import os
+import re
+import math
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from osgeo import gdal
+
+from utils.checkpoint import partial_path, commit_output
+
+# Tile size in pixels, tiles are aligned to a grid of this size in the projected CRS so
+# tiles of overlapping scenes cover the same areas
+TILE_SIZE = 4096
+# Grid position added to the scene name, e.g. 20200831T101156_classification_x0012_y-0345
+TILE_PATTERN = re.compile(r"^(?P<scene>.+)_x(?P<x>-?\d+)_y(?P<y>-?\d+)$")
+
+
+def grid_index(value):
+    # Four digits after the sign, so negative positions have the same width as positive ones
+    return "{}{:04d}".format("-" if value < 0 else "", abs(value))
+
+
+def tile_name(scene, x, y):
+    return "{}_x{}_y{}".format(scene, grid_index(x), grid_index(y))
+
+
+def parse_tile(name):
+    """
+    Scene name and grid position of a tile name, or None if it is not a tile
+    """
+    match = TILE_PATTERN.match(os.path.splitext(os.path.basename(name))[0])
+    if match is None:
+        return None
+
+    return match.group("scene"), int(match.group("x")), int(match.group("y"))
+
+
+def axis_windows(origin, res, size, tile_size):
+    """
+    Grid index, pixel offset and length of the tiles along one axis of an image
+
+    :param origin: coordinate of the image edge, increasing with the pixel index
+    :param res: positive pixel size
+    """
+    span = tile_size * res
+    first = int(math.floor(origin / span))
+    last = int(math.floor((origin + size * res) / span - 1e-9))
+    windows = []
+    for index in range(first, last + 1):
+        start = max(0, int(round((index * span - origin) / res)))
+        end = min(size, int(round(((index + 1) * span - origin) / res)))
+        if end > start:
+            windows.append((index, start, end - start))
+
+    return windows
+
+
+def tile_windows(gt, xdim, ydim, tile_size=TILE_SIZE):
+    """
+    Grid aligned windows covering a north-up image
+
+    Rows are indexed from north to south so names sort in reading order
+
+    :return: list of (x index, y index, xoff, yoff, xsize, ysize)
+    """
+    cols = axis_windows(gt[0], abs(gt[1]), xdim, tile_size)
+    rows = axis_windows(-gt[3], abs(gt[5]), ydim, tile_size)
+
+    return [(x, y, xoff, yoff, xsize, ysize) for y, yoff, ysize in rows for x, xoff, xsize in cols]
+
+
+def cog_options(blocksize, compress):
+    return ["BLOCKSIZE={}".format(blocksize), "COMPRESS={}".format(compress), "BIGTIFF=IF_SAFER",
+            "OVERVIEWS=AUTO", "RESAMPLING=NEAREST"]
+
+
+def write_tile(infile, outfile, window, nodata=0, blocksize=512, compress="DEFLATE", fmt="COG"):
+    """
+    Copies one window of a scene to a tile, skipping windows that only hold no data
+
+    Each call opens its own GDAL handle so tiles can be written by several workers
+
+    :return: path of the tile, or None if it was empty
+    """
+    xoff, yoff, xsize, ysize = window
+    ds = gdal.Open(infile)
+    block = ds.GetRasterBand(1).ReadAsArray(xoff, yoff, xsize, ysize)
+    if block is None or np.all(block == nodata):
+        ds = None
+        return None
+
+    options = cog_options(blocksize, compress) if fmt == "COG" else ["COMPRESS={}".format(compress), "TILED=YES"]
+    gdal.Translate(partial_path(outfile), ds, format=fmt, srcWin=[xoff, yoff, xsize, ysize], creationOptions=options)
+    ds = None
+
+    return commit_output(partial_path(outfile), outfile)
+
+
+def tile_scene(logger, infile, outdir, tile_size=TILE_SIZE, workers=4, fmt="COG", blocksize=512, compress="DEFLATE"):
+    """
+    Cuts a scene into grid aligned tiles, written in parallel windowed passes
+
+    :param fmt: COG, or GTiff for tiles that are converted further
+    :return: paths of the tiles that hold valid data
+    """
+    ds = gdal.Open(infile)
+    gt = ds.GetGeoTransform()
+    xdim, ydim = ds.RasterXSize, ds.RasterYSize
+    nodata = ds.GetRasterBand(1).GetNoDataValue()
+    ds = None
+    if gt[2] != 0 or gt[4] != 0:
+        logger.warning("{} is not north-up, writing it as a single tile".format(infile))
+        windows = [(0, 0, 0, 0, xdim, ydim)]
+    else:
+        windows = tile_windows(gt, xdim, ydim, tile_size)
+
+    scene = os.path.basename(infile).split(".")[0]
+    ext = ".tif"
+
+    def write(window):
+        x, y = window[:2]
+        outfile = os.path.join(outdir, tile_name(scene, x, y) + ext)
+        return write_tile(infile, outfile, window[2:], nodata=0 if nodata is None else nodata,
+                          blocksize=blocksize, compress=compress, fmt=fmt)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        tiles = [tile for tile in executor.map(write, windows) if tile is not None]
+    logger.info("Cut {} into {} tiles of {} pixels, {} empty tiles skipped".format(
+        infile, len(tiles), tile_size, len(windows) - len(tiles)))
+
+    return tiles
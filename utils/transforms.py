@@ -0,0 +1,88 @@
+import threading
+import numpy as np
+import pyproj
+
+# Transformers are cached per thread, as a pyproj Transformer must not be shared between threads
+_local = threading.local()
+
+
+def get_transformer(src_crs, dst_crs="EPSG:4326"):
+    """
+    Memoised always_xy Transformer for a (source, destination) CRS pair
+
+    The CRSs can be given as anything pyproj accepts (WKT, "EPSG:xxxx" or a pyproj.CRS), and a
+    transformer is only created the first time a pair is seen by each thread
+    """
+    cache = getattr(_local, "transformers", None)
+    if cache is None:
+        cache = _local.transformers = {}
+
+    key = (str(src_crs), str(dst_crs))
+    transformer = cache.get(key)
+    if transformer is None:
+        transformer = pyproj.Transformer.from_crs(src_crs, dst_crs, always_xy=True)
+        cache[key] = transformer
+
+    return transformer
+
+
+def pixel_centres(gt, xdim, ydim):
+    """
+    Projected x and y of the pixel centres along the first row and column of a north-up image
+    """
+    xs = gt[0] + (np.arange(xdim) + 0.5) * gt[1]
+    ys = gt[3] + (np.arange(ydim) + 0.5) * gt[5]
+
+    return xs, ys
+
+
+def latlon_rows(gt, wkt, xdim, row_start, row_end):
+    """
+    2D latitude and longitude of the pixel centres for a block of rows
+
+    Memory is bounded by the block size rather than the image size
+
+    :return: lat and lon arrays of shape (row_end - row_start, xdim)
+    """
+    cols = np.arange(xdim) + 0.5
+    rows = np.arange(row_start, row_end)[:, np.newaxis] + 0.5
+    xx = gt[0] + cols * gt[1] + rows * gt[2]
+    yy = gt[3] + cols * gt[4] + rows * gt[5]
+    lon, lat = get_transformer(wkt).transform(xx, yy)
+
+    return lat, lon
+
+
+def cf_grid_mapping(wkt, gt):
+    """
+    CF grid mapping attributes derived from the source WKT rather than assumed
+    """
+    crs = pyproj.CRS.from_wkt(wkt)
+    attrs = crs.to_cf()
+    attrs['crs_type'] = "projected_2d" if crs.is_projected else "geographic_2d"
+    attrs['spatial_ref'] = crs.to_wkt()
+    attrs['GeoTransform'] = list(gt)
+
+    return attrs
+
+
+def cf_coordinate_attributes(wkt):
+    """
+    CF attributes of the x and y coordinates, from the axes of the source CRS rather than
+    assuming UTM metres
+
+    :return: x and y variable attributes
+    """
+    crs = pyproj.CRS.from_wkt(wkt)
+    datum = "{} coordinates, {}".format("cartesian" if crs.is_projected else "geographic", crs.name)
+    if crs.datum is not None:
+        datum += ", datum {}".format(crs.datum.name)
+    axes = {}
+    for attrs in crs.cs_to_cf():
+        attrs = dict(attrs)
+        if attrs.get('units') == "metre":
+            attrs['units'] = "m"
+        attrs['reference_datum'] = datum
+        axes[attrs.pop('axis', None)] = attrs
+
+    return axes.get('X', {}), axes.get('Y', {})